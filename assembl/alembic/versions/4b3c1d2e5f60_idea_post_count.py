@@ -0,0 +1,39 @@
+"""idea post count
+
+Revision ID: 4b3c1d2e5f60
+Revises: f7d61062eccf
+Create Date: 2026-10-18 10:12:41.532106
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b3c1d2e5f60'
+down_revision = 'f7d61062eccf'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_post_count',
+            sa.Column('idea_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('num_posts', sa.Integer, nullable=False),
+            sa.Column('num_contributors', sa.Integer, nullable=False))
+    # Counts are filled by assembl.scripts.rebuild_idea_post_counts;
+    # until then, they are computed on the fly.
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_post_count')
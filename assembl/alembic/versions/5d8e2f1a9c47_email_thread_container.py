@@ -0,0 +1,43 @@
+"""email thread container
+
+Revision ID: 5d8e2f1a9c47
+Revises: c81f4e6a2d95
+Create Date: 2026-10-18 19:12:44.508321
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d8e2f1a9c47'
+down_revision = 'c81f4e6a2d95'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    # Filled as emails are imported; assembl.scripts.rethread_mails
+    # fills it for existing emails.
+    with context.begin_transaction():
+        op.create_table(
+            'email_thread_container',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('message_id', sa.Unicode, nullable=False),
+            sa.Column('email_id', sa.Integer, sa.ForeignKey(
+                'email.id', ondelete='SET NULL', onupdate='CASCADE'),
+                index=True),
+            sa.Column('parent_id', sa.Integer, sa.ForeignKey(
+                'email_thread_container.id', ondelete='SET NULL',
+                onupdate='CASCADE'), index=True),
+            sa.UniqueConstraint('discussion_id', 'message_id'))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('email_thread_container')
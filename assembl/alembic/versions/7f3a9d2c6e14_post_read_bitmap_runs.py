@@ -0,0 +1,30 @@
+"""post read bitmaps as runs of ids
+
+Revision ID: 7f3a9d2c6e14
+Revises: 5d8e2f1a9c47
+Create Date: 2026-10-18 17:41:05.532916
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7f3a9d2c6e14'
+down_revision = '5d8e2f1a9c47'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    # The storage format changed; bitmaps are rebuilt from the action
+    # table when next needed.
+    with context.begin_transaction():
+        op.execute("DELETE FROM post_read_bitmap")
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.execute("DELETE FROM post_read_bitmap")
@@ -0,0 +1,38 @@
+"""post read bitmap
+
+Revision ID: 9e2a7c4d1b83
+Revises: 4b3c1d2e5f60
+Create Date: 2026-10-18 14:03:17.218440
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e2a7c4d1b83'
+down_revision = '4b3c1d2e5f60'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'post_read_bitmap',
+            sa.Column('user_id', sa.Integer, sa.ForeignKey(
+                'user.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('base_id', sa.Integer, nullable=False),
+            sa.Column('bits', sa.LargeBinary, nullable=False))
+    # Bitmaps are built from the action table when first needed.
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('post_read_bitmap')
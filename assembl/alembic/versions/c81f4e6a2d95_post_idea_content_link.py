@@ -0,0 +1,71 @@
+"""post idea content link index
+
+Revision ID: c81f4e6a2d95
+Revises: 9e2a7c4d1b83
+Create Date: 2026-10-18 16:41:05.730214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c81f4e6a2d95'
+down_revision = '9e2a7c4d1b83'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'post_idea_content_link',
+            sa.Column('post_id', sa.Integer, sa.ForeignKey(
+                'post.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('idea_content_link_id', sa.Integer, sa.ForeignKey(
+                'idea_content_link.id', ondelete='CASCADE',
+                onupdate='CASCADE'), primary_key=True, index=True),
+            sa.Column('negative', sa.Boolean, nullable=False))
+        op.execute("""
+            INSERT INTO post_idea_content_link
+                (post_id, idea_content_link_id, negative)
+            SELECT post.id, idea_content_link.id,
+                idea_content_link.type IN (
+                    'assembl:postDelinkedToIdea_abstract',
+                    'assembl:postDelinkedToIdea')
+            FROM post JOIN idea_content_link
+            ON idea_content_link.content_id = ANY(string_to_array(
+                post.ancestry || CAST(post.id AS VARCHAR), ',')::integer[])""")
+        op.execute(
+            "DROP FUNCTION IF EXISTS idea_content_links_above_post(integer)")
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('post_idea_content_link')
+        op.execute("""
+CREATE OR REPLACE FUNCTION idea_content_links_above_post(IN root_id integer)
+        RETURNS varchar AS $$
+DECLARE
+    posts varchar;
+    posts_a integer[];
+    icl_a integer[];
+    agg varchar;
+BEGIN
+    SELECT post.ancestry || cast (post.id as VARCHAR) FROM post
+        WHERE post.id = root_id INTO posts;
+    IF posts IS NULL THEN
+        RETURN '';
+    END IF;
+    SELECT string_to_array(posts, ',') INTO posts_a;
+    SELECT array (
+        SELECT idea_content_link.id FROM unnest(posts_a) post_id
+        JOIN idea_content_link ON content_id = cast (post_id AS INTEGER)
+    ) INTO icl_a;
+    agg := array_to_string(icl_a, ',');
+    RETURN agg;
+END;
+$$ LANGUAGE plpgsql;""")
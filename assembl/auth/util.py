@@ -3,11 +3,12 @@ from csv import reader
 from datetime import datetime, timedelta
 from io import TextIOWrapper, BytesIO
 import base64
-from itertools import groupby
+from itertools import groupby, chain
 from collections import defaultdict
 
 from future.utils import string_types
-from sqlalchemy import inspect
+from sqlalchemy import inspect, event
+from sqlalchemy.orm.session import Session, object_session
 from sqlalchemy.sql.expression import and_
 from pyramid.security import (Everyone, Authenticated, forget)
 from pyramid.httpexceptions import HTTPNotFound
@@ -17,6 +18,7 @@ from pyramid.authentication import SessionAuthenticationPolicy
 
 from assembl.lib.locale import _
 from ..lib.sqla import get_session_maker
+from ..lib.caching import shared_region, generational_key, renew_generation
 from ..lib.raven_client import sentry_context
 from . import (
     R_SYSADMIN, P_READ, R_OWNER, P_SYSADMIN, SYSTEM_ROLES, ASSEMBL_PERMISSIONS)
@@ -104,34 +106,276 @@ def roles_from_request_reified(request):
     return roles
 
 
+class DiscussionAcl(object):
+    """The permissions that each role has in a discussion,
+    in general and for each publication state."""
+
+    def __init__(self, role_permissions=None, state_role_permissions=None,
+                 state_labels=None):
+        # role name -> frozenset of permission names
+        self.role_permissions = role_permissions or {}
+        # pub_state_id -> role name -> frozenset of permission names
+        self.state_role_permissions = state_role_permissions or {}
+        # pub_state_id -> publication state label
+        self.state_labels = state_labels or {}
+
+    @classmethod
+    def load(cls, discussion_id):
+        session = get_session_maker()()
+        role_permissions = defaultdict(set)
+        state_role_permissions = defaultdict(lambda: defaultdict(set))
+        state_labels = {}
+        if discussion_id:
+            for (role, permission) in session.query(
+                    Role.name, Permission.name
+                    ).select_from(DiscussionPermission).join(
+                    Role, DiscussionPermission.role_id == Role.id).join(
+                    Permission, DiscussionPermission.permission_id == Permission.id
+                    ).filter(DiscussionPermission.discussion_id == discussion_id):
+                role_permissions[role].add(permission)
+            for (state_id, label, role, permission) in session.query(
+                    StateDiscussionPermission.pub_state_id,
+                    PublicationState.label, Role.name, Permission.name
+                    ).select_from(StateDiscussionPermission).join(
+                    PublicationState,
+                    StateDiscussionPermission.pub_state_id == PublicationState.id
+                    ).join(Role, StateDiscussionPermission.role_id == Role.id
+                    ).join(Permission,
+                           StateDiscussionPermission.permission_id == Permission.id
+                    ).filter(StateDiscussionPermission.discussion_id == discussion_id):
+                state_role_permissions[state_id][role].add(permission)
+                state_labels[state_id] = label
+        return cls(
+            {role: frozenset(perms) for (role, perms) in role_permissions.items()},
+            {state_id: {role: frozenset(perms) for (role, perms) in by_role.items()}
+             for (state_id, by_role) in state_role_permissions.items()},
+            state_labels)
+
+    def permissions_for(self, roles):
+        return frozenset(chain.from_iterable(
+            self.role_permissions.get(role, ()) for role in roles))
+
+    def state_permissions_for(self, state_id, roles):
+        by_role = self.state_role_permissions.get(state_id, {})
+        return frozenset(chain.from_iterable(
+            by_role.get(role, ()) for role in roles))
+
+
+class UserPermissions(object):
+    """The roles and permissions of a user in a discussion,
+    as given by :py:class:`PermissionResolver`."""
+
+    def __init__(self, roles, acl):
+        self.roles = roles
+        self.acl = acl
+        self.is_sysadmin = R_SYSADMIN in roles
+        if self.is_sysadmin:
+            self.permissions = frozenset(ASSEMBL_PERMISSIONS)
+        else:
+            self.permissions = acl.permissions_for(roles)
+        self.state_permissions = {
+            state_id: acl.state_permissions_for(state_id, roles)
+            for state_id in acl.state_role_permissions}
+
+    def permissions_with(self, extra_roles=(), pub_state_id=None):
+        """The permissions given by our roles and some extra roles,
+        such as ownership or roles local to an instance."""
+        roles = self.roles.union(extra_roles)
+        permissions = self.acl.permissions_for(roles)
+        if pub_state_id:
+            permissions |= self.acl.state_permissions_for(pub_state_id, roles)
+        return permissions
+
+
+class PermissionResolver(object):
+    """Resolve the roles and permissions of a user in a discussion.
+
+    Results are memoized on the current request, and shared across
+    requests in the ``permissions`` dogpile region when a dogpile backend
+    is configured. Shared entries are keyed on a generation token per user
+    and per discussion, which is renewed after a commit that changes the
+    user's roles or the discussion's permissions. Until then, the region
+    is bypassed for users and discussions changed in the transaction."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def region(self):
+        return shared_region('permissions')
+
+    @staticmethod
+    def request_memo(request=None):
+        from pyramid.threadlocal import get_current_request
+        request = request or get_current_request()
+        if request is None:
+            return None
+        memo = getattr(request, '_permission_memo', None)
+        if memo is None:
+            memo = request._permission_memo = {}
+        return memo
+
+    @staticmethod
+    def pending_changes():
+        """The user and discussion ids whose roles or permissions were
+        changed in the current transaction, not yet committed."""
+        session = get_session_maker()()
+        return session.info.get('permission_changes', ((), ()))
+
+    def _cached(self, key, generations, creator, pending=False):
+        region = self.region
+        if pending or not region:
+            # No backend, or uncommitted changes in this transaction
+            self.misses += 1
+            return creator()
+        key = generational_key(region, key, generations)
+        value = region.get(key)
+        if value:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = creator()
+        region.set(key, value)
+        return value
+
+    def discussion_acl(self, discussion_id, request=None):
+        memo = self.request_memo(request)
+        key = 'acl:%s' % (discussion_id,)
+        if memo is not None and key in memo:
+            self.hits += 1
+            return memo[key]
+        acl = self._cached(
+            key, ['discussion:%s' % (discussion_id,)],
+            lambda: DiscussionAcl.load(discussion_id),
+            discussion_id in self.pending_changes()[1])
+        if memo is not None:
+            memo[key] = acl
+        return acl
+
+    def user_roles(self, user_id, discussion_id, request=None):
+        user_id = user_id or Everyone
+        if user_id == Everyone:
+            return frozenset((Everyone,))
+        elif user_id == Authenticated:
+            return frozenset((Authenticated, Everyone))
+        memo = self.request_memo(request)
+        key = 'roles:%s:%s' % (user_id, discussion_id)
+        if memo is not None and key in memo:
+            self.hits += 1
+            return memo[key]
+        roles = self._cached(
+            key, ['user:%s' % (user_id,)],
+            lambda: frozenset(get_roles(user_id, discussion_id)),
+            user_id in self.pending_changes()[0])
+        if memo is not None:
+            memo[key] = roles
+        return roles
+
+    def get(self, user_id, discussion_id, request=None):
+        """The :py:class:`UserPermissions` of a user in a discussion"""
+        user_id = user_id or Everyone
+        memo = self.request_memo(request)
+        key = 'perms:%s:%s' % (user_id, discussion_id)
+        if memo is not None and key in memo:
+            self.hits += 1
+            return memo[key]
+        permissions = UserPermissions(
+            self.user_roles(user_id, discussion_id, request),
+            self.discussion_acl(discussion_id, request))
+        if memo is not None:
+            memo[key] = permissions
+        return permissions
+
+    def invalidate(self, user_ids=(), discussion_ids=()):
+        memo = self.request_memo()
+        if memo:
+            memo.clear()
+        region = self.region
+        if not region:
+            return
+        for user_id in user_ids:
+            renew_generation(region, 'user:%s' % (user_id,))
+        for discussion_id in discussion_ids:
+            renew_generation(region, 'discussion:%s' % (discussion_id,))
+
+
+permission_resolver = PermissionResolver()
+
+
+def target_roles(user_id, target_instance):
+    """The roles that a user has on a specific instance:
+    ownership, and roles local to that instance."""
+    user_id = user_id or Everyone
+    if user_id in (Everyone, Authenticated):
+        return []
+    roles = []
+    if target_instance.is_owner(user_id):
+        roles.append(R_OWNER)
+    if hasattr(target_instance, 'local_user_roles'):
+        session = get_session_maker()()
+        target_cls = target_instance.__class__.__mapper__.relationships['local_user_roles'].argument.class_
+        roles.extend(name for (name,) in target_cls.filter_on_instance(
+            target_instance, session.query(Role.name).join(target_cls).filter(
+                target_cls.profile_id == user_id)))
+    return roles
+
+
+def _record_permission_change(session, user_id=None, discussion_id=None):
+    user_ids, discussion_ids = session.info.setdefault(
+        'permission_changes', (set(), set()))
+    if user_id:
+        user_ids.add(user_id)
+    if discussion_id:
+        discussion_ids.add(discussion_id)
+    # Do not serve stale permissions for the rest of this request
+    memo = PermissionResolver.request_memo()
+    if memo:
+        memo.clear()
+
+
+def _role_changed(mapper, connection, target):
+    _record_permission_change(
+        object_session(target), user_id=target.profile_id)
+
+
+def _permission_changed(mapper, connection, target):
+    _record_permission_change(
+        object_session(target), discussion_id=target.discussion_id)
+
+
+for cls, listener in ((UserRole, _role_changed),
+                      (LocalUserRole, _role_changed),
+                      (DiscussionPermission, _permission_changed),
+                      (StateDiscussionPermission, _permission_changed)):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(cls, event_name, listener)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_permissions(session):
+    changes = session.info.pop('permission_changes', None)
+    if changes:
+        permission_resolver.invalidate(*changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_permission_changes(session):
+    session.info.pop('permission_changes', None)
+
+
 def get_permissions(user_id, discussion_id, target_instance=None):
     user_id = user_id or Everyone
-    session = get_session_maker()()
-    is_sysadmin = user_id != Everyone and session.query(UserRole).filter_by(profile_id=user_id
-        ).join(Role).filter_by(name=R_SYSADMIN).count()
-    if is_sysadmin:
+    resolved = permission_resolver.get(user_id, discussion_id)
+    if resolved.is_sysadmin:
         return list(ASSEMBL_PERMISSIONS)
     if not discussion_id:
         return []
-    roles = get_role_query(user_id, discussion_id, target_instance).with_entities(Role.id)
-
-    rp_query = session.query(
-            DiscussionPermission.role_id.label('role_id'),
-            DiscussionPermission.permission_id.label('permission_id')).filter(
-        DiscussionPermission.discussion_id == discussion_id)
-    if target_instance and hasattr(target_instance, 'pub_state_id'):
-        rp_query = rp_query.union(
-            session.query(
-                StateDiscussionPermission.role_id.label('role_id'),
-                StateDiscussionPermission.permission_id.label('permission_id')).join(
-            PublicationState, PublicationState.id == StateDiscussionPermission.pub_state_id).filter(
-            PublicationState.id == target_instance.pub_state_id))
-    rp_query = rp_query.subquery()
-    permissions = session.query(Permission.name).join(
-        rp_query, rp_query.c.permission_id == Permission.id).join(
-        Role, (rp_query.c.role_id == Role.id) & Role.id.in_(roles))
-    result = [x[0] for x in permissions.distinct()]
-    return result
+    if target_instance is None:
+        return list(resolved.permissions)
+    return list(resolved.permissions_with(
+        target_roles(user_id, target_instance),
+        getattr(target_instance, 'pub_state_id', None)))
 
 
 def base_permissions_from_request(request):
@@ -145,33 +389,26 @@ def permissions_from_request(request):
 
 
 def permissions_for_states(discussion_id, user_id):
-    from ..models import Idea, StateDiscussionPermission
+    from ..models import Idea
     db = get_session_maker()()
-
-    roles = get_role_query(user_id, discussion_id).with_entities(Role.id)
+    resolved = permission_resolver.get(user_id, discussion_id)
     states = db.query(Idea.pub_state_id).filter_by(discussion_id=discussion_id).distinct()
-    states = [x[0] for x in states if x[0]]
-    sdps = db.query(StateDiscussionPermission).filter(
-        StateDiscussionPermission.discussion_id == discussion_id,
-        StateDiscussionPermission.pub_state_id.in_(states),
-        StateDiscussionPermission.role_id.in_(roles),)
     result = defaultdict(list)
-    for sdp in sdps:
-        result[sdp.publication_state_label].append(sdp.permission_name)
+    for (state_id,) in states:
+        permissions = resolved.state_permissions.get(state_id)
+        if permissions:
+            result[resolved.acl.state_labels[state_id]].extend(permissions)
     return result
 
 
 def permissions_for_state(
         discussion_id, state_id, user_id, with_ownership=False):
-    from ..models import StateDiscussionPermission
-    db = get_session_maker()()
-    roles = get_role_query(
-        user_id, discussion_id, None, with_ownership).with_entities(Role.id)
-    perms = db.query(Permission.name).join(StateDiscussionPermission).filter(
-        StateDiscussionPermission.discussion_id == discussion_id,
-        StateDiscussionPermission.pub_state_id == state_id,
-        StateDiscussionPermission.role_id.in_(roles))
-    return [p[0] for p in perms]
+    user_id = user_id or Everyone
+    resolved = permission_resolver.get(user_id, discussion_id)
+    roles = resolved.roles
+    if with_ownership and user_id not in (Everyone, Authenticated):
+        roles = roles | {R_OWNER}
+    return list(resolved.acl.state_permissions_for(state_id, roles))
 
 
 def permissions_for_states_from_req(request):
@@ -420,51 +657,9 @@ def roles_with_permissions(discussion, *permissions):
 
 
 def user_has_permission(discussion_id, user_id, permission):
-    from ..models import Discussion
     # assume all ids valid
-    user_id = user_id or Everyone
-    db = Discussion.default_db
-    if user_id == Everyone:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name == user_id).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    elif user_id == Authenticated:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    sysadmin = db.query(UserRole).filter_by(
-        profile_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-    if sysadmin:
-        return True
-    permission = db.query(DiscussionPermission).join(
-        Permission, Role, UserRole).filter(
-            DiscussionPermission.discussion_id == discussion_id).filter(
-                UserRole.profile_id == user_id).filter(
-                    Permission.name == permission
-                ).union(
-                    db.query(DiscussionPermission
-                        ).join(Permission, Role, LocalUserRole).filter(and_(
-                            # Virtuoso disregards this explicit condition
-                            DiscussionPermission.discussion_id == discussion_id,
-                            # So I have to add this one as well.
-                            LocalUserRole.discussion_id == discussion_id,
-                            LocalUserRole.profile_id == user_id,
-                            LocalUserRole.requested == False,
-                            Permission.name == permission))
-                ).union(
-                    db.query(DiscussionPermission).join(
-                            Permission, Role).filter(
-                                DiscussionPermission.discussion_id == discussion_id).filter(
-                                    Role.name.in_((Authenticated, Everyone))).filter(
-                                        Permission.name == permission)
-                ).first()
-    return permission is not None
+    resolved = permission_resolver.get(user_id, discussion_id)
+    return resolved.is_sysadmin or permission in resolved.permissions
 
 
 def users_with_permission(discussion_id, permission, id_only=True):
@@ -0,0 +1,141 @@
+"""A compact set of integer ids, stored as runs of consecutive ids."""
+from builtins import object
+from bisect import bisect_right
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varints(data):
+    n = shift = 0
+    for byte in bytearray(data):
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield n
+            n = shift = 0
+
+
+class IdBitmap(object):
+    """A set of non-negative integers, as sorted runs of consecutive ids.
+
+    Suited to ids that come in runs, like the ids of the posts of a
+    discussion read by a user: their size depends on the number of runs,
+    not on the span of the ids, so the ids of other discussions in
+    between cost nothing. Serialized as varints, alternating the gap
+    since the end of the previous run (or since ``base``, the first id)
+    and the length of the run."""
+
+    def __init__(self, ids=()):
+        # Run i covers starts[i] <= id < ends[i]; runs never touch
+        self.starts = []
+        self.ends = []
+        if ids:
+            self.update(ids)
+
+    @property
+    def base(self):
+        return self.starts[0] if self.starts else 0
+
+    @classmethod
+    def from_bytes(cls, base, data):
+        bitmap = cls()
+        values = _read_varints(data or b'')
+        end = base
+        for gap in values:
+            start = end + gap
+            end = start + next(values)
+            bitmap.starts.append(start)
+            bitmap.ends.append(end)
+        return bitmap
+
+    def to_bytes(self):
+        out = bytearray()
+        end = self.base
+        for start, next_end in zip(self.starts, self.ends):
+            _write_varint(out, start - end)
+            _write_varint(out, next_end - start)
+            end = next_end
+        return bytes(out)
+
+    def add(self, id):
+        starts, ends = self.starts, self.ends
+        i = bisect_right(starts, id)
+        if i and id < ends[i - 1]:
+            return
+        if i and ends[i - 1] == id:
+            ends[i - 1] = id + 1
+            if i < len(starts) and starts[i] == id + 1:
+                # Join the next run
+                ends[i - 1] = ends[i]
+                del starts[i]
+                del ends[i]
+        elif i < len(starts) and starts[i] == id + 1:
+            starts[i] = id
+        else:
+            starts.insert(i, id)
+            ends.insert(i, id + 1)
+
+    def discard(self, id):
+        starts, ends = self.starts, self.ends
+        i = bisect_right(starts, id) - 1
+        if i < 0 or id >= ends[i]:
+            return
+        start, end = starts[i], ends[i]
+        if start == id and end == id + 1:
+            del starts[i]
+            del ends[i]
+        elif start == id:
+            starts[i] = id + 1
+        elif end == id + 1:
+            ends[i] = id
+        else:
+            # Split the run
+            ends[i] = id
+            starts.insert(i + 1, id + 1)
+            ends.insert(i + 1, end)
+
+    def update(self, ids):
+        # In order, most ids extend the last run
+        for id in sorted(set(ids)):
+            self.add(id)
+
+    def difference_update(self, ids):
+        for id in ids:
+            self.discard(id)
+
+    def __contains__(self, id):
+        i = bisect_right(self.starts, id) - 1
+        return i >= 0 and id < self.ends[i]
+
+    def __len__(self):
+        return sum(self.ends) - sum(self.starts)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            for id in range(start, end):
+                yield id
+
+    def __eq__(self, other):
+        if isinstance(other, IdBitmap):
+            return self.starts == other.starts and self.ends == other.ends
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "<IdBitmap %d ids in %d runs>" % (len(self), len(self.starts))
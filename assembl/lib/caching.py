@@ -0,0 +1,97 @@
+"""Caches shared by the processes of a server, through dogpile.
+
+Values are keyed on generation tokens, which are renewed when the data
+they were computed from changes; stale entries are then never read
+again and simply expire."""
+from os.path import join, dirname
+from hashlib import md5
+from uuid import uuid4
+
+from .config import get_config
+
+_regions = {}
+
+
+def shared_region(name):
+    """The dogpile region of that name, configured from the
+    ``dogpile_cache`` settings, or None if there is no backend."""
+    if name not in _regions:
+        config = get_config()
+        backend = config.get('dogpile_cache.backend')
+        region = None
+        if backend:
+            from pyramid_dogpile_cache import get_region
+            fname = join(
+                dirname(dirname(dirname(__file__))),
+                config.get('dogpile_cache.arguments.filename'))
+            region = get_region(name, **{
+                "backend": backend,
+                "expiration_time": config.get(
+                    'dogpile_cache.expiration_time', 3600),
+                "arguments.filename": fname})
+        _regions[name] = region
+    return _regions[name]
+
+
+def get_generation(region, key):
+    "The current generation token for key, created if needed."
+    token = region.get('gen:' + key, expiration_time=-1)
+    if not token:
+        token = uuid4().hex
+        region.set('gen:' + key, token)
+    return token
+
+
+def renew_generation(region, key):
+    """Make the values cached under the current token unreachable.
+
+    The token is dropped, and a new one is created when next needed;
+    renewing a token that nobody has read since does not write to the
+    backend."""
+    if region and region.get('gen:' + key, expiration_time=-1):
+        region.delete('gen:' + key)
+
+
+def generational_key(region, key, generations):
+    return ':'.join([key] + [
+        get_generation(region, generation) for generation in generations])
+
+
+def weak_etag(*parts):
+    "A weak ETag for content determined by those parts."
+    digest = md5()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        digest.update(part)
+        digest.update(b'\0')
+    return 'W/"%s"' % (digest.hexdigest(),)
+
+
+def changes_generations(discussion_id=None, global_changes=False):
+    """Generations renewed whenever the change stream has changes for
+    that discussion and, with global_changes or without a discussion,
+    changes outside of any discussion, mostly to users and agent profiles.
+    Tokens are kept in the ``changes`` region."""
+    generations = []
+    if discussion_id:
+        generations.append('changes:discussion:%s' % (discussion_id,))
+    if global_changes or not discussion_id:
+        generations.append('changes:*')
+    return generations
+
+
+def renew_changes_generations(discussion_ids):
+    """Invalidate what was cached on the changes generations of those
+    discussions, once changes were sent for them. ``*`` stands for
+    changes outside of any discussion, and only invalidates what was
+    cached with ``global_changes``."""
+    region = shared_region('changes')
+    if not region:
+        return
+    for discussion_id in discussion_ids:
+        if discussion_id == '*':
+            renew_generation(region, 'changes:*')
+        else:
+            renew_generation(
+                region, 'changes:discussion:%s' % (discussion_id,))
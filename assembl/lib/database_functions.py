@@ -9,31 +9,7 @@ from .config import get
 from .sqla import mark_changed
 
 
-postgres_functions = {
-    "idea_content_links_above_post": """
-CREATE OR REPLACE FUNCTION idea_content_links_above_post(IN root_id integer)
-        RETURNS varchar AS $$
-DECLARE
-    posts varchar;
-    posts_a integer[];
-    icl_a integer[];
-    agg varchar;
-BEGIN
-    SELECT post.ancestry || cast (post.id as VARCHAR) FROM post
-        WHERE post.id = root_id INTO posts;
-    IF posts IS NULL THEN
-        RETURN '';
-    END IF;
-    SELECT string_to_array(posts, ',') INTO posts_a;
-    SELECT array (
-        SELECT idea_content_link.id FROM unnest(posts_a) post_id
-        JOIN idea_content_link ON content_id = cast (post_id AS INTEGER)
-    ) INTO icl_a;
-    agg := array_to_string(icl_a, ',');
-    RETURN agg;
-END;
-$$ LANGUAGE plpgsql;"""
-}
+postgres_functions = {}
 
 
 class FunctionManager(object):
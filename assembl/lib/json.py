@@ -2,9 +2,14 @@
 
 from __future__ import absolute_import
 
+import logging
 from datetime import date, datetime
+
 from simplejson import dumps, JSONEncoder
+from pyramid.threadlocal import manager as threadlocal_manager
+import transaction
 
+log = logging.getLogger(__name__)
 
 class DateJSONEncoder(JSONEncoder):
     """A JSONEncoder that can encode datetime objects using iso8601"""
@@ -18,8 +23,89 @@ class DateJSONEncoder(JSONEncoder):
             return super(DateJSONEncoder, self).default(obj)
 
 
+class JSONStream(object):
+    """A JSON array that the json renderer will serialize incrementally,
+    so the response is sent as the items are produced.
+
+    The status and headers are sent before the first item, so an error
+    while producing the items cannot turn into an error response. It is
+    logged, the transaction is aborted, and the array (and object, if
+    any) is closed, so the body is still valid JSON. With a key, the
+    object then has an ``"error"`` key instead of the extra keys;
+    without one, the array is simply shorter.
+
+    :param items: an iterable of JSON-serializable values. None values
+        are skipped.
+    :param key: if given, the array will be the value of that key in a
+        JSON object, rather than the whole response.
+    :param extra: a callable returning a dict of the other keys of that
+        object. It is called after all items have been consumed.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, items, key=None, extra=None):
+        self.items = items
+        self.key = key
+        self.extra = extra
+        self.failed = False
+
+    def iter_chunks(self):
+        if self.key is not None:
+            yield '{%s: [' % (dumps(self.key),)
+        else:
+            yield '['
+        first = True
+        try:
+            for item in self.items:
+                if item is None:
+                    continue
+                item = dumps(item, cls=DateJSONEncoder)
+                yield item if first else ', ' + item
+                first = False
+        except Exception:
+            log.exception("Error while streaming JSON, closing it early")
+            self.failed = True
+        yield ']'
+        if self.key is not None:
+            if self.failed:
+                yield ', "error": "Incomplete response"'
+            else:
+                extra = self.extra() if self.extra else {}
+                for k, v in extra.items():
+                    yield ', %s: %s' % (
+                        dumps(k), dumps(v, cls=DateJSONEncoder))
+            yield '}'
+
+    def app_iter(self, request):
+        """Iterate on utf-8 encoded chunks of the serialization.
+
+        This is consumed after the view's transaction has been committed,
+        so we use our own, with the request's threadlocals."""
+        threadlocal_manager.push({
+            'request': request, 'registry': request.registry})
+        try:
+            with transaction.manager:
+                buffer = []
+                size = 0
+                for chunk in self.iter_chunks():
+                    buffer.append(chunk)
+                    size += len(chunk)
+                    if size >= self.chunk_size:
+                        yield ''.join(buffer).encode('utf-8')
+                        buffer = []
+                        size = 0
+                if buffer:
+                    yield ''.join(buffer).encode('utf-8')
+                if self.failed:
+                    transaction.abort()
+        finally:
+            threadlocal_manager.pop()
+
+
 def json_renderer_factory(info):
-    """ Same factory from pyramid.renderers, but with a custom encoder. """
+    """ Same factory from pyramid.renderers, but with a custom encoder.
+    Also renders a :py:class:`JSONStream` as an iterable response body. """
     def _render(value, system):
         request = system.get('request')
         if request is not None:
@@ -27,5 +113,7 @@ def json_renderer_factory(info):
             ct = response.content_type
             if ct == response.default_content_type:
                 response.content_type = 'application/json'
+            if isinstance(value, JSONStream):
+                return value.app_iter(request)
         return dumps(value, cls=DateJSONEncoder)
     return _render
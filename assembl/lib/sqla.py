@@ -29,15 +29,16 @@ from enum import Enum
 from anyjson import dumps, loads
 from sqlalchemy import (
     DateTime, MetaData, engine_from_config, event, Column, Integer,
-    inspect, or_, and_)
+    inspect, or_, and_, tuple_, literal)
 from sqlalchemy.exc import NoInspectionAvailable, OperationalError
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.associationproxy import (
     AssociationProxy, ObjectAssociationProxyInstance)
-from sqlalchemy.orm import scoped_session, sessionmaker, aliased
+from sqlalchemy.orm import (
+    scoped_session, sessionmaker, aliased, selectinload)
 from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY, MANYTOMANY
 from sqlalchemy.orm.properties import RelationshipProperty
-from sqlalchemy.orm.util import has_identity
+from sqlalchemy.orm.util import has_identity, AliasedClass
 from sqlalchemy.util import classproperty
 from sqlalchemy.orm.session import object_session, Session
 from sqlalchemy.engine import strategies
@@ -46,11 +47,12 @@ from sqlalchemy.engine.url import URL
 from zope.sqlalchemy import register
 from zope.sqlalchemy.datamanager import mark_changed as z_mark_changed
 from pyramid.httpexceptions import HTTPUnauthorized, HTTPBadRequest
+from pyramid.settings import asbool
 import transaction
 
 from .parsedatetime import parse_datetime
 from ..view_def import get_view_def
-from .zmqlib import get_pub_socket, send_changes
+from .zmqlib import get_pub_socket, send_changes, queue_changes
 from ..semantic.namespaces import QUADNAMES
 from .config import CascadingSettings
 from ..auth import (
@@ -59,6 +61,7 @@ from ..auth import (
 from .decl_enums import EnumSymbol, DeclEnumType
 from .utils import get_global_base_url
 from .config import get_config
+from .caching import renew_changes_generations
 from . import logging
 from .read_write_session import ReadWriteSession
 
@@ -135,6 +138,90 @@ def uses_list(prop):
         return subprop.uselist
 
 
+def yield_in_batches(
+        query, keyset_columns, batch_size=500, on_batch=None,
+        descending=False):
+    """Iterate on the results of a query, loading them by batches.
+
+    This plays the role of :py:meth:`Query.yield_per`, but is compatible
+    with eager loading: each batch is loaded with its own keyset query
+    (``WHERE (keys) > :last ORDER BY keys LIMIT n``), so the first batch
+    comes as fast whatever the number of results, and memory use does
+    not grow with it since the identity map is weak.
+    The keyset columns replace the query's ordering. They must define a
+    total order, so the last one should be the primary key; a single
+    column is accepted too.
+    If given, on_batch is called with the results of each batch before
+    they are yielded."""
+    if not isinstance(keyset_columns, (list, tuple)):
+        keyset_columns = [keyset_columns]
+    num_keys = len(keyset_columns)
+    descriptions = query.column_descriptions
+    single_entity = len(descriptions) == 1 and isinstance(
+        descriptions[0]['expr'], (type, AliasedClass))
+    ordering = [c.desc() if descending else c for c in keyset_columns]
+    query = query.order_by(None).order_by(*ordering).add_columns(
+        *keyset_columns).limit(batch_size)
+    last = None
+    while True:
+        batch = query
+        if last is not None:
+            keys = tuple_(*keyset_columns)
+            values = tuple_(*[
+                literal(v, col.type) for (col, v)
+                in zip(keyset_columns, last)])
+            batch = batch.filter(
+                keys < values if descending else keys > values)
+        rows = batch.all()
+        if not rows:
+            return
+        last = rows[-1][-num_keys:]
+        if single_entity:
+            results = [row[0] for row in rows]
+        else:
+            results = [tuple(row[:-num_keys]) for row in rows]
+        if on_batch is not None:
+            on_batch(results)
+        for result in results:
+            yield result
+        if len(rows) < batch_size:
+            return
+
+
+def _translate_to_json(v, view_name, user_id, permissions, base_uri):
+    """Translate a value to JSON for :py:meth:`BaseOps.generic_json`.
+    Base objects are given as a uri, or as JSON if a view_name is given."""
+    if isinstance(v, Base):
+        p = getattr(v, 'user_can', None)
+        if p and not v.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            return None
+        if view_name:
+            return v.generic_json(
+                view_name, user_id, permissions, base_uri)
+        else:
+            return v.uri(base_uri)
+    elif isinstance(v, (
+            string_types, int, long, float, bool, type(None))):
+        return v
+    elif isinstance(v, EnumSymbol):
+        return v.name
+    elif isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    elif isinstance(v, dict):
+        v = {_translate_to_json(k, view_name, user_id, permissions, base_uri):
+             _translate_to_json(val, view_name, user_id, permissions, base_uri)
+             for k, val in v.items()}
+        return {k: val for (k, val) in v.items()
+                if val is not None}
+    elif isinstance(v, Iterable):
+        v = [_translate_to_json(i, view_name, user_id, permissions, base_uri)
+             for i in v]
+        return [x for x in v if x is not None]
+    else:
+        raise NotImplementedError("Cannot translate", v)
+
+
 class TableLockCreationThread(Thread):
     """Utility class to create objects as a side effect.
     Will use an exclusive table lock to ensure that the objects
@@ -819,21 +906,35 @@ class BaseOps(object):
         if record:
             return record.source.name
 
-    def generic_json(
-            self, view_def_name='default', user_id=None,
-            permissions=(P_READ, P_READ_IDEA), base_uri='local:'):
-        """Return a representation of this object as a JSON object,
-        according to the given view_def and access control."""
-        user_id = user_id or Everyone
-        if not self.user_can(user_id, CrudPermissions.READ, permissions):
-            return None
-        view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
+    _json_serializers = {}
+
+    @classmethod
+    def get_json_serializer(cls, view_def_name='default'):
+        """Return the function that serializes instances of this class
+        according to the given view_def, compiling it on first use.
+
+        The serializer is a function of (instance, user_id, permissions,
+        base_uri), which does not check read access on the instance itself.
+        It is None if the view_def does not represent this class."""
+        view_def = get_view_def(view_def_name)
+        key = (cls, view_def_name)
+        cached = cls._json_serializers.get(key, None)
+        # view_defs may be reloaded in development
+        if cached is None or cached[0] is not view_def:
+            cached = (view_def, cls.compile_json_serializer(
+                view_def_name, view_def))
+            cls._json_serializers[key] = cached
+        return cached[1]
+
+    @classmethod
+    def compile_json_serializer(cls, view_def_name, view_def):
+        """Interpret the view_def for this class once, and return
+        a serializer function. See :py:meth:`get_json_serializer`."""
+        my_typename = cls.external_typename()
+        local_view = cls.expand_view_def(view_def)
         if not local_view:
             return None
-        mapper = self.__class__.__mapper__
+        mapper = cls.__mapper__
         relns = {r.key: r for r in mapper.relationships}
         cols = {c.key: c for c in mapper.columns}
         fkeys = {c for c in mapper.columns if c.foreign_keys}
@@ -843,19 +944,139 @@ class BaseOps(object):
         }
         fkey_of_reln = {r.key: r._calculated_foreign_keys
                         for r in mapper.relationships}
-        methods = self.__class__.get_single_arg_methods()
-        properties = self.__class__.get_props_of()
+        methods = cls.get_single_arg_methods()
+        properties = cls.get_props_of()
         known = set()
-        for name, spec in local_view.items():
-            vals = None
-            if name == "_default":
-                continue
-            if name == "@update":
+        handlers = []
+        # relations that the serializer will load, with their view_def
+        loaded_relations = []
+
+        def update_handler(spec):
+            def handler(self, result, user_id, permissions, base_uri):
                 update_dict = getattr(self, spec)
                 if pyinspect.ismethod(update_dict):
                     update_dict = update_dict()
                 assert isinstance(update_dict, dict)
                 result.update(update_dict)
+            return handler
+
+        def constant_handler(name, value):
+            def handler(self, result, user_id, permissions, base_uri):
+                result[name] = value
+            return handler
+
+        def self_handler(name, view_name):
+            def handler(self, result, user_id, permissions, base_uri):
+                if view_name:
+                    r = self.generic_json(
+                        view_name, user_id, permissions, base_uri)
+                    if r is not None:
+                        result[name] = r
+                else:
+                    result[name] = self.uri()
+            return handler
+
+        def method_handler(name, prop_name, view_name):
+            def handler(self, result, user_id, permissions, base_uri):
+                # Function call. PLEASE RETURN JSON, Base objects,
+                # or list or dicts thereof
+                val = getattr(self, prop_name)()
+                result[name] = _translate_to_json(
+                    val, view_name, user_id, permissions, base_uri)
+            return handler
+
+        def value_handler(name, prop_name, view_name):
+            def handler(self, result, user_id, permissions, base_uri):
+                val = getattr(self, prop_name)
+                if val is not None:
+                    val = _translate_to_json(
+                        val, view_name, user_id, permissions, base_uri)
+                if val is not None:
+                    result[name] = val
+            return handler
+
+        def fkey_handler(name, target_cls, fkey_name):
+            def handler(self, result, user_id, permissions, base_uri):
+                result[name] = target_cls.uri_generic(
+                    getattr(self, fkey_name))
+            return handler
+
+        def list_handler(name, prop_name, spec, view_name):
+            def handler(self, result, user_id, permissions, base_uri):
+                vals = getattr(self, prop_name)
+                if vals is None:
+                    return single_handler(
+                        self, result, user_id, permissions, base_uri)
+                if view_name:
+                    if isinstance(spec, dict):
+                        result[name] = {
+                            ob.uri(base_uri):
+                            ob.generic_json(
+                                view_name, user_id, permissions, base_uri)
+                            for ob in vals
+                            if ob.user_can(
+                                user_id, CrudPermissions.READ, permissions)}
+                    else:
+                        result[name] = [
+                            ob.generic_json(
+                                view_name, user_id, permissions, base_uri)
+                            for ob in vals
+                            if ob.user_can(
+                                user_id, CrudPermissions.READ, permissions)]
+                else:
+                    assert not isinstance(spec, dict),\
+                        "in viewdef %s, class %s, dict without viewname for %s" % (
+                            view_def_name, my_typename, name)
+                    result[name] = [
+                        ob.uri(base_uri) for ob in vals
+                        if ob.user_can(
+                            user_id, CrudPermissions.READ, permissions)]
+            single_handler = reln_handler(name, prop_name, spec, view_name)
+            return handler
+
+        def reln_handler(name, prop_name, spec, view_name):
+            reln = relns.get(prop_name, None)
+            as_list = isinstance(spec, list)
+
+            def handler(self, result, user_id, permissions, base_uri):
+                assert not isinstance(spec, dict),\
+                    "in viewdef %s, class %s, dict for non-list relation %s" % (
+                        view_def_name, my_typename, prop_name)
+                if view_name:
+                    ob = getattr(self, prop_name)
+                    if ob and ob.user_can(
+                            user_id, CrudPermissions.READ, permissions):
+                        val = ob.generic_json(
+                            view_name, user_id, permissions, base_uri)
+                        if val is not None:
+                            result[name] = [val] if as_list else val
+                    else:
+                        result[name] = [] if as_list else None
+                    return
+                uri = None
+                if len(reln._calculated_foreign_keys) == 1 \
+                        and reln._calculated_foreign_keys < fkeys:
+                    # shortcut, avoid fetch
+                    fkey = list(reln._calculated_foreign_keys)[0]
+                    ob_id = getattr(self, fkey.name)
+                    if ob_id:
+                        uri = reln.mapper.class_.uri_generic(
+                            ob_id, base_uri)
+                else:
+                    ob = getattr(self, prop_name)
+                    if ob:
+                        uri = ob.uri(base_uri)
+                if uri:
+                    result[name] = [uri] if as_list else uri
+                else:
+                    result[name] = [] if as_list else None
+            return handler
+
+        for name, spec in local_view.items():
+            if name == "_default":
+                continue
+            if name == "@update":
+                handlers.append(update_handler(spec))
                 continue
             elif spec is False:
                 known.add(name)
@@ -886,7 +1107,7 @@ class BaseOps(object):
                         view_def_name, my_typename, name)
                 if subspec[0] == "'":
                     # literals.
-                    result[name] = loads(subspec[1:])
+                    handlers.append(constant_handler(name, loads(subspec[1:])))
                     continue
                 if ':' in subspec:
                     prop_name, view_name = subspec.split(':', 1)
@@ -901,59 +1122,17 @@ class BaseOps(object):
                 assert get_view_def(view_name),\
                     "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
                         view_def_name, my_typename, name, view_name)
-            #print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        string_types, int, long, float, bool, type(None))):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
 
             if prop_name == 'self':
-                if view_name:
-                    r = self.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if r is not None:
-                        result[name] = r
-                else:
-                    result[name] = self.uri()
-                continue
+                handlers.append(self_handler(name, view_name))
             elif prop_name == '@view':
-                result[name] = view_def_name
-                continue
+                handlers.append(constant_handler(name, view_def_name))
             elif prop_name[0] == '&':
                 prop_name = prop_name[1:]
                 assert prop_name in methods,\
                     "in viewdef %s, class %s, name %s, unknown method %s" % (
                         view_def_name, my_typename, name, prop_name)
-                # Function call. PLEASE RETURN JSON, Base objects,
-                # or list or dicts thereof
-                val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
-                continue
+                handlers.append(method_handler(name, prop_name, view_name))
             elif prop_name in cols:
                 assert not view_name,\
                     "in viewdef %s, class %s, viewdef for literal property %s" % (
@@ -965,32 +1144,24 @@ class BaseOps(object):
                     "in viewdef %s, class %s, dict for literal property %s" % (
                         view_def_name, my_typename, prop_name)
                 known.add(prop_name)
-                val = getattr(self, prop_name)
-                if val is not None:
-                    val = translate_to_json(val)
-                if val is not None:
-                    result[name] = val
-                continue
+                handlers.append(value_handler(name, prop_name, view_name))
             elif prop_name in properties:
                 known.add(prop_name)
                 if view_name or (prop_name not in fkey_of_reln) or (
                         relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
+                    handlers.append(value_handler(name, prop_name, view_name))
+                    if prop_name in relns:
+                        loaded_relations.append((prop_name, view_name))
                 else:
-                    fkeys = list(fkey_of_reln[prop_name])
-                    assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
-
-                continue
-            elif isinstance(getattr(self.__class__, prop_name, None),
+                    reln_fkeys = list(fkey_of_reln[prop_name])
+                    assert(len(reln_fkeys) == 1)
+                    handlers.append(fkey_handler(
+                        name, relns[prop_name].mapper.class_,
+                        reln_fkeys[0].key))
+            elif isinstance(getattr(cls, prop_name, None),
                     (AssociationProxy, ObjectAssociationProxyInstance)):
-                vals = getattr(self, prop_name)
+                known.add(prop_name)
+                handlers.append(list_handler(name, prop_name, spec, view_name))
             else:
                 assert prop_name in relns,\
                         "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
@@ -999,103 +1170,129 @@ class BaseOps(object):
                 # Add derived prop?
                 reln = relns[prop_name]
                 if reln.uselist:
-                    vals = getattr(self, prop_name)
-            if vals is not None:
-                known.add(prop_name)
-                if view_name:
-                    if isinstance(spec, dict):
-                        result[name] = {
-                            ob.uri(base_uri):
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)}
-                    else:
-                        result[name] = [
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)]
-                else:
-                    assert not isinstance(spec, dict),\
-                        "in viewdef %s, class %s, dict without viewname for %s" % (
-                            view_def_name, my_typename, name)
-                    result[name] = [
-                        ob.uri(base_uri) for ob in vals
-                        if ob.user_can(
-                            user_id, CrudPermissions.READ, permissions)]
-                continue
-            assert not isinstance(spec, dict),\
-                "in viewdef %s, class %s, dict for non-list relation %s" % (
-                    view_def_name, my_typename, prop_name)
-            if view_name:
-                ob = getattr(self, prop_name)
-                if ob and ob.user_can(
-                        user_id, CrudPermissions.READ, permissions):
-                    val = ob.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
-            else:
-                uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
-                    # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
-                    if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
+                    handlers.append(list_handler(
+                        name, prop_name, spec, view_name))
+                    loaded_relations.append((prop_name, view_name))
                 else:
-                    ob = getattr(self, prop_name)
-                    if ob:
-                        uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
-
+                    handlers.append(reln_handler(
+                        name, prop_name, spec, view_name))
+                    if view_name or not (
+                            len(reln._calculated_foreign_keys) == 1
+                            and reln._calculated_foreign_keys < fkeys):
+                        loaded_relations.append((prop_name, view_name))
+
+        # Unspecified columns, or relations given by a single foreign key
+        defaults = []
         if local_view.get('_default') is not False:
             for name, col in cols.items():
                 if name in known:
                     continue  # already done
                 as_rel = reln_of_fkeys.get(frozenset((col, )))
                 if as_rel:
-                    name = as_rel.key
-                    if name in known:
-                        continue
-                    else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
+                    if as_rel.key not in known:
+                        defaults.append(
+                            (as_rel.key, col.key, as_rel.mapper.class_))
                 else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
-        return result
+                    defaults.append((name, name, None))
+
+        def serializer(self, user_id, permissions, base_uri):
+            result = {}
+            for handler in handlers:
+                handler(self, result, user_id, permissions, base_uri)
+            for (name, col_name, target_cls) in defaults:
+                ob = getattr(self, col_name)
+                if not ob:
+                    result[name] = None
+                elif target_cls is not None:
+                    result[name] = target_cls.uri_generic(ob, base_uri)
+                elif type(ob) == datetime:
+                    result[name] = ob.isoformat() + "Z"
+                else:
+                    result[name] = ob
+            return result
+        serializer.loaded_relations = loaded_relations
+        return serializer
+
+    @classmethod
+    def loader_paths_for_view_def(cls, view_def_name='default', depth=2):
+        """The paths of lazy relations that the view_def will load,
+        following nested view_defs up to the given depth.
+
+        Relationships that are already eagerly loaded are not followed."""
+        serializer = cls.get_json_serializer(view_def_name)
+        if serializer is None or depth < 1:
+            return []
+        relns = cls.__mapper__.relationships
+        paths = []
+        for prop_name, view_name in serializer.loaded_relations:
+            reln = relns[prop_name]
+            if reln.lazy != 'select':
+                continue
+            attribute = getattr(cls, prop_name)
+            paths.append((attribute, ))
+            target_cls = reln.mapper.class_
+            if view_name and issubclass(target_cls, BaseOps):
+                paths.extend(
+                    (attribute, ) + path for path in
+                    target_cls.loader_paths_for_view_def(
+                        view_name, depth - 1))
+        return paths
+
+    @classmethod
+    def loader_options_for_view_def(cls, view_def_name='default', depth=2):
+        """Query options that will preload, with one query per relation,
+        the relations used by the view_def."""
+        options = []
+        for path in cls.loader_paths_for_view_def(view_def_name, depth):
+            option = selectinload(path[0])
+            for attribute in path[1:]:
+                option = option.selectinload(attribute)
+            options.append(option)
+        return options
+
+    @classmethod
+    def preload_for_view_def(
+            cls, instances, view_def_name='default', depth=2):
+        """Load the relations used by the view_def for all those instances,
+        with one query per relation and class rather than per instance."""
+        by_class = defaultdict(list)
+        for instance in instances:
+            by_class[instance.__class__].append(instance.id)
+        for sub_cls, ids in by_class.items():
+            options = sub_cls.loader_options_for_view_def(
+                view_def_name, depth)
+            if not options:
+                continue
+            # identity-mapped instances get their unloaded relations set
+            sub_cls.default_db.query(sub_cls).filter(
+                sub_cls.id.in_(ids)).options(*options).all()
+
+    @classmethod
+    def generic_json_many(
+            cls, instances, view_def_name='default', user_id=None,
+            permissions=(P_READ, P_READ_IDEA), base_uri='local:'):
+        """Return the generic_json of each instance, after preloading
+        the relations used by the view_def for all of them at once."""
+        instances = list(instances)
+        view_def_name = view_def_name or 'default'
+        if instances:
+            cls.preload_for_view_def(instances, view_def_name)
+        return [i.generic_json(view_def_name, user_id, permissions, base_uri)
+                for i in instances]
+
+    def generic_json(
+            self, view_def_name='default', user_id=None,
+            permissions=(P_READ, P_READ_IDEA), base_uri='local:'):
+        """Return a representation of this object as a JSON object,
+        according to the given view_def and access control."""
+        user_id = user_id or Everyone
+        if not self.user_can(user_id, CrudPermissions.READ, permissions):
+            return None
+        serializer = self.__class__.get_json_serializer(
+            view_def_name or 'default')
+        if serializer is None:
+            return None
+        return serializer(self, user_id, permissions, base_uri)
 
     def locked_object_creation(
             self, object_generator, lock_table_cls=None, num_attempts=3):
@@ -2243,43 +2440,36 @@ class BaseOps(object):
         # 4. ownership + State + StateDiscussionPermission
         # 5. LocalUserRole + DiscussionPermission (factorable)
         # 6. LocalUserRole + State + StateDiscussionPermission
-        from ..models.permissions import DiscussionPermission, Permission, Role
-        from ..models.publication_states import PublicationState, StateDiscussionPermission
-        session = self.db
+        # Roles and permissions come from the permission resolver,
+        # only the roles local to this instance are queried here.
+        from ..auth.util import permission_resolver
+        from ..models.permissions import Role
         if not discussion:
             return []
-        roles = self.get_role_query(user_id, discussion.id
-            ).with_entities(Role.id).subquery()
-        queries = []
+        user_id = user_id or Everyone
+        resolved = permission_resolver.get(user_id, discussion.id)
+        local_roles = []
+        if user_id not in (Everyone, Authenticated):
+            (local_role_class, fkey) = self.local_role_class_and_fkey()
+            if local_role_class:
+                local_roles = [x for (x,) in self.db.query(Role.name).join(
+                    local_role_class).filter(
+                    getattr(local_role_class, fkey)==self.id,
+                    local_role_class.profile_id==user_id)]
+        is_owner = self.is_owner(user_id)
+        if is_owner:
+            local_roles.append(R_OWNER)
+        roles = resolved.roles.union(local_roles)
+        permissions = set()
         if include_global:
-            queries.append(
-                session.query(Permission.name).join(
-                    DiscussionPermission
-                ).join(Role
-                ).filter(Role.id.in_(roles)))
-        elif self.is_owner(user_id):
-            queries.append(
-                session.query(Permission.name).join(
-                    DiscussionPermission
-                ).join(Role
-                ).filter(Role.name == R_OWNER))
+            permissions.update(resolved.acl.permissions_for(roles))
+        elif is_owner:
+            permissions.update(resolved.acl.permissions_for((R_OWNER,)))
         pub_state_id = getattr(self, 'pub_state_id', None)
         if pub_state_id:
-            queries.append(
-                session.query(Permission.name).join(
-                    StateDiscussionPermission,
-                    (Permission.id==StateDiscussionPermission.permission_id) &
-                    (StateDiscussionPermission.pub_state_id==pub_state_id) &
-                    (StateDiscussionPermission.discussion_id==discussion.id) &
-                    StateDiscussionPermission.role_id.in_(roles)
-                )
-            )
-        if not len(queries):
-            return []
-        query = queries.pop(0)
-        if queries:
-            query = query.union(*queries)
-        return [x for (x,) in query.distinct()]
+            permissions.update(
+                resolved.acl.state_permissions_for(pub_state_id, roles))
+        return list(permissions)
 
     def local_permissions_req(self, request=None, include_global=False):
         # TODO: Cache in request
@@ -2391,7 +2581,25 @@ class PrivateObjectMixin(object):
         return ""
 
 
-class Tombstone(object):
+class SerializedChange(object):
+    """A change whose json is complete when it is recorded, like a
+    :py:class:`Tombstone`. It is sent as-is on the changes websocket,
+    even with ``changes_deferred_serialization``."""
+    uri = None
+
+    def generic_json(self, *vargs, **kwargs):
+        raise NotImplementedError()
+
+    def send_to_changes(self, connection, operation=CrudOperation.UPDATE,
+                        discussion_id=None, view_def="changes"):
+        assert connection
+        if 'cdict' not in connection.info:
+            connection.info['cdict'] = {}
+        connection.info['cdict'][(self.uri, view_def)] = (
+            discussion_id, self)
+
+
+class Tombstone(SerializedChange):
     def __init__(self, ob, **kwargs):
         self.typename = ob.external_typename()
         self.uri = ob.uri()
@@ -2448,21 +2656,32 @@ def before_commit_listener(session):
     """Create the Json representation of changed objects which will be
     sent to the :py:mod:`assembl.tasks.changes_router`
 
-    We have to do this before commit, while objects are still attached."""
+    We have to do this before commit, while objects are still attached.
+    With ``changes_deferred_serialization``, only tombstones and other
+    :py:class:`SerializedChange` are serialized here; other objects are
+    recorded by type, uri and view_def, and serialized by
+    :py:func:`assembl.tasks.changes.send_deferred_changes`."""
     # If there hasn't been a flush yet, make sure any sql error occur BEFORE
     # we send changes to the socket.
     session.flush()
     info = session.connection().info
     if 'cdict' in info:
+        deferred = asbool(get_config().get(
+            'changes_deferred_serialization', False))
         changes = defaultdict(list)
         for ((uri, view_def), (discussion, target)) in \
                 info['cdict'].items():
             discussion = discussion or "*"
+            if deferred and not isinstance(target, SerializedChange):
+                changes[discussion].append(
+                    (target.external_typename(), uri, view_def))
+                continue
             json = target.generic_json(view_def)
             if json:
                 changes[discussion].append(json)
         del info['cdict']
         session.cdict2 = changes
+        session.cdict2_deferred = deferred
     else:
         log.debug("EMPTY CDICT!")
 
@@ -2473,8 +2692,16 @@ def after_commit_listener(session):
     if not getattr(session, 'zsocket', None):
         session.zsocket = get_pub_socket()
     if getattr(session, 'cdict2', None):
-        for discussion, changes in session.cdict2.items():
-            send_changes(session.zsocket, discussion, changes)
+        # Preloads and ETags are only as fresh as the change stream
+        renew_changes_generations(session.cdict2.keys())
+        if getattr(session, 'cdict2_deferred', False):
+            from ..tasks.changes import send_deferred_changes
+            for discussion, changes in session.cdict2.items():
+                send_deferred_changes.delay(discussion, changes)
+        else:
+            for discussion, changes in session.cdict2.items():
+                if not queue_changes(discussion, changes):
+                    send_changes(session.zsocket, discussion, changes)
         del session.cdict2
 
 
@@ -3,6 +3,10 @@ from builtins import next
 from builtins import str
 import atexit
 from itertools import count
+from collections import OrderedDict, defaultdict
+from threading import Thread
+from queue import Queue, Empty
+from time import monotonic
 import logging
 
 from future.utils import native_str
@@ -18,6 +22,10 @@ CHANGES_SOCKET = None
 MULTIPLEX = True
 INITED = False
 DISPATCHER = None
+# Changes sent within that many seconds are merged. 0 to disable.
+COALESCE_WINDOW = 0
+COALESCE_MAX_BATCH = 500
+_coalescer = None
 
 _counter = count()
 _active_sockets = []
@@ -72,14 +80,110 @@ def send_changes(socket, discussion, changeset):
     log.debug("sent %d %s %s " % (order, discussion, changeset))
 
 
-def configure_zmq(sockdef, multiplex):
-    global CHANGES_SOCKET, MULTIPLEX
+class ChangesCoalescer(Thread):
+    """Merges the changes sent within a short window, so that only the last
+    state of each object is sent, in one message per discussion.
+
+    The window starts with the first change after a flush. Changes are also
+    flushed once there are max_batch distinct objects waiting."""
+
+    def __init__(self, window, max_batch):
+        super(ChangesCoalescer, self).__init__(
+            name="ChangesCoalescer", daemon=True)
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = Queue()
+        self.pending = defaultdict(OrderedDict)
+        self.num_pending = 0
+        self.deadline = None
+
+    def add(self, discussion, changes):
+        """Queue changes to be sent. Can be called from any thread."""
+        self.queue.put((discussion, changes))
+
+    def stop(self):
+        self.queue.put((None, None))
+
+    def merge(self, discussion, changes):
+        if self.deadline is None:
+            self.deadline = monotonic() + self.window
+        pending = self.pending[discussion]
+        for change in changes:
+            object_id = change.get('@id', None)
+            # Changes that do not name an object are all kept
+            key = ((object_id, change.get('@view', None)) if object_id
+                   else id(change))
+            if pending.pop(key, None) is None:
+                self.num_pending += 1
+            # The latest state goes last
+            pending[key] = change
+
+    def flush(self, socket):
+        for discussion, pending in self.pending.items():
+            send_changes(socket, discussion, list(pending.values()))
+        self.pending.clear()
+        self.num_pending = 0
+        self.deadline = None
+
+    def run(self):
+        # zmq sockets belong to a thread
+        socket = get_pub_socket()
+        while True:
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(0, self.deadline - monotonic())
+            try:
+                discussion, changes = self.queue.get(timeout=timeout)
+            except Empty:
+                self.flush(socket)
+                continue
+            if changes is None:
+                self.flush(socket)
+                break
+            self.merge(discussion, changes)
+            if self.num_pending >= self.max_batch:
+                self.flush(socket)
+
+
+def queue_changes(discussion, changes):
+    """Send the changes, through the coalescer if configured."""
+    global _coalescer
+    if not COALESCE_WINDOW:
+        return False
+    if _coalescer is None:
+        _coalescer = ChangesCoalescer(COALESCE_WINDOW, COALESCE_MAX_BATCH)
+        _coalescer.start()
+    _coalescer.add(discussion, changes)
+    return True
+
+
+@atexit.register
+def stop_coalescer():
+    # registered after stop_sockets, so called before.
+    if _coalescer is not None:
+        _coalescer.stop()
+        _coalescer.join(1)
+
+
+def configure_zmq(sockdef, multiplex, coalesce_window=0,
+                  coalesce_max_batch=500):
+    global CHANGES_SOCKET, MULTIPLEX, COALESCE_WINDOW, COALESCE_MAX_BATCH
     assert isinstance(sockdef, native_str)
     CHANGES_SOCKET = sockdef
     MULTIPLEX = multiplex
+    COALESCE_WINDOW = float(coalesce_window or 0)
+    COALESCE_MAX_BATCH = int(coalesce_max_batch)
+
+
+def configure_zmq_from_settings(settings, multiplex=None):
+    """Configure the changes socket and coalescing from the settings.
+    multiplex, if given, overrides the ``changes_multiplex`` setting."""
+    if multiplex is None:
+        multiplex = settings['changes_multiplex']
+    configure_zmq(settings['changes_socket'], multiplex,
+                  settings.get('changes_coalesce_window', 0),
+                  settings.get('changes_coalesce_max_batch', 500))
 
 
 def includeme(config):
-    settings = config.registry.settings
-    configure_zmq(settings['changes_socket'],
-                  settings['changes_multiplex'])
+    configure_zmq_from_settings(config.registry.settings)
@@ -259,6 +259,7 @@ from .post import (
     IdeaProposalPost,
     ImportedPost,
     Post,
+    PostAncestorLoader,
     PublicationStates,
     WidgetPost,
     SynthesisPost,
@@ -267,6 +268,8 @@ from .mail import (
     AbstractFilesystemMailbox,
     AbstractMailbox,
     Email,
+    EmailThreadContainer,
+    EmailThreader,
     IMAPMailbox,
     MaildirMailbox,
     MailingList,
@@ -275,7 +278,9 @@ from .idea import (
     Idea,
     IdeaLink,
     RootIdea,
+    IdeaHierarchy,
     IdeaLocalUserRole,
+    IdeaPostCount,
 )
 from .action import (
     Action,
@@ -284,6 +289,7 @@ from .action import (
     CollapsePost,
     ExpandPost,
     LikedPost,
+    PostReadBitmap,
     UniqueActionOnIdea,
     UniqueActionOnPost,
     ViewIdea,
@@ -300,6 +306,8 @@ from .idea_content_link import (
     IdeaExtractLink,
     AnnotationSelector,
     TextFragmentIdentifier,
+    PostIdeaContentLink,
+    DiscussionIdeaContentLinks,
 )
 from .idea_graph_view import (
     ExplicitSubGraphView,
@@ -326,6 +334,9 @@ from .votes import (
 from .annotation import (
     Webpage,
 )
+from .path_utils import (
+    DiscussionGlobalData,
+)
 from .timeline import (
     DiscussionMilestone,
     DiscussionPhase,
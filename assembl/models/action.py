@@ -3,6 +3,7 @@
 """
 
 from datetime import datetime
+from collections import defaultdict
 
 from future.utils import as_native_str
 from sqlalchemy import (
@@ -11,20 +12,26 @@ from sqlalchemy import (
     String,
     ForeignKey,
     Integer,
+    LargeBinary,
     Unicode,
     DateTime,
     desc,
     select,
     func,
     event,
+    literal,
 )
 from sqlalchemy.inspection import inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import relationship, backref, column_property
+from sqlalchemy.orm.session import object_session
 from sqla_rdfbridge.mapping import IriClass
 
 from . import (
-    DiscussionBoundBase, DiscussionBoundTombstone, TombstonableMixin,
+    Base, DiscussionBoundBase, DiscussionBoundTombstone, TombstonableMixin,
     OriginMixin, Post)
+from ..lib.bitmap import IdBitmap
+from ..lib.sqla import get_session_maker, mark_changed, SerializedChange
 from ..semantic.namespaces import (
     ASSEMBL, QUADNAMES, VERSION, RDF, VirtRDF)
 from ..semantic.virtuoso_mapping import QuadMapPatternS
@@ -215,6 +222,68 @@ class ViewPost(UniqueActionOnPost):
 
     verb = 'viewed'
 
+    @classmethod
+    def mark_read(cls, db, user_id, discussion_id, post_ids):
+        """Create the missing views of the given posts by a user, with a
+        single INSERT ... SELECT, and send one change for all of them.
+
+        :param post_ids: a subquery with the ids of posts as first column
+        :returns: the ids of the posts that were not read yet"""
+        action = Action.__table__
+        action_on_post = ActionOnPost.__table__
+        post_id = list(post_ids.c)[0]
+        already_read = select([action_on_post.c.post_id]).select_from(
+            action_on_post.join(action, action.c.id == action_on_post.c.id)
+        ).where(
+            (action.c.type == cls.__mapper__.polymorphic_identity)
+            & (action.c.actor_id == user_id)
+            & (action.c.tombstone_date == None)
+            & (action_on_post.c.post_id == post_id))
+        new_views = select([
+            func.nextval(action.fullname + '_id_seq').label('id'),
+            post_id.label('post_id')
+        ]).where(~already_read.exists()).cte('new_views')
+        new_actions = action.insert().from_select(
+            ['id', 'type', 'actor_id', 'creation_date'],
+            select([new_views.c.id,
+                    literal(cls.__mapper__.polymorphic_identity),
+                    literal(user_id), literal(datetime.utcnow())])
+        ).returning(action.c.id).cte('new_actions')
+        read_ids = [x for (x,) in db.execute(
+            action_on_post.insert().from_select(
+                ['id', 'post_id'],
+                select([new_views.c.id, new_views.c.post_id]).select_from(
+                    new_views.join(new_actions,
+                                   new_actions.c.id == new_views.c.id))
+            ).returning(action_on_post.c.post_id))]
+        if read_ids:
+            mark_changed(db)
+            changes = db.info.setdefault('post_read_changes', {})
+            for read_id in read_ids:
+                changes[(user_id, read_id)] = True
+            ReadStatusChanges(user_id, read_ids).send_to_changes(
+                db.connection(), discussion_id=discussion_id)
+        return read_ids
+
+
+class ReadStatusChanges(SerializedChange):
+    """One change for many posts marked read at once"""
+
+    def __init__(self, user_id, post_ids):
+        self.user_id = user_id
+        self.post_ids = post_ids
+        self.uri = "%s#read_posts_%d" % (User.uri_generic(user_id), id(self))
+
+    def generic_json(self, *vargs, **kwargs):
+        user_uri = User.uri_generic(self.user_id)
+        return {
+            "@type": "ReadStatusChanges",
+            "@private": [user_uri],
+            "actor": user_uri,
+            "posts": [Content.uri_generic(post_id)
+                      for post_id in self.post_ids],
+        }
+
 
 class LikedPost(UniqueActionOnPost):
     """
@@ -382,3 +451,121 @@ class ViewIdea(ActionOnIdea):
             actor=User.uri_generic(self.actor_id))
 
     verb = 'viewed'
+
+
+class PostReadBitmap(Base):
+    """The ids of the posts of a discussion read by a user,
+    as an :py:class:`assembl.lib.bitmap.IdBitmap`.
+
+    A summary of the live :py:class:`ViewPost` of that user in that
+    discussion, stored by the first commit that changes those views and
+    kept up to date at commit. Post ids are global, but they are stored
+    as runs of consecutive ids, so the posts of other discussions in
+    between do not make the stored value grow."""
+    __tablename__ = 'post_read_bitmap'
+
+    user_id = Column(Integer, ForeignKey(
+        User.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    base_id = Column(Integer, nullable=False, default=0)
+    bits = Column(LargeBinary, nullable=False, default=b'')
+
+    @staticmethod
+    def read_post_ids_query(db, user_id, discussion_id):
+        return db.query(ViewPost.post_id).join(
+            Content, Content.id == ViewPost.post_id).filter(
+            Content.discussion_id == discussion_id,
+            ViewPost.actor_id == user_id,
+            ViewPost.tombstone_date == None)
+
+    @classmethod
+    def build_bitmap(cls, db, user_id, discussion_id):
+        "Build the bitmap from the ViewPost table"
+        return IdBitmap(
+            x for (x,) in cls.read_post_ids_query(db, user_id, discussion_id))
+
+    @classmethod
+    def get_bitmap(cls, db, user_id, discussion_id, for_update=False):
+        """The :py:class:`IdBitmap` of posts read by this user
+
+        If it is not stored yet, it is built from the ViewPost table, and
+        only stored when for_update, as by :py:func:`update_post_read_bitmaps`;
+        reading never writes."""
+        table = cls.__table__
+        query = select([table.c.base_id, table.c.bits]).where(
+            (table.c.user_id == user_id)
+            & (table.c.discussion_id == discussion_id))
+        if for_update:
+            query = query.with_for_update()
+        row = db.execute(query).first()
+        if row is None:
+            bitmap = cls.build_bitmap(db, user_id, discussion_id)
+            if not for_update:
+                return bitmap
+            db.execute(pg_insert(table).values(
+                user_id=user_id, discussion_id=discussion_id,
+                base_id=bitmap.base, bits=bitmap.to_bytes()
+            ).on_conflict_do_nothing())
+            mark_changed(db)
+            # Another transaction may have stored it first; lock that row.
+            row = db.execute(query).first()
+        return IdBitmap.from_bytes(row.base_id, row.bits)
+
+    @classmethod
+    def store_bitmap(cls, db, user_id, discussion_id, bitmap):
+        table = cls.__table__
+        db.execute(table.update().where(
+            (table.c.user_id == user_id)
+            & (table.c.discussion_id == discussion_id)
+        ).values(base_id=bitmap.base, bits=bitmap.to_bytes()))
+        mark_changed(db)
+
+
+def _record_read_change(target, read):
+    session = object_session(target)
+    if session is None:
+        return
+    changes = session.info.setdefault('post_read_changes', {})
+    changes[(target.actor_id, target.post_id)] = read
+
+
+@event.listens_for(ViewPost, 'after_insert', propagate=True)
+@event.listens_for(ViewPost, 'after_update', propagate=True)
+def view_post_read_listener(mapper, connection, target):
+    _record_read_change(target, target.tombstone_date is None)
+
+
+@event.listens_for(ViewPost, 'after_delete', propagate=True)
+def view_post_unread_listener(mapper, connection, target):
+    _record_read_change(target, False)
+
+
+@event.listens_for(get_session_maker(), 'before_commit')
+def update_post_read_bitmaps(session):
+    """Apply the ViewPost changes of this transaction to the bitmaps"""
+    if not session.info.get('post_read_changes'):
+        return
+    session.flush()
+    changes = session.info.pop('post_read_changes', {})
+    post_discussion = dict(session.query(
+        Content.id, Content.discussion_id).filter(
+        Content.id.in_({post_id for (_, post_id) in changes})))
+    by_bitmap = defaultdict(lambda: (set(), set()))
+    for (user_id, post_id), read in changes.items():
+        discussion_id = post_discussion.get(post_id)
+        if discussion_id is None:
+            continue
+        by_bitmap[(user_id, discussion_id)][0 if read else 1].add(post_id)
+    for (user_id, discussion_id), (read, unread) in by_bitmap.items():
+        bitmap = PostReadBitmap.get_bitmap(
+            session, user_id, discussion_id, True)
+        bitmap.update(read)
+        bitmap.difference_update(unread)
+        PostReadBitmap.store_bitmap(session, user_id, discussion_id, bitmap)
+
+
+@event.listens_for(get_session_maker(), 'after_rollback')
+def forget_post_read_changes(session):
+    session.info.pop('post_read_changes', None)
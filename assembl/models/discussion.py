@@ -38,13 +38,15 @@ from assembl.lib import config
 from assembl.lib.utils import slugify, get_global_base_url, full_class_name
 from ..lib.sqla_types import URLString, CoerceUnicode
 from ..lib.sqla import CrudOperation
+from ..lib.caching import (
+    shared_region, generational_key, changes_generations, weak_etag)
 from ..lib.locale import strip_country
 from ..lib.discussion_creation import IDiscussionCreationCallback
 from . import DiscussionBoundBase, NamedClassMixin, OriginMixin
 from ..semantic.virtuoso_mapping import QuadMapPatternS
 from ..auth import (
-    P_READ, R_SYSADMIN, P_ADMIN_DISC, R_PARTICIPANT, P_SYSADMIN,
-    CrudPermissions, Authenticated, Everyone)
+    P_READ, P_READ_IDEA, R_SYSADMIN, P_ADMIN_DISC, R_PARTICIPANT,
+    P_SYSADMIN, CrudPermissions, Authenticated, Everyone)
 from .auth import User
 from ..auth.util import get_permissions, permissions_for_state
 from .permissions import (
@@ -148,15 +150,10 @@ class Discussion(NamedClassMixin, OriginMixin, DiscussionBoundBase):
         self.logo_url = url
 
     def read_post_ids(self, user_id):
-        from .post import Post
-        from .action import ViewPost
-        return (x[0] for x in self.db.query(Post.id).join(
-            ViewPost
-        ).filter(
-            Post.discussion_id == self.id,
-            ViewPost.actor_id == user_id,
-            ViewPost.post_id == Post.id
-        ))
+        from .action import PostReadBitmap
+        if not user_id:
+            return iter(())
+        return iter(PostReadBitmap.get_bitmap(self.db, user_id, self.id))
 
     def get_read_posts_ids_preload(self, user_id):
         from .post import Post
@@ -421,23 +418,105 @@ class Discussion(NamedClassMixin, OriginMixin, DiscussionBoundBase):
             pass  # add a pseudo-anonymous user?
         return users
 
-    def get_all_agents_preload(self, user=None):
+    def cached_preload(self, name, variant, compute, global_changes=False):
+        """The json computed by ``compute`` for a preload, as
+        (etag, data, json string).
+
+        Shared by the requests that give the same ``variant``, in the
+        ``preload`` dogpile region, until the change stream has changes
+        in this discussion, or, with ``global_changes``, changes outside
+        of any discussion, such as to users."""
+        def create():
+            data = compute()
+            value = json.dumps(data)
+            return (weak_etag(value), data, value)
+        region = shared_region('preload')
+        if not region:
+            return create()
+        key = generational_key(
+            shared_region('changes'), 'preload:%d:%s:%s' % (
+                self.id, name, weak_etag(variant)[3:-1]),
+            changes_generations(self.id, global_changes))
+        return region.get_or_create(key, create)
+
+    def all_agents_preload(self, user=None):
+        """The agents of the discussion, as (etag, json string).
+
+        Only the user's own email is added per request."""
         from assembl.views.api.agent import _get_agents_real
         from pyramid.threadlocal import get_current_request
         request = get_current_request()
         assert request
-        return json.dumps(_get_agents_real(
-            request, user.id if user else Everyone, 'partial'))
+        permissions = request.permissions
+        (etag, agents, value) = self.cached_preload(
+            'agents', ','.join(sorted(permissions)),
+            lambda: _get_agents_real(request, Everyone, 'partial'), True)
+        if user is None or P_ADMIN_DISC in permissions or \
+                P_SYSADMIN in permissions:
+            # emails are already there
+            return (etag, value)
+        uri = user.uri()
+        for (n, agent) in enumerate(agents):
+            if agent and agent['@id'] == uri:
+                agents = list(agents)
+                agents[n] = dict(
+                    agent, preferred_email=user.get_preferred_email())
+                value = json.dumps(agents)
+                return (weak_etag(value), value)
+        return (etag, value)
 
-    def get_readers_preload(self):
-        return json.dumps([user.generic_json('partial') for user in self.get_readers()])
+    def get_all_agents_preload(self, user=None):
+        return self.all_agents_preload(user)[1]
 
-    def get_ideas_preload(self, user_id):
+    def get_readers_preload(self):
+        (etag, readers, value) = self.cached_preload(
+            'readers', '', lambda: [
+                user.generic_json('partial') for user in self.get_readers()],
+            True)
+        return value
+
+    def ideas_preload(self, user_id):
+        """The ideas of the discussion, as (etag, json string).
+
+        The ideas are computed as seen by everyone, and shared when the
+        user can read all ideas; post counts and extra permissions are
+        then overlaid for the user."""
         from assembl.views.api.idea import _get_ideas_real
         from pyramid.threadlocal import get_current_request
+        from .idea import Idea
         request = get_current_request()
         assert request
-        return json.dumps(_get_ideas_real(request, user_id=user_id))
+        base_permissions = request.base_permissions
+        if not (P_READ_IDEA in base_permissions
+                or P_SYSADMIN in base_permissions):
+            # Which ideas are visible depends on the user
+            value = json.dumps(_get_ideas_real(request, user_id=user_id))
+            return (weak_etag(value), value)
+        (etag, ideas, value) = self.cached_preload(
+            'ideas', ','.join(sorted(request.permissions)),
+            lambda: _get_ideas_real(request, user_id=Everyone))
+        ideas = [idea for idea in ideas if idea]
+        if not ideas:
+            return (etag, value)
+        counters = Idea.prepare_counters(self.id, True)
+        idea_ids = [Idea.get_database_id(idea['@id']) for idea in ideas]
+        instances = {idea.id: idea for idea in self.db.query(Idea).filter(
+            Idea.id.in_(idea_ids)).options(joinedload(Idea.pub_state))}
+        overlaid = []
+        for (idea_id, idea) in zip(idea_ids, ideas):
+            idea = dict(idea)
+            if 'num_total_and_read_posts' in idea:
+                idea['num_total_and_read_posts'] = counters.get_counts(
+                    idea_id)
+            if 'extra_permissions' in idea and idea_id in instances:
+                idea['extra_permissions'] = \
+                    instances[idea_id].extra_permissions_for(user_id)
+            overlaid.append(idea)
+        value = json.dumps(overlaid)
+        return (weak_etag(value), value)
+
+    def get_ideas_preload(self, user_id):
+        return self.ideas_preload(user_id)[1]
 
     def get_idea_links(self):
         from .idea import Idea
@@ -452,14 +531,23 @@ class Discussion(NamedClassMixin, OriginMixin, DiscussionBoundBase):
             Idea.discussion_id == self.id).filter(
                 ~Idea.source_links.any()).all()
 
-    def get_related_extracts_preload(self, user_id):
+    def related_extracts_preload(self, user_id):
+        "The extracts of the discussion, as (etag, json string)."
         from assembl.views.api.extract import _get_extracts_real
         from pyramid.threadlocal import get_current_request
         from .idea import Idea
-        Idea.get_discussion_data(self.id)
         request = get_current_request()
         assert request
-        return json.dumps(_get_extracts_real(request, user_id=user_id))
+
+        def compute():
+            Idea.get_discussion_data(self.id)
+            return _get_extracts_real(request, user_id=Everyone)
+        (etag, extracts, value) = self.cached_preload(
+            'extracts', ','.join(sorted(request.permissions)), compute)
+        return (etag, value)
+
+    def get_related_extracts_preload(self, user_id):
+        return self.related_extracts_preload(user_id)[1]
 
     def get_user_permissions(self, user_id):
         return get_permissions(user_id, self.id)
@@ -15,6 +15,7 @@ from sqlalchemy.orm import (
     relationship, backref, aliased, contains_eager, joinedload, deferred,
     column_property, with_polymorphic, remote, foreign)
 from sqlalchemy.orm.attributes import NO_VALUE
+from sqlalchemy.orm.session import object_session
 from sqlalchemy.sql import text, column
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.sql.expression import union, bindparam, literal_column
@@ -45,7 +46,7 @@ from ..lib.clean_input import sanitize_text
 from ..lib.utils import get_global_base_url
 from ..nlp.wordcounter import WordCounter
 from . import (
-    DiscussionBoundBase, HistoryMixinWithOrigin, TimestampedMixin)
+    Base, DiscussionBoundBase, HistoryMixinWithOrigin, TimestampedMixin)
 from .discussion import Discussion
 from .uriref import URIRefDb
 from ..semantic.virtuoso_mapping import QuadMapPatternS
@@ -57,7 +58,8 @@ from .permissions import (
 from .langstrings import LangString, LangStringEntry
 from ..semantic.namespaces import (
     SIOC, IDEA, ASSEMBL, QUADNAMES, FOAF, RDF, VirtRDF)
-from ..lib.sqla import CrudOperation
+from ..lib.sqla import CrudOperation, get_session_maker
+from ..lib.caching import shared_region, get_generation, renew_generation
 from ..lib.model_watcher import get_model_watcher
 from .auth import AgentProfile
 from .publication_states import PublicationState, PublicationTransition
@@ -507,10 +509,18 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
         return select_exp
 
     def get_all_ancestors(self, id_only=False):
-        query = self.get_ancestors_query(
-            tombstone_date=self.tombstone_date, subquery=not id_only)
+        hierarchy = None
+        if self.tombstone_date is None:
+            hierarchy = IdeaHierarchy.get(self.db, self.discussion_id)
+        if hierarchy is not None and self.id in hierarchy:
+            query = list(hierarchy.ancestors(self.id))
+        else:
+            query = self.get_ancestors_query(
+                tombstone_date=self.tombstone_date, subquery=not id_only)
+            if id_only:
+                return list((id for (id,) in self.db.query(query)))
         if id_only:
-            return list((id for (id,) in self.db.query(query)))
+            return query
         else:
             return self.db.query(Idea).filter(Idea.id.in_(query)).all()
 
@@ -564,10 +574,16 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
         return select_exp
 
     def get_all_descendants(self, id_only=False, inclusive=True):
-        query = self.get_descendants_query(
-            inclusive=inclusive, subquery=not id_only)
+        hierarchy = IdeaHierarchy.get(self.db, self.discussion_id)
+        if self.id in hierarchy:
+            query = list(hierarchy.descendants(self.id, inclusive))
+        else:
+            query = self.get_descendants_query(
+                inclusive=inclusive, subquery=not id_only)
+            if id_only:
+                return list((id for (id,) in self.db.query(query)))
         if id_only:
-            return list((id for (id,) in self.db.query(query)))
+            return query
         else:
             return self.db.query(Idea).filter(Idea.id.in_(query)).all()
 
@@ -695,33 +711,7 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
 
     @classmethod
     def children_dict(cls, discussion_id):
-        # We do not want a subclass
-        cls = [c for c in cls.mro() if c.__name__=="Idea"][0]
-        source = aliased(cls, name="source")
-        target = aliased(cls, name="target")
-        link_info = list(cls.default_db.query(
-            IdeaLink.target_id, IdeaLink.source_id
-            ).join(source, source.id == IdeaLink.source_id
-            ).join(target, target.id == IdeaLink.target_id
-            ).filter(
-            source.discussion_id == discussion_id,
-            IdeaLink.tombstone_date == None,
-            source.tombstone_date == None,
-            target.tombstone_date == None,
-            target.discussion_id == discussion_id
-            ).order_by(IdeaLink.order))
-        if not link_info:
-            (root_id,) = cls.default_db.query(
-                RootIdea.id).filter_by(discussion_id=discussion_id).first()
-            return {None: (root_id,), root_id: ()}
-        child_nodes = {child for (child, parent) in link_info}
-        children_of = defaultdict(list)
-        for (child, parent) in link_info:
-            children_of[parent].append(child)
-        root = set(children_of.keys()) - child_nodes
-        assert len(root) == 1
-        children_of[None] = [root.pop()]
-        return children_of
+        return IdeaHierarchy.get(cls.default_db(), discussion_id).children
 
     @classmethod
     def visit_idea_ids_depth_first(
@@ -1013,23 +1003,22 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
     @classmethod
     def get_idea_ids_showing_post(cls, post_id):
         "Given a post, give the ID of the ideas that show this message"
-        from sqlalchemy.sql.functions import func
-        from .idea_content_link import IdeaContentPositiveLink
+        from .idea_content_link import (
+            IdeaContentPositiveLink, PostIdeaContentLink)
         from .post import Post
-        (ancestry, discussion_id, idea_link_ids)  = cls.default_db.query(
-            Post.ancestry, Post.discussion_id,
-            func.idea_content_links_above_post(Post.id)
+        (ancestry, discussion_id) = cls.default_db.query(
+            Post.ancestry, Post.discussion_id
             ).filter(Post.id==post_id).first()
         post_path = "%s%d," % (ancestry, post_id)
-        if not idea_link_ids:
-            return []
-        idea_link_ids = [int(id) for id in idea_link_ids.split(',') if id]
-        # This could be combined with previous in postgres.
         root_ideas = cls.default_db.query(
                 IdeaContentPositiveLink.idea_id.distinct()
+            ).join(
+                PostIdeaContentLink,
+                PostIdeaContentLink.idea_content_link_id ==
+                IdeaContentPositiveLink.id
             ).filter(
                 IdeaContentPositiveLink.idea_id != None,
-                IdeaContentPositiveLink.id.in_(idea_link_ids)).all()
+                PostIdeaContentLink.post_id == post_id).all()
         if not root_ideas:
             return []
         root_ideas = [x for (x,) in root_ideas]
@@ -1055,6 +1044,24 @@ class Idea(HistoryMixinWithOrigin, TimestampedMixin, DiscussionBoundBase):
         return [(idea.id, idea.num_read_posts)
                 for idea in ideas]
 
+    @classmethod
+    def ideas_read_counts(cls, discussion_id, post_ids):
+        """Given posts, give the read count of posts of the current user
+            for each idea that shows any of them"""
+        from .path_utils import PostPathIndex
+        from .post import Post
+        if not post_ids:
+            return []
+        counter = cls.prepare_counters(discussion_id)
+        index = PostPathIndex(counter.paths)
+        idea_ids = set()
+        for (post_id, ancestry) in cls.default_db.query(
+                Post.id, Post.ancestry).filter(Post.id.in_(post_ids)):
+            idea_ids.update(index.ideas_including(
+                "%s%d," % (ancestry or '', post_id)))
+        return [(idea_id, counter.get_counts(idea_id)[2])
+                for idea_id in idea_ids]
+
     def get_widget_creation_urls(self):
         from .widgets import GeneratedIdeaWidgetLink
         return [wl.context_url for wl in self.widget_links
@@ -1837,3 +1844,221 @@ def send_user_to_socket_for_idea_local_user_role(
     user.send_to_changes(
         connection, CrudOperation.UPDATE, target.get_discussion_id(), "private")
 
+
+
+class IdeaPostCount(Base):
+    """The number of posts and contributors of an idea, including
+    those of its descendants, as shown in the table of ideas.
+
+    Kept up to date by :py:mod:`assembl.models.path_utils`, and rebuilt
+    by :py:mod:`assembl.scripts.rebuild_idea_post_counts`."""
+    __tablename__ = 'idea_post_count'
+
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    num_posts = Column(Integer, nullable=False, default=0)
+    num_contributors = Column(Integer, nullable=False, default=0)
+
+
+class _ChildrenDict(dict):
+    "Children of ideas by id; leaves and unknown ideas have none."
+    def __missing__(self, key):
+        return ()
+
+
+class IdeaHierarchy(object):
+    """An immutable snapshot of the tree of live ideas of a discussion.
+
+    Holds the parent and children of each idea, their depth, and the
+    interval of each idea in a depth-first (Euler) tour of the tree, so
+    ancestry tests and descendant lists need no query.
+
+    Snapshots are shared across requests, and across processes in the
+    ``idea_hierarchy`` dogpile region when a dogpile backend is
+    configured. They are versioned by a generation token per discussion,
+    renewed after a commit that changes idea links or removes ideas."""
+
+    def __init__(self, discussion_id, root_id, link_info, version=None):
+        """:param link_info: (child_id, parent_id) pairs, in order"""
+        self.discussion_id = discussion_id
+        self.version = version
+        self.root_id = root_id
+        self.parent = {}
+        children = defaultdict(list)
+        for (child_id, parent_id) in link_info:
+            self.parent[child_id] = parent_id
+            children[parent_id].append(child_id)
+        self.children = _ChildrenDict(
+            (parent_id, tuple(child_ids))
+            for (parent_id, child_ids) in children.items())
+        self.children[None] = (root_id,)
+        # Euler tour: descendants of an idea are the ideas from its
+        # enter index to its exit index in the depth-first order.
+        order = []
+        enter = {}
+        exit = {}
+        depth = {}
+        stack = [(root_id, 0, False)]
+        while stack:
+            (idea_id, level, done) = stack.pop()
+            if done:
+                exit[idea_id] = len(order)
+                continue
+            if idea_id in enter:
+                # not necessary in a tree, but let's start to think graph.
+                continue
+            enter[idea_id] = len(order)
+            depth[idea_id] = level
+            order.append(idea_id)
+            stack.append((idea_id, level, True))
+            for child_id in reversed(self.children[idea_id]):
+                stack.append((child_id, level + 1, False))
+        self.order = tuple(order)
+        self.enter = enter
+        self.exit = exit
+        self.depth = depth
+
+    @classmethod
+    def load(cls, db, discussion_id, version=None):
+        source = aliased(Idea, name="source")
+        target = aliased(Idea, name="target")
+        link_info = list(db.query(
+            IdeaLink.target_id, IdeaLink.source_id
+            ).join(source, source.id == IdeaLink.source_id
+            ).join(target, target.id == IdeaLink.target_id
+            ).filter(
+            source.discussion_id == discussion_id,
+            IdeaLink.tombstone_date == None,
+            source.tombstone_date == None,
+            target.tombstone_date == None,
+            target.discussion_id == discussion_id
+            ).order_by(IdeaLink.order))
+        roots = {parent for (child, parent) in link_info} - {
+            child for (child, parent) in link_info}
+        if len(roots) == 1:
+            root_id = roots.pop()
+        else:
+            (root_id,) = db.query(RootIdea.id).filter_by(
+                discussion_id=discussion_id).first()
+        return cls(discussion_id, root_id, link_info, version)
+
+    @classmethod
+    def get(cls, db, discussion_id):
+        """The current hierarchy of the discussion"""
+        if db.autoflush and (db.new or db.dirty or db.deleted):
+            # as a query would
+            db.flush()
+        if db.info.get('idea_hierarchy_changes') or discussion_id in \
+                db.info.get('idea_hierarchy_discussions', ()):
+            # Uncommitted changes in this transaction
+            return cls.load(db, discussion_id)
+        region = shared_region('idea_hierarchy')
+        if not region:
+            return cls.load(db, discussion_id)
+        version = get_generation(region, 'discussion:%d' % (discussion_id,))
+        hierarchy = _idea_hierarchies.get(discussion_id, None)
+        if hierarchy is not None and hierarchy.version == version:
+            return hierarchy
+        key = 'hierarchy:%d:%s' % (discussion_id, version)
+        hierarchy = region.get(key)
+        if not hierarchy:
+            hierarchy = cls.load(db, discussion_id, version)
+            region.set(key, hierarchy)
+        _idea_hierarchies[discussion_id] = hierarchy
+        return hierarchy
+
+    def __contains__(self, idea_id):
+        return idea_id in self.enter
+
+    def is_ancestor(self, ancestor_id, idea_id, inclusive=True):
+        if ancestor_id not in self.enter or idea_id not in self.enter:
+            return False
+        if ancestor_id == idea_id:
+            return inclusive
+        return (self.enter[ancestor_id] < self.enter[idea_id]
+                < self.exit[ancestor_id])
+
+    def ancestors(self, idea_id, inclusive=True):
+        """ids of ancestor ideas, from the idea up to the root"""
+        if not inclusive:
+            idea_id = self.parent.get(idea_id, None)
+        while idea_id:
+            yield idea_id
+            idea_id = self.parent.get(idea_id, None)
+
+    def descendants(self, idea_id, inclusive=True):
+        """ids of descendant ideas, in depth-first order"""
+        if idea_id not in self.enter:
+            return ()
+        start = self.enter[idea_id]
+        return self.order[start if inclusive else start + 1:
+                          self.exit[idea_id]]
+
+
+_idea_hierarchies = {}
+
+
+def _record_hierarchy_change(target, idea_ids):
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault('idea_hierarchy_changes', set()).update(
+        idea_id for idea_id in idea_ids if idea_id)
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_link_hierarchy_listener(mapper, connection, target):
+    _record_hierarchy_change(target, (target.source_id, target.target_id))
+
+
+def _record_hierarchy_discussion(target):
+    session = object_session(target)
+    if session is not None and target.discussion_id:
+        session.info.setdefault('idea_hierarchy_discussions', set()).add(
+            target.discussion_id)
+
+
+@event.listens_for(Idea, 'after_update', propagate=True)
+def idea_hierarchy_listener(mapper, connection, target):
+    if inspect(target).attrs.tombstone_date.history.has_changes():
+        _record_hierarchy_discussion(target)
+
+
+@event.listens_for(Idea, 'after_delete', propagate=True)
+def idea_delete_hierarchy_listener(mapper, connection, target):
+    _record_hierarchy_discussion(target)
+
+
+@event.listens_for(get_session_maker(), 'before_commit')
+def find_hierarchy_changes(session):
+    """Find the discussions of the ideas whose links changed,
+    while we can still query."""
+    if not session.info.get('idea_hierarchy_changes'):
+        return
+    session.flush()
+    idea_ids = session.info.pop('idea_hierarchy_changes', ())
+    session.info.setdefault('idea_hierarchy_discussions', set()).update(
+        discussion_id for (discussion_id,) in session.query(
+            Idea.discussion_id.distinct()).filter(Idea.id.in_(idea_ids)))
+
+
+@event.listens_for(get_session_maker(), 'after_commit')
+def renew_hierarchy_versions(session):
+    discussion_ids = session.info.pop('idea_hierarchy_discussions', ())
+    for discussion_id in discussion_ids:
+        _idea_hierarchies.pop(discussion_id, None)
+    region = shared_region('idea_hierarchy')
+    if region:
+        for discussion_id in discussion_ids:
+            renew_generation(region, 'discussion:%d' % (discussion_id,))
+
+
+@event.listens_for(get_session_maker(), 'after_rollback')
+def forget_hierarchy_changes(session):
+    session.info.pop('idea_hierarchy_changes', None)
+    session.info.pop('idea_hierarchy_discussions', None)
@@ -4,9 +4,13 @@ import re
 import quopri
 import logging
 import simplejson as json
+from builtins import object
+from collections import defaultdict
 
 from future.utils import as_native_str
 from sqlalchemy.orm import (relationship, backref)
+from sqlalchemy.orm.session import object_session
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy import (
     Column,
     Boolean,
@@ -16,15 +20,22 @@ from sqlalchemy import (
     Unicode,
     UnicodeText,
     ForeignKey,
+    any_,
+    cast,
     event,
+    func,
+    inspect,
+    literal,
+    select,
 )
 from rdflib import URIRef
 from sqla_rdfbridge.mapping import PatternIriClass
 
-from . import DiscussionBoundBase, OriginMixin
+from . import Base, DiscussionBoundBase, OriginMixin
 from ..semantic import context_url
 from ..semantic.virtuoso_mapping import QuadMapPatternS
-from ..lib.sqla import CrudOperation
+from ..lib.sqla import CrudOperation, get_session_maker
+from ..lib.caching import shared_region, get_generation, renew_generation
 from ..lib.model_watcher import get_model_watcher
 from ..lib.utils import get_global_base_url
 from ..lib.clean_input import sanitize_html
@@ -515,6 +526,260 @@ class IdeaThreadContextBreakLink(IdeaContentNegativeLink):
     }
 
 
+class PostIdeaContentLink(Base):
+    """Index of the :py:class:`IdeaContentLink` that apply to each post,
+    i.e. the links of the post itself and of its ancestors.
+
+    Kept up to date when links are created or changed and when posts are
+    moved; links and posts that go away take their rows with them."""
+    __tablename__ = 'post_idea_content_link'
+
+    post_id = Column(Integer, ForeignKey(
+        Post.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    idea_content_link_id = Column(Integer, ForeignKey(
+        IdeaContentLink.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True, index=True)
+    negative = Column(Boolean, nullable=False, default=False)
+
+    @staticmethod
+    def negative_types():
+        return [cls.__mapper__.polymorphic_identity
+                for cls in IdeaContentNegativeLink.get_subclasses()]
+
+    @classmethod
+    def rebuild(cls, connection, post_ids):
+        """Recompute the rows of those posts from their ancestry.
+
+        :param post_ids: a list of ids, or a select of ids"""
+        table = cls.__table__
+        post = Post.__table__
+        link = IdeaContentLink.__table__
+        connection.execute(table.delete().where(
+            table.c.post_id.in_(post_ids)))
+        path_ids = cast(func.string_to_array(
+            post.c.ancestry + cast(post.c.id, String), ','), ARRAY(Integer))
+        connection.execute(table.insert().from_select(
+            ['post_id', 'idea_content_link_id', 'negative'],
+            select([post.c.id, link.c.id,
+                    link.c.type.in_(cls.negative_types())]
+                   ).select_from(post.join(
+                       link, link.c.content_id == any_(path_ids))
+                   ).where(post.c.id.in_(post_ids))))
+
+    @classmethod
+    def add_link(cls, connection, link_id, content_id, negative):
+        """Add a new link to its post and all the posts below it"""
+        table = cls.__table__
+        post = Post.__table__
+        linked = post.alias('linked')
+        connection.execute(table.insert().from_select(
+            ['post_id', 'idea_content_link_id', 'negative'],
+            select([post.c.id, literal(link_id), literal(negative)]).where(
+                (linked.c.id == content_id) & (
+                    (post.c.id == linked.c.id) | post.c.ancestry.like(
+                        linked.c.ancestry + cast(linked.c.id, String)
+                        + ',%')))))
+
+    @classmethod
+    def remove_link(cls, connection, link_id):
+        table = cls.__table__
+        connection.execute(table.delete().where(
+            table.c.idea_content_link_id == link_id))
+
+    @classmethod
+    def link_ids_by_post(cls, db, post_ids):
+        """The ids of the links that apply to each of those posts.
+
+        :param post_ids: a list of ids, or a query of ids
+        :returns: a dict of link id lists, by post id; posts without
+            links are absent."""
+        link_ids = defaultdict(list)
+        for (post_id, link_id) in db.query(
+                cls.post_id, cls.idea_content_link_id).filter(
+                cls.post_id.in_(post_ids)):
+            link_ids[post_id].append(link_id)
+        return dict(link_ids)
+
+
+@event.listens_for(IdeaContentLink, 'after_insert', propagate=True)
+def index_link_insert_listener(mapper, connection, target):
+    PostIdeaContentLink.add_link(
+        connection, target.id, target.content_id,
+        isinstance(target, IdeaContentNegativeLink))
+    _record_link_change(target)
+
+
+@event.listens_for(IdeaContentLink, 'after_update', propagate=True)
+def index_link_update_listener(mapper, connection, target):
+    # Links seldom change; the content may have.
+    PostIdeaContentLink.remove_link(connection, target.id)
+    PostIdeaContentLink.add_link(
+        connection, target.id, target.content_id,
+        isinstance(target, IdeaContentNegativeLink))
+    _record_link_change(target)
+
+
+@event.listens_for(IdeaContentLink, 'after_delete', propagate=True)
+def index_link_delete_listener(mapper, connection, target):
+    # Index rows are deleted by cascade.
+    _record_link_change(target)
+
+
+@event.listens_for(Post, 'after_insert', propagate=True)
+def index_post_insert_listener(mapper, connection, target):
+    # Links on the post itself come later, through the link listeners.
+    if target.ancestry:
+        PostIdeaContentLink.rebuild(connection, [target.id])
+
+
+@event.listens_for(Post, 'after_update', propagate=True)
+def index_post_update_listener(mapper, connection, target):
+    # Descendants of a moved post are handled by Post._set_ancestry.
+    if inspect(target).attrs.ancestry.history.has_changes():
+        PostIdeaContentLink.rebuild(connection, [target.id])
+
+
+class DiscussionIdeaContentLinks(object):
+    """The json representations of the idea content links of a
+    discussion, as given with posts, with what is needed to filter them.
+
+    Shared across requests, and across processes in the
+    ``idea_content_links`` dogpile region when a dogpile backend is
+    configured. They are versioned by a generation token per discussion,
+    renewed after a commit that changes links."""
+
+    def __init__(self, discussion_id, rows, version=None):
+        """:param rows: (id, idea_id, content_id, creator_id, type,
+            creation_date, extract_id) of each link"""
+        self.discussion_id = discussion_id
+        self.version = version
+        polymap = IdeaContentLink.__mapper__.polymorphic_map
+        negative_types = set(PostIdeaContentLink.negative_types())
+        # link id -> (json, idea_id, content_id, negative)
+        self.links = {}
+        for (id, idea_id, content_id, creator_id, type, creation_date,
+                extract_id) in rows:
+            self.links[id] = ({
+                "@id": IdeaContentLink.uri_generic(id),
+                "idIdea": Idea.uri_generic(idea_id),
+                "idPost": Content.uri_generic(content_id),
+                "idCreator": AgentProfile.uri_generic(creator_id),
+                "@type": polymap[type].class_.external_typename(),
+                "created": creation_date.isoformat() + "Z",
+                "idExcerpt": Extract.uri_generic(extract_id)
+                if extract_id else None,
+            }, idea_id, content_id, type in negative_types)
+
+    @classmethod
+    def load(cls, db, discussion_id, version=None):
+        link = IdeaContentLink.__table__
+        content = Content.__table__
+        rows = db.execute(select([
+            link.c.id, link.c.idea_id, link.c.content_id, link.c.creator_id,
+            link.c.type, link.c.creation_date, link.c.extract_id]
+        ).select_from(link.join(content, content.c.id == link.c.content_id)
+        ).where(content.c.discussion_id == discussion_id))
+        return cls(discussion_id, rows, version)
+
+    @classmethod
+    def get(cls, db, discussion_id, link_ids=()):
+        """The current links of the discussion
+
+        :param link_ids: links that must be known; the cached value is
+            reloaded if it predates any of them."""
+        if db.info.get('idea_content_link_changes') or discussion_id in \
+                db.info.get('idea_content_link_discussions', ()):
+            # Uncommitted changes in this transaction
+            return cls.load(db, discussion_id)
+        region = shared_region('idea_content_links')
+        if not region:
+            return cls.load(db, discussion_id)
+        version = get_generation(region, 'discussion:%d' % (discussion_id,))
+        links = _discussion_links.get(discussion_id, None)
+        if links is not None and links.version == version \
+                and links.knows(link_ids):
+            return links
+        key = 'links:%d:%s' % (discussion_id, version)
+        links = region.get(key)
+        if not links or not links.knows(link_ids):
+            # The version may not be renewed yet for a recent commit
+            links = cls.load(db, discussion_id, version)
+            region.set(key, links)
+        _discussion_links[discussion_id] = links
+        return links
+
+    def knows(self, link_ids):
+        links = self.links
+        return all(link_id in links for link_id in link_ids)
+
+    def filter(self, link_ids, post):
+        """Exclude positive links if a negative link points from the same
+        idea to a post below, in the ancestry of that post."""
+        links = self.links
+        negative_depths = defaultdict(list)
+        for link_id in link_ids:
+            (_, idea_id, content_id, negative) = links[link_id]
+            if negative:
+                negative_depths[idea_id].append(content_id)
+        if not negative_depths:
+            return link_ids
+        depth = {post_id: n for (n, post_id) in enumerate(
+            post.ancestor_ids() + [post.id])}
+        for idea_id, content_ids in negative_depths.items():
+            negative_depths[idea_id] = max(
+                depth.get(content_id, -1) for content_id in content_ids)
+        result = []
+        for link_id in link_ids:
+            (_, idea_id, content_id, negative) = links[link_id]
+            if (negative or idea_id not in negative_depths
+                    or negative_depths[idea_id] <= depth.get(content_id, -1)):
+                result.append(link_id)
+        return result
+
+    def representations(self, link_ids):
+        return [dict(self.links[link_id][0]) for link_id in link_ids]
+
+
+_discussion_links = {}
+
+
+def _record_link_change(target):
+    session = object_session(target)
+    if session is not None and target.content_id:
+        session.info.setdefault('idea_content_link_changes', set()).add(
+            target.content_id)
+
+
+@event.listens_for(get_session_maker(), 'before_commit')
+def find_idea_content_link_changes(session):
+    """Find the discussions of the changed links, while we can still
+    query."""
+    content_ids = session.info.pop('idea_content_link_changes', None)
+    if not content_ids:
+        return
+    session.info.setdefault('idea_content_link_discussions', set()).update(
+        discussion_id for (discussion_id,) in session.query(
+            Content.discussion_id.distinct()).filter(
+            Content.id.in_(content_ids)))
+
+
+@event.listens_for(get_session_maker(), 'after_commit')
+def renew_idea_content_link_versions(session):
+    discussion_ids = session.info.pop('idea_content_link_discussions', ())
+    for discussion_id in discussion_ids:
+        _discussion_links.pop(discussion_id, None)
+    region = shared_region('idea_content_links')
+    if region:
+        for discussion_id in discussion_ids:
+            renew_generation(region, 'discussion:%d' % (discussion_id,))
+
+
+@event.listens_for(get_session_maker(), 'after_rollback')
+def forget_idea_content_link_changes(session):
+    session.info.pop('idea_content_link_changes', None)
+    session.info.pop('idea_content_link_discussions', None)
+
+
 class AnnotationSelector(DiscussionBoundBase):
     __tablename__ = 'annotation_selector'
     id = Column(Integer, primary_key=True,
@@ -3,13 +3,16 @@
 from builtins import str
 from builtins import object
 import email
-import mailbox
 import re
 import smtplib
 import os
+import ssl
+from hashlib import sha1
 from html import escape as html_escape
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from multiprocessing import cpu_count
 from email.header import decode_header as decode_email_header, Header
+from email.parser import HeaderParser
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import parseaddr, mktime_tz, parsedate_tz
@@ -19,14 +22,16 @@ from html import escape
 
 from future.utils import native_str, as_native_str, binary_type, PY2, bytes_to_native_str
 from past.builtins import str as oldstr
-import jwzthreading
+from billiard.pool import Pool
+import certifi
+from imapclient import IMAPClient
 from ..lib.clean_input import sanitize_html
 from pyramid.threadlocal import get_current_registry
 from datetime import datetime
-# from imaplib2 import IMAP4_SSL, IMAP4
 import transaction
 from pyisemail import is_email
-from sqlalchemy.orm import (deferred, undefer, joinedload_all)
+from sqlalchemy.orm import (
+    deferred, undefer, joinedload_all, relationship)
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy import (
     Column,
@@ -36,21 +41,79 @@ from sqlalchemy import (
     Binary,
     UnicodeText,
     Boolean,
+    UniqueConstraint,
 )
 from ..lib.sqla_types import (CoerceUnicode, EmailString)
 
+from . import Base
 from .langstrings import LangString
 from .generic import PostSource
 from .post import ImportedPost
 from .auth import EmailAccount
 from .attachment import File, PostAttachment, AttachmentPurpose
 from ..tasks.imap import import_mails
-from ..tasks.translate import translate_content
+from ..tasks.translate import translate_contents
 
 
 log = logging.getLogger(__name__)
 
 
+class MessageParser(object):
+    """Parses messages with :py:meth:`AbstractMailbox.parse_message`, over a
+    pool of ``mail_import_processes`` worker processes (default: one per
+    cpu), or in this process if set to 1.
+
+    Imports run in celery prefork workers, which are daemonic processes;
+    multiprocessing does not let those have children, so the pool is
+    billiard's, celery's fork of multiprocessing, which does.
+
+    Use as a context manager, so the pool is shut down."""
+    def __init__(self, processes=None):
+        if processes is None:
+            from assembl.lib.config import get_config
+            processes = int(get_config().get(
+                'mail_import_processes', 0) or cpu_count())
+        self.pool = None
+        if processes > 1:
+            self.pool = Pool(processes)
+
+    def _map(self, function, items):
+        if self.pool is None or len(items) < 2:
+            return [function(item) for item in items]
+        return self.pool.map(function, items, chunksize=8)
+
+    def parse(self, messages):
+        return self._map(AbstractMailbox.parse_message, messages)
+
+    def parse_files(self, paths):
+        "Read and parse files, in the worker processes"
+        return self._map(parse_message_file, paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.pool is not None:
+            if exc_type is None:
+                self.pool.close()
+            else:
+                self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def parse_message_file(path):
+    """Read an email file and parse it with
+    :py:meth:`AbstractMailbox.parse_message`, adding the ``content_hash``
+    of the file."""
+    with open(path, 'rb') as f:
+        message_bytes = f.read()
+    message_data = AbstractMailbox.parse_message(
+        AbstractMailbox.guess_encoding(message_bytes))
+    message_data['content_hash'] = sha1(message_bytes).hexdigest()
+    return message_data
+
+
 class AbstractMailbox(PostSource):
     """
     A Mailbox refers to any source of Email, and
@@ -331,8 +394,13 @@ class AbstractMailbox(PostSource):
         #Nothing was stripped...
         return html.tostring(doc, encoding="unicode")
 
-    def parse_email(self, message_string, existing_email=None):
-        """ Creates or replace a email from a string """
+    @staticmethod
+    def parse_message(message_string):
+        """Parse an email string without using the database.
+
+        This is the costly part of :py:meth:`parse_email`, and may run in
+        another process: returns a dict of picklable values, whose
+        ``error`` is set if the email cannot be imported."""
         if isinstance(message_string, binary_type):
             message_bytes = message_string
             message_string = message_bytes.decode('utf-8')
@@ -341,7 +409,6 @@ class AbstractMailbox(PostSource):
         parsed_email = email.message_from_string(
             bytes_to_native_str(message_bytes))
         body = None
-        error_description = None
         default_charset = parsed_email.get_charset() or 'ISO-8859-1'
 
         def extract_text(part):
@@ -428,17 +495,16 @@ class AbstractMailbox(PostSource):
 
         new_message_id = parsed_email.get('Message-ID', None)
         if new_message_id:
-            new_message_id = self.clean_angle_brackets(
+            new_message_id = AbstractMailbox.clean_angle_brackets(
                 email_header_to_unicode(new_message_id))
         else:
-            error_description = "Unable to parse the Message-ID for message string: \n%s" % message_string
-            return (None, None, error_description)
+            return dict(error="Unable to parse the Message-ID for message string: \n%s" % message_string)
 
         assert new_message_id
 
         new_in_reply_to = parsed_email.get('In-Reply-To', None)
         if new_in_reply_to:
-            new_in_reply_to = self.clean_angle_brackets(
+            new_in_reply_to = AbstractMailbox.clean_angle_brackets(
                 email_header_to_unicode(new_in_reply_to))
 
         sender_name, sender_email = parseaddr(parsed_email.get('From'))
@@ -447,16 +513,66 @@ class AbstractMailbox(PostSource):
             sender = "%s <%s>" % (sender_name, sender_email)
         else:
             sender = sender_email
-        sender_email_account = EmailAccount.get_or_make_profile(self.db, sender_email, sender_name)
-        creation_date = datetime.utcfromtimestamp(
-            mktime_tz(parsedate_tz(parsed_email['Date'])))
-        subject = email_header_to_unicode(parsed_email['Subject'], False)
-        recipients = email_header_to_unicode(parsed_email['To'])
-        body = body.strip()
+        attachments = []
+        attachment_parts = [p for p in parsed_email.walk()
+                            if p.get_content_disposition()]
+        for (num, part) in enumerate(attachment_parts):
+            payload = part.get_payload(decode=True)
+            if part.get_content_type() == "message/rfc822":
+                payload = part.as_bytes()
+            attachments.append((
+                part.get_filename("file %d" % num),
+                part.get_content_type(), payload))
+        return dict(
+            error=None,
+            message_bytes=message_bytes,
+            message_id=new_message_id,
+            in_reply_to=new_in_reply_to,
+            sender=sender,
+            sender_name=sender_name,
+            sender_email=sender_email,
+            creation_date=datetime.utcfromtimestamp(
+                mktime_tz(parsedate_tz(parsed_email['Date']))),
+            subject=email_header_to_unicode(parsed_email['Subject'], False),
+            recipients=email_header_to_unicode(parsed_email['To']),
+            body=body.strip(),
+            mime_type=mimeType,
+            references=AbstractMailbox.message_references(parsed_email),
+            attachments=attachments,
+            # used by message_ok_to_import
+            headers={key: parsed_email.get(key, None) for key in (
+                'Return-Path', 'Precedence', 'Auto-Submitted')})
+
+    def parse_email(self, message_string, existing_email=None,
+                    message_data=None, check_existing=True):
+        """ Creates or replace a email from a string
+
+        :param message_data: the result of :py:meth:`parse_message`
+            on that string, if already parsed
+        :param check_existing: whether to look for an email with the same
+            message-id; skip when it is already known to be new"""
+        if message_data is None:
+            message_data = self.parse_message(message_string)
+        if message_data['error']:
+            return (None, None, message_data['error'])
+        message_bytes = message_data['message_bytes']
+        new_message_id = message_data['message_id']
+        new_in_reply_to = message_data['in_reply_to']
+        sender = message_data['sender']
+        sender_email_account = EmailAccount.get_or_make_profile(
+            self.db, message_data['sender_email'],
+            message_data['sender_name'])
+        creation_date = message_data['creation_date']
+        subject = message_data['subject']
+        recipients = message_data['recipients']
+        body = message_data['body']
+        mimeType = message_data['mime_type']
         # Try/except for a normal situation is an anti-pattern,
         # but sqlalchemy doesn't have a function that returns
         # 0, 1 result or an exception
         try:
+            if not check_existing:
+                raise NoResultFound()
             email_object = self.db.query(Email).filter(
                 Email.source_post_id == new_message_id,
                 Email.discussion_id == self.discussion_id,
@@ -525,17 +641,11 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
         # email_object = self.db.merge(email_object)
 
         if not email_object.attachments:
-            attachment_parts = [p for p in parsed_email.walk()
-                                if p.get_content_disposition()]
-            for (num, part) in enumerate(attachment_parts):
-                title = part.get_filename("file %d" % num)
+            for (title, mime_type, payload) in message_data['attachments']:
                 doc = File(
                     discussion=self.discussion,
-                    mime_type=part.get_content_type(),
+                    mime_type=mime_type,
                     title=title)
-                payload = part.get_payload(decode=True)
-                if part.get_content_type() == "message/rfc822":
-                    payload = part.as_bytes()
                 doc.add_raw_data(payload)
                 attachment = PostAttachment(
                     discussion=self.discussion,
@@ -549,7 +659,7 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
                 self.db.add(attachment)
 
         email_object.guess_languages()
-        return (email_object, parsed_email, error_description)
+        return (email_object, message_data, None)
 
     @staticmethod
     def guess_encoding(blob):
@@ -571,77 +681,21 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
             except (UnicodeDecodeError, UnicodeEncodeError):
                 return blob
 
-    """
-    emails have to be a complete set
-    """
-    @staticmethod
-    def thread_mails(emails):
-        #log.debug('Threading...')
-        emails_for_threading = []
-        for mail in emails:
-            blob = AbstractMailbox.guess_encoding(mail.imported_blob)
-            email_for_threading = jwzthreading.Message(email.message_from_string(blob))
-            #Store our emailsubject, jwzthreading does not decode subject itself
-            email_for_threading.subject = mail.subject.first_original().value
-            #Store our email object pointer instead of the raw message text
-            email_for_threading.message = mail
-            emails_for_threading.append(email_for_threading)
-
-        threaded_emails = jwzthreading.thread(emails_for_threading)
-
-        # Output
-        for container in threaded_emails:
-            jwzthreading.print_container(container, 0, True)
-
-        def update_threading(threaded_emails, debug=False):
-            log.debug("\n\nEntering update_threading() for %ld mails:" % len(threaded_emails))
-            for container in threaded_emails:
-                message = container['message']
-                # if debug:
-                    #jwzthreading.print_container(container)
-                message_string = "%s %s %d " % (
-                    message.subject, message.message_id,
-                    message.message.id) if message else "null "
-                log.debug("Processing: %s container: %s parent: %s children :%s" % (
-                    message_string, container, container.parent, container.children))
-
-                if(message):
-                    current_parent = message.message.parent
-                    if(current_parent):
-                        db_parent_message_id = current_parent.message_id
-                    else:
-                        db_parent_message_id = None
+    _message_id_re = re.compile(r'<([^<>]+)>')
 
-                    if container.parent:
-                        parent_message = container.parent['message']
-                        if parent_message:
-                            #jwzthreading strips the <>, re-add them
-                            algorithm_parent_message_id = u"<" + parent_message.message_id + u">"
-                        else:
-                            log.warn("Parent was a dummy container, we may need "
-                                     "to handle this case better, as we just "
-                                     "potentially lost sibling relationships")
-                            algorithm_parent_message_id = None
-                    else:
-                        algorithm_parent_message_id = None
-                    log.debug("Current parent from database: " + repr(db_parent_message_id))
-                    log.debug("Current parent from algorithm: " + repr(algorithm_parent_message_id))
-                    log.debug("References: " + repr(message.references))
-                    if algorithm_parent_message_id != db_parent_message_id:
-                        if current_parent == None or isinstance(current_parent, Email):
-                            log.debug("UPDATING PARENT for :" + repr(message.message.message_id))
-                            new_parent = parent_message.message if algorithm_parent_message_id else None
-                            log.debug(repr(new_parent))
-                            message.message.set_parent(new_parent)
-                        else:
-                            log.debug("Skipped reparenting:  the current parent "
-                                      "isn't an email, the threading algorithm only "
-                                      "considers mails")
-                    update_threading(container.children, debug=debug)
-                else:
-                    log.debug("Current message ID: None, was a dummy container")
-                    update_threading(container.children, debug=debug)
-        update_threading(threaded_emails, debug=False)
+    @staticmethod
+    def message_references(headers):
+        """The message-ids an email refers to, from the root of its thread
+        to its direct parent, as given by its References and In-Reply-To
+        headers."""
+        message_id_re = AbstractMailbox._message_id_re
+        references = message_id_re.findall(
+            str(headers.get('References', None) or ''))
+        in_reply_to = message_id_re.findall(
+            str(headers.get('In-Reply-To', None) or ''))
+        if in_reply_to and in_reply_to[0] not in references:
+            references.append(in_reply_to[0])
+        return references
 
     def reprocess_content(self):
         """ Allows re-parsing all content as if it were imported for the first time
@@ -659,7 +713,7 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
                 (email_object, dummy, error) = self.parse_email(blob, email)
 
         with transaction.manager:
-            self.thread_mails(emails)
+            EmailThreader(session, self.discussion_id).rebuild()
 
     def import_content(self, only_new=True):
         from assembl.lib.config import get_config
@@ -710,11 +764,16 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
         etc.)
 
         The reference is La référence est http://tools.ietf.org/html/rfc3834
+
+        Takes the message string, or the result of :py:meth:`parse_message`
+        to avoid a double parse.
         """
-        #TODO:  This is a double-parse, refactor parse_message so we can reuse it
-        if isinstance(message_string, binary_type):
-            message_string = message_string.decode('utf-8')
-        parsed_email = email.message_from_string(message_string)
+        if isinstance(message_string, dict):
+            parsed_email = message_string['headers']
+        else:
+            if isinstance(message_string, binary_type):
+                message_string = message_string.decode('utf-8')
+            parsed_email = email.message_from_string(message_string)
         if parsed_email.get('Return-Path', None) == '<>':
             #TODO:  Check if a report-type=delivery-status; is present,
             # and process the bounce
@@ -758,97 +817,98 @@ class IMAPMailbox(AbstractMailbox):
         'polymorphic_identity': 'source_imapmailbox',
         'with_polymorphic': '*'
     }
+    # How many messages to fetch in one UID FETCH, and import in one commit
+    fetch_batch_size = 200
+
+    def imap_client(self):
+        "An IMAPClient logged into this mailbox, with the folder selected"
+        context = ssl.create_default_context(cafile=certifi.where())
+        client = IMAPClient(
+            self.host, port=self.port, use_uid=True, ssl=self.use_ssl,
+            ssl_context=context)
+        if b'STARTTLS' in client.capabilities():
+            # Always use starttls if server supports it
+            client.starttls(context)
+        client.login(self.username, self.password)
+        client.select_folder(self.folder)
+        return client
+
     @staticmethod
     def do_import_content(mbox, only_new=True):
         mbox = mbox.db.merge(mbox)
         session = mbox.db
         session.add(mbox)
-        if mbox.use_ssl:
-            mailbox = IMAP4_SSL(host=mbox.host.encode('utf-8'), port=mbox.port)
-        else:
-            mailbox = IMAP4(host=mbox.host.encode('utf-8'), port=mbox.port)
-        if 'STARTTLS' in mailbox.capabilities:
-            #Always use starttls if server supports it
-            mailbox.starttls()
-        mailbox.login(mbox.username, mbox.password)
-        mailbox.select(mbox.folder)
-
-        command = "ALL"
-        search_status = None
+        mbox_id = mbox.id
+        discussion_id = mbox.discussion_id
+        mailbox = mbox.imap_client()
+        batch_size = mbox.fetch_batch_size
 
         email_ids = None
         if only_new and mbox.last_imported_email_uid:
-            command = "(UID %s:*)" % mbox.last_imported_email_uid
-
-            search_status, search_result = mailbox.uid('search', None, command)
-            #log.debug("UID searched with: "+ command + ", got result "+repr(search_status)+" and found "+repr(search_result))
-            email_ids = search_result[0].split()
-            #log.debug(email_ids)
-
-        if (only_new and search_status == 'OK' and email_ids
-                and email_ids[0] == mbox.last_imported_email_uid):
-            # Note:  the email_ids[0]==mbox.last_imported_email_uid test is
-            # necessary beacuse according to https://tools.ietf.org/html/rfc3501
-            # seq-range like "3291:* includes the UID of the last message in
-            # the mailbox, even if that value is less than 3291."
-
-            # discard the first message, it should be the last imported email.
-            del email_ids[0]
-        else:
+            email_ids = sorted(mailbox.search(
+                ['UID', '%s:*' % mbox.last_imported_email_uid]))
+            if (email_ids and
+                    str(email_ids[0]) == mbox.last_imported_email_uid):
+                # Note:  the email_ids[0]==mbox.last_imported_email_uid test is
+                # necessary beacuse according to https://tools.ietf.org/html/rfc3501
+                # seq-range like "3291:* includes the UID of the last message in
+                # the mailbox, even if that value is less than 3291."
+
+                # discard the first message, it should be the last imported email.
+                del email_ids[0]
+            else:
+                email_ids = None
+        if email_ids is None:
             # Either:
             # a) we don't import only new messages or
             # b) the message with mbox.last_imported_email_uid hasn't been found
             #    (may have been deleted)
             # In this case we request all messages and rely on duplicate
             # detection
-            command = "ALL"
-            search_status, search_result = mailbox.uid('search', None, command)
-            # log.debug("UID searched with: "+ command + ", got result "+repr(search_status)+" and found "+repr(search_result))
-            assert search_status == 'OK'
-            email_ids = search_result[0].split()
-
-        def import_email(mailbox_obj, email_id):
-            session = mailbox_obj.db
-            #log.debug("running fetch for message: "+email_id)
-            status, message_data = mailbox.uid('fetch', email_id, "(RFC822)")
-            assert status == 'OK'
-
-            #log.debug(repr(message_data))
-            for response_part in message_data:
-                if isinstance(response_part, tuple):
-                    message_string = response_part[1]
-            assert message_string
-            if mailbox_obj.message_ok_to_import(message_string):
-                (email_object, dummy, error) = mailbox_obj.parse_email(message_string)
-                if error:
-                    raise Exception(error)
-                session.add(email_object)
-                translate_content(email_object)  # should delay
-            else:
-                log.info("Skipped message with imap id %s (bounce or vacation message)"% (email_id))
-            #log.debug("Setting mailbox_obj.last_imported_email_uid to "+email_id)
-            mailbox_obj.last_imported_email_uid = email_id
+            email_ids = sorted(mailbox.search(['ALL']))
 
         if len(email_ids):
             log.info("Processing messages from IMAP: %d "% (len(email_ids)))
-            for email_id in email_ids:
-                with transaction.manager:
-                    import_email(mbox, email_id)
         else:
             log.info("No IMAP messages to process")
-
-        discussion_id = mbox.discussion_id
-        mailbox.close()
-        mailbox.logout()
-
-        with transaction.manager:
-            if len(email_ids):
-                #We imported mails, we need to re-thread
-                emails = session.query(Email).filter(
-                    Email.discussion_id == discussion_id,
-                    ).options(joinedload_all(Email.parent))
-
-                AbstractMailbox.thread_mails(emails)
+        try:
+            with MessageParser() as parser:
+                for start in range(0, len(email_ids), batch_size):
+                    uids = email_ids[start:start + batch_size]
+                    # Only one batch of messages is in memory at a time
+                    messages = mailbox.fetch(uids, [b"RFC822"])
+                    present_uids = [uid for uid in uids if uid in messages]
+                    parsed = parser.parse([
+                        messages.pop(uid)[b"RFC822"]
+                        for uid in present_uids])
+                    del messages
+                    with transaction.manager:
+                        mbox = AbstractMailbox.get(mbox_id)
+                        threader = EmailThreader(session, discussion_id)
+                        new_emails = []
+                        for uid, message_data in zip(present_uids, parsed):
+                            if message_data['error']:
+                                raise Exception(message_data['error'])
+                            if mbox.message_ok_to_import(message_data):
+                                (email_object, dummy, error) = mbox.parse_email(
+                                    None, message_data=message_data)
+                                if error:
+                                    raise Exception(error)
+                                session.add(email_object)
+                                threader.add(
+                                    email_object, message_data['references'])
+                                new_emails.append(email_object)
+                            else:
+                                log.info("Skipped message with imap id %s (bounce or vacation message)"% (uid))
+                        # Only the threads of the new emails are affected
+                        threader.apply()
+                        mbox.last_imported_email_uid = str(uids[-1])
+                        session.flush()
+                        new_email_ids = [e.id for e in new_emails]
+                    if new_email_ids:
+                        translate_contents.delay(new_email_ids, True)
+        finally:
+            mailbox.logout()
 
     def make_reader(self):
         from assembl.tasks.imapclient_source_reader import IMAPReader
@@ -918,12 +978,15 @@ class MaildirMailbox(AbstractFilesystemMailbox):
     __mapper_args__ = {
         'polymorphic_identity': 'source_maildirmailbox',
     }
+
+    # How many messages to import in one commit
+    import_batch_size = 200
+
     @staticmethod
     def do_import_content(abstract_mbox, only_new=True):
         abstract_mbox = abstract_mbox.db.merge(abstract_mbox)
         session = abstract_mbox.db
         session.add(abstract_mbox)
-        discussion_id = abstract_mbox.discussion_id
 
         if not os.path.isdir(abstract_mbox.filesystem_path):
             raise "There is no directory at %s" % abstract_mbox.filesystem_path
@@ -947,29 +1010,48 @@ class MaildirMailbox(AbstractFilesystemMailbox):
                 if not tmp_folder_present:
                     os.mkdir(tmp_folder_path)
 
-        mbox = mailbox.Maildir(abstract_mbox.filesystem_path, factory=None, create=False)
-        mails = list(mbox.values())
-        #import pdb; pdb.set_trace()
-        def import_email(abstract_mbox, message_data):
-            session = abstract_mbox.db
-            message_string = message_data.as_string()
-
-            (email_object, dummy, error) = abstract_mbox.parse_email(message_string)
-            if error:
-                raise Exception(error)
-            with transaction.manager:
-                session.add(email_object)
-            abstract_mbox = AbstractMailbox.get(abstract_mbox.id)
-
-        if len(mails):
-            [import_email(abstract_mbox, message_data) for message_data in mails]
-
-            #We imported mails, we need to re-thread
-            with transaction.manager:
-                emails = session.query(Email).filter(
-                        Email.discussion_id == discussion_id,
-                        ).options(joinedload_all(Email.parent))
-                AbstractMailbox.thread_mails(emails)
+        paths = sorted(
+            os.path.join(folder_path, name)
+            for folder_path in (cur_folder_path, new_folder_path)
+            for name in os.listdir(folder_path)
+            if not name.startswith('.'))
+        batch_size = abstract_mbox.import_batch_size
+        seen_hashes = set()
+        with MessageParser() as parser:
+            for start in range(0, len(paths), batch_size):
+                batch = OrderedDict()
+                for message_data in parser.parse_files(
+                        paths[start:start + batch_size]):
+                    if message_data['error']:
+                        raise Exception(message_data['error'])
+                    # Skip copies of the same file, and of the same message
+                    if message_data['content_hash'] in seen_hashes:
+                        continue
+                    seen_hashes.add(message_data['content_hash'])
+                    batch.setdefault(message_data['message_id'], message_data)
+                with transaction.manager:
+                    session.add(abstract_mbox)
+                    session.flush()
+                    existing = set()
+                    if only_new:
+                        existing = {id for (id,) in session.query(
+                            Email.source_post_id).filter(
+                                Email.source_id == abstract_mbox.id,
+                                Email.source_post_id.in_(list(batch)))}
+                    threader = EmailThreader(
+                        session, abstract_mbox.discussion_id)
+                    for message_id, message_data in batch.items():
+                        if message_id in existing:
+                            continue
+                        (email_object, dummy, error) = abstract_mbox.parse_email(
+                            None, message_data=message_data,
+                            check_existing=not only_new)
+                        if error:
+                            raise Exception(error)
+                        session.add(email_object)
+                        threader.add(email_object, message_data['references'])
+                    threader.apply()
+                abstract_mbox = AbstractMailbox.get(abstract_mbox.id)
 
 class Email(ImportedPost):
     """
@@ -1081,3 +1163,187 @@ class Email(ImportedPost):
 
     def get_title(self):
         return self.source.mangle_mail_subject(self.subject)
+
+
+class EmailThreadContainer(Base):
+    """A container of the JWZ threading algorithm: a message-id of the
+    discussion, with its email if imported, or only seen in the references
+    of other emails.
+
+    Kept so new emails can be threaded without re-threading the whole
+    discussion; see :py:class:`EmailThreader`."""
+    __tablename__ = "email_thread_container"
+    __table_args__ = (
+        UniqueConstraint('discussion_id', 'message_id'),)
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False)
+    message_id = Column(CoerceUnicode(), nullable=False)
+    email_id = Column(Integer, ForeignKey(
+        Email.id, ondelete='SET NULL', onupdate='CASCADE'), index=True)
+    parent_id = Column(Integer, ForeignKey(
+        'email_thread_container.id', ondelete='SET NULL',
+        onupdate='CASCADE'), index=True)
+
+    email = relationship(Email)
+    parent = relationship(
+        'EmailThreadContainer', remote_side=[id], backref='children')
+
+
+class EmailThreader(object):
+    """Threads the emails of a discussion with the JWZ algorithm,
+    incrementally: only the containers of the new emails and of their
+    references are loaded, and only the emails below the containers whose
+    parent changed are re-parented.
+
+    Each email goes under the closest email above its container; like the
+    previous full re-threading, it leaves alone emails that were moved
+    under a post that is not an email."""
+
+    def __init__(self, db, discussion_id):
+        self.db = db
+        self.discussion_id = discussion_id
+        self.containers = {}
+        self.changed = set()
+        # Whether self.containers holds all containers of the discussion
+        self.complete = False
+
+    def _load(self, message_ids):
+        missing = [id for id in message_ids if id not in self.containers]
+        if not missing:
+            return
+        if not self.complete:
+            for container in self.db.query(EmailThreadContainer).filter(
+                    EmailThreadContainer.discussion_id == self.discussion_id,
+                    EmailThreadContainer.message_id.in_(missing)):
+                self.containers[container.message_id] = container
+            missing = [id for id in missing if id not in self.containers]
+            if not missing:
+                return
+            # Emails imported before this index existed
+            emails = {email.source_post_id: email for email in self.db.query(
+                Email).filter(
+                    Email.discussion_id == self.discussion_id,
+                    Email.source_post_id.in_(missing))}
+        else:
+            emails = {}
+        for message_id in missing:
+            container = EmailThreadContainer(
+                discussion_id=self.discussion_id, message_id=message_id,
+                email=emails.get(message_id, None))
+            self.db.add(container)
+            self.containers[message_id] = container
+
+    @staticmethod
+    def _is_ancestor(ancestor, container):
+        "Whether ancestor is that container or one of its ancestors"
+        while container is not None:
+            if container is ancestor:
+                return True
+            container = container.parent
+        return False
+
+    def _set_parent(self, container, parent):
+        if container.parent is not parent:
+            container.parent = parent
+            self.changed.add(container)
+
+    def add(self, email, references):
+        """Place a new email in its thread.
+
+        :param references: as given by
+            :py:meth:`AbstractMailbox.message_references`"""
+        message_id = email.source_post_id
+        references = [id for id in references if id != message_id]
+        self._load(references + [message_id])
+        container = self.containers[message_id]
+        if container.email is not None and container.email is not email:
+            log.warning("Duplicate message-id: %s", message_id)
+            return
+        if container.email is None:
+            # Replies imported earlier hang below this placeholder
+            # and must now go under the email
+            self.changed.update(container.children)
+        container.email = email
+        self.changed.add(container)
+        # Link the references together, without changing existing links
+        parent = None
+        for reference in references:
+            reference_container = self.containers[reference]
+            if (parent is not None and reference_container.parent is None
+                    and not self._is_ancestor(reference_container, parent)):
+                self._set_parent(reference_container, parent)
+            parent = reference_container
+        # The email itself goes under its last reference
+        if parent is not None and self._is_ancestor(container, parent):
+            parent = None
+        self._set_parent(container, parent)
+
+    @staticmethod
+    def _email_containers_below(container):
+        """The container if it has an email, or the closest containers
+        with an email below it."""
+        if container.email is not None:
+            return [container]
+        containers = []
+        for child in container.children:
+            containers.extend(
+                EmailThreader._email_containers_below(child))
+        return containers
+
+    @staticmethod
+    def _email_above(container):
+        container = container.parent
+        while container is not None and container.email is None:
+            container = container.parent
+        return container.email if container is not None else None
+
+    @staticmethod
+    def _depth(container):
+        depth = 0
+        while container.parent is not None:
+            container = container.parent
+            depth += 1
+        return depth
+
+    def apply(self):
+        "Re-parent the emails whose threads changed since the last call"
+        containers = set()
+        for container in self.changed:
+            containers.update(self._email_containers_below(container))
+        self.changed = set()
+        # Parents first
+        for container in sorted(containers, key=self._depth):
+            email = container.email
+            parent = self._email_above(container)
+            current_parent = email.parent
+            if current_parent is parent:
+                continue
+            if current_parent is None or isinstance(current_parent, Email):
+                log.debug("Updating parent of %s", email.message_id)
+                email.set_parent(parent)
+            else:
+                log.debug("Skipped reparenting of %s: the current parent "
+                          "isn't an email", email.message_id)
+
+    def rebuild(self):
+        "Thread all the emails of the discussion again, from their headers"
+        self.db.query(EmailThreadContainer).filter_by(
+            discussion_id=self.discussion_id).delete(
+            synchronize_session=False)
+        self.containers = {}
+        self.changed = set()
+        self.complete = True
+        emails = self.db.query(Email).filter(
+            Email.discussion_id == self.discussion_id
+        ).order_by(Email.creation_date, Email.id).options(
+            undefer(Email.imported_blob))
+        parser = HeaderParser()
+        for email_ in emails:
+            headers = parser.parsestr(
+                AbstractMailbox.guess_encoding(email_.imported_blob))
+            self.add(email_, AbstractMailbox.message_references(headers))
+        self.apply()
+        self.complete = False
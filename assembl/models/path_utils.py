@@ -5,24 +5,34 @@ from builtins import range
 from builtins import object
 from functools import total_ordering
 from collections import defaultdict
+from itertools import chain
 from bisect import bisect_right
 
 from future.utils import as_native_str
-from sqlalchemy import String
-from sqlalchemy.orm import (with_polymorphic, aliased)
+from sqlalchemy import String, event, inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import with_polymorphic
+from sqlalchemy.orm.session import object_session
 from sqlalchemy.sql.expression import or_, union, except_
 from sqlalchemy.sql.functions import count
 
+from ..lib.sqla import get_session_maker
 from .idea_content_link import (
-    IdeaContentLink, IdeaContentPositiveLink, IdeaContentNegativeLink)
+    IdeaContentLink, IdeaContentPositiveLink, IdeaContentNegativeLink,
+    DiscussionIdeaContentLinks)
 from .post import (
     Post, Content, SynthesisPost,
     countable_publication_states, deleted_publication_states)
 from .annotation import Webpage
-from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
+from .idea import (
+    IdeaVisitor, Idea, IdeaLink, IdeaPostCount, IdeaHierarchy)
 from .discussion import Discussion
 from .action import ViewPost
 
+# Namespace of the advisory locks that serialize the updates of
+# the stored post counts of each discussion
+IDEA_POST_COUNT_LOCK = 0x1dea
+
 # TODO: Write a discussion structure cache manager.
 # This will have caches of parent, children, counts, etc. at need
 # and understand the invalidation relationships
@@ -477,9 +487,45 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         return q
 
 
+class PostPathIndex(object):
+    """Finds the ideas that include a post, given the globally complete
+    PostPathLocalCollections of a PostPathCombiner, without a query.
+
+    A post is included in an idea if the longest of the post's ancestry
+    paths found in that idea's collection is positive."""
+    def __init__(self, paths):
+        self.by_path = defaultdict(list)
+        for idea_id, collection in paths.items():
+            for path in collection.paths:
+                self.by_path[path.post_path].append((idea_id, path.positive))
+
+    def ideas_including(self, post_path):
+        "ids of the ideas including the post whose path is given"
+        included = set()
+        decided = set()
+        end = len(post_path)
+        while end > 0:
+            level = {}
+            for idea_id, positive in self.by_path.get(post_path[:end], ()):
+                if idea_id not in decided:
+                    # negative paths win over positive paths at same level
+                    level[idea_id] = level.get(idea_id, True) and positive
+            for idea_id, positive in level.items():
+                decided.add(idea_id)
+                if positive:
+                    included.add(idea_id)
+            end = post_path.rfind(',', 0, end - 1) + 1
+        return included
+
+
 class PostPathCounter(PostPathCombiner):
-    "Adds the ability to do post counts to PostPathCombiner."
-    def __init__(self, discussion, user_id=None, calc_subset=None):
+    """Adds the ability to do post counts to PostPathCombiner.
+
+    Ideas in stored_counts (idea_id -> (num_posts, num_contributors))
+    will not be counted with a query; their read counts are obtained
+    for all ideas at once."""
+    def __init__(self, discussion, user_id=None, calc_subset=None,
+                 stored_counts=None):
         super(PostPathCounter, self).__init__(discussion)
         self.counts = {}
         self.viewed_counts = {}
@@ -487,6 +533,8 @@ class PostPathCounter(PostPathCombiner):
         self.contributor_counts = {}
         self.user_id = user_id
         self.calc_subset = calc_subset
+        self.stored_counts = stored_counts or {}
+        self._read_counts_by_idea = None
 
     def copy_result(self, idea_id, parent_result, child_result):
         # When the parent has no information, and can get it from a single child
@@ -542,12 +590,18 @@ class PostPathCounter(PostPathCombiner):
             self.contributor_counts[idea_id] = 0
             self.viewed_counts[idea_id] = 0
             return (0, 0, 0)
-        q = path_collection.as_clause(
-            self.discussion.db, self.discussion.id, user_id=self.user_id,
-            include_deleted=None)
-        (
-            post_count, contributor_count, viewed_count
-        ) = self.get_counts_for_query(q)
+        stored = self.stored_counts.get(idea_id, None)
+        if stored is not None:
+            post_count, contributor_count = stored
+            viewed_count = (self.get_read_counts_by_idea()[idea_id]
+                            if self.user_id else 0)
+        else:
+            q = path_collection.as_clause(
+                self.discussion.db, self.discussion.id, user_id=self.user_id,
+                include_deleted=None)
+            (
+                post_count, contributor_count, viewed_count
+            ) = self.get_counts_for_query(q)
         (
             path_collection.count,
             path_collection.contributor_count,
@@ -560,6 +614,36 @@ class PostPathCounter(PostPathCombiner):
         self.contributor_counts[idea_id] = contributor_count
         return (post_count, contributor_count, viewed_count)
 
+    def get_read_counts_by_idea(self):
+        """Count the posts read by the user in each idea, in one query.
+
+        Only valid once the visit is over."""
+        if self._read_counts_by_idea is None:
+            index = PostPathIndex(self.paths)
+            read_counts = defaultdict(int)
+            q = self.discussion.db.query(Post.ancestry, Post.id).join(
+                ViewPost,
+                (ViewPost.post_id == Post.id)
+                & (ViewPost.tombstone_date == None)
+                & (ViewPost.actor_id == self.user_id)
+            ).filter(
+                Post.discussion_id == self.discussion.id,
+                Post.hidden == False,
+                Post.publication_state.in_(countable_publication_states)
+            ).distinct()
+            for (ancestry, post_id) in q:
+                for idea_id in index.ideas_including(
+                        "%s%d," % (ancestry or '', post_id)):
+                    read_counts[idea_id] += 1
+            self._read_counts_by_idea = read_counts
+        return self._read_counts_by_idea
+
+    def forget_stored_counts(self, idea_ids):
+        "These ideas' stored counts are stale, count them with a query."
+        for idea_id in idea_ids:
+            if self.stored_counts.pop(idea_id, None) is not None:
+                self.counts.pop(idea_id, None)
+
     def get_orphan_counts(self, include_deleted=False):
         return self.get_counts_for_query(
             self.orphan_clause(self.user_id, include_deleted=include_deleted))
@@ -569,7 +653,8 @@ class PostPathCounter(PostPathCombiner):
             idea_id = idea_id.id
         result = super(PostPathCounter, self).end_visit(
             idea_id, level, result, child_results)
-        if self.calc_subset is None or (idea_id in self.calc_subset):
+        if (self.calc_subset is None or (idea_id in self.calc_subset)) \
+                and idea_id not in self.stored_counts:
             self.get_counts(idea_id)
         return result
 
@@ -581,10 +666,10 @@ class DiscussionGlobalData(object):
         self.db = db
         self.user_id = user_id
         self._discussion = discussion
-        self._parent_dict = None
-        self._children_dict = None
+        self._hierarchy = None
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._idea_content_links = None
 
     @property
     def discussion(self):
@@ -592,49 +677,27 @@ class DiscussionGlobalData(object):
             self._discussion = Discussion.get(self.discussion_id)
         return self._discussion
 
+    @property
+    def hierarchy(self):
+        """The :py:class:`assembl.models.idea.IdeaHierarchy` snapshot"""
+        if self._hierarchy is None:
+            self._hierarchy = IdeaHierarchy.get(self.db, self.discussion_id)
+        return self._hierarchy
+
     @property
     def parent_dict(self):
         """dictionary child_idea.id -> parent_idea.id.
 
         TODO: Make it dict(id->id[]) for multiparenting"""
-        if self._parent_dict is None:
-            source = aliased(Idea, name="source")
-            target = aliased(Idea, name="target")
-            self._parent_dict = dict(self.db.query(
-                IdeaLink.target_id, IdeaLink.source_id
-                ).join(source, source.id == IdeaLink.source_id
-                ).join(target, target.id == IdeaLink.target_id
-                ).filter(
-                source.discussion_id == self.discussion_id,
-                IdeaLink.tombstone_date == None,
-                source.tombstone_date == None,
-                target.tombstone_date == None,
-                target.discussion_id == self.discussion_id))
-        return self._parent_dict
+        return self.hierarchy.parent
 
     def idea_ancestry(self, idea_id):
         """generator of ids of ancestor ideas"""
-        while idea_id:
-            yield idea_id
-            idea_id = self.parent_dict.get(idea_id, None)
+        return self.hierarchy.ancestors(idea_id)
 
     @property
     def children_dict(self):
-        if self._children_dict is None:
-            if not self.parent_dict:
-                (root_id,) = self.db.query(
-                    RootIdea.id).filter_by(
-                    discussion_id=self.discussion_id).first()
-                self._children_dict = {None: (root_id,), root_id: ()}
-                return self._children_dict
-            children = defaultdict(list)
-            for child, parent in self.parent_dict.items():
-                children[parent].append(child)
-            root = set(children.keys()) - set(self.parent_dict.keys())
-            # assert len(root) == 1
-            children[None] = [root.pop()]
-            self._children_dict = children
-        return self._children_dict
+        return self.hierarchy.children
 
     @property
     def post_path_collection_raw(self):
@@ -642,23 +705,232 @@ class DiscussionGlobalData(object):
             self._post_path_collection_raw = PostPathGlobalCollection(self.discussion)
         return self._post_path_collection_raw
 
+    @property
+    def idea_ids(self):
+        "ids of the ideas in the discussion's hierarchy"
+        return set(self.parent_dict).union(self.children_dict[None])
+
+    def get_stored_counts(self):
+        return {
+            idea_id: (num_posts, num_contributors)
+            for (idea_id, num_posts, num_contributors) in self.db.query(
+                IdeaPostCount.idea_id, IdeaPostCount.num_posts,
+                IdeaPostCount.num_contributors
+            ).filter_by(discussion_id=self.discussion_id)}
+
     def post_path_counter(self, user_id, calc_all):
         if (self._post_path_counter is None
                 or not isinstance(self._post_path_counter, PostPathCounter)):
             collection = self.post_path_collection_raw
             counter = PostPathCounter(
-                self.discussion, user_id, None if calc_all else ())
+                self.discussion, user_id, None if calc_all else (),
+                self.get_stored_counts())
             counter.init_from(self.post_path_collection_raw)
             Idea.visit_idea_ids_depth_first(
                 counter, self.discussion_id, self.children_dict)
+            pending = pending_count_changes(self.db)
+            for key in (self.discussion_id, None):
+                if key in pending:
+                    counter.forget_stored_counts(
+                        self.ideas_affected_by(counter, pending[key]))
             self._post_path_counter = counter
         return self._post_path_counter
 
+    def ideas_affected_by(self, counter, changes):
+        """ids of the ideas whose counts may be changed by the
+        :py:class:`IdeaPostCountChanges`, given a visited counter."""
+        idea_ids = set()
+        for idea_id in changes.idea_ids:
+            idea_ids.update(self.idea_ancestry(idea_id))
+        if changes.post_paths:
+            index = PostPathIndex(counter.paths)
+            for post_path in changes.post_paths:
+                idea_ids.update(index.ideas_including(post_path))
+        return idea_ids
+
+    def lock_stored_counts(self):
+        """Wait for other transactions updating the stored counts of
+        this discussion; the lock is released at the end of the
+        transaction."""
+        self.db.execute(
+            "SELECT pg_advisory_xact_lock(%d, %d)" % (
+                IDEA_POST_COUNT_LOCK, self.discussion_id)).first()
+
+    def update_stored_counts(self, changes=None):
+        """Recompute the stored counts of ideas affected by changes,
+        or of all the ideas of the discussion.
+
+        Updates of a discussion's counts are serialized, so the last
+        one counts the posts of all committed transactions."""
+        self.lock_stored_counts()
+        counter = PostPathCounter(self.discussion, None, ())
+        counter.init_from(self.post_path_collection_raw)
+        Idea.visit_idea_ids_depth_first(
+            counter, self.discussion_id, self.children_dict)
+        live_ids = self.idea_ids
+        stale = self.db.query(IdeaPostCount).filter(
+            IdeaPostCount.discussion_id == self.discussion_id)
+        if changes is None:
+            idea_ids = live_ids
+            stale = stale.filter(~IdeaPostCount.idea_id.in_(live_ids))
+        else:
+            idea_ids = self.ideas_affected_by(counter, changes)
+            dead_ids = idea_ids - live_ids
+            stale = stale.filter(IdeaPostCount.idea_id.in_(dead_ids)) \
+                if dead_ids else None
+        if stale is not None:
+            stale.delete(synchronize_session=False)
+        rows = []
+        for idea_id in idea_ids & live_ids:
+            (num_posts, num_contributors, _) = counter.get_counts(idea_id)
+            rows.append(dict(
+                idea_id=idea_id, discussion_id=self.discussion_id,
+                num_posts=num_posts, num_contributors=num_contributors))
+        if rows:
+            upsert = pg_insert(IdeaPostCount.__table__)
+            self.db.execute(upsert.on_conflict_do_update(
+                index_elements=[IdeaPostCount.__table__.c.idea_id],
+                set_=dict(
+                    num_posts=upsert.excluded.num_posts,
+                    num_contributors=upsert.excluded.num_contributors)),
+                rows)
+
     def reset_hierarchy(self):
-        self._parent_dict = None
-        self._children_dict = None
+        self._hierarchy = None
         self._post_path_counter = None
 
+    def idea_content_links(self, link_ids=()):
+        """The :py:class:`DiscussionIdeaContentLinks` of the discussion,
+        kept as long as this object unless they lack one of link_ids."""
+        links = self._idea_content_links
+        if links is None or not links.knows(link_ids):
+            links = self._idea_content_links = DiscussionIdeaContentLinks.get(
+                self.db, self.discussion_id, link_ids)
+        return links
+
     def reset_content_links(self):
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._idea_content_links = None
+
+
+class IdeaPostCountChanges(object):
+    "Changes that may affect the stored post counts of ideas."
+    __slots__ = ("idea_ids", "post_paths")
+
+    def __init__(self):
+        self.idea_ids = set()
+        self.post_paths = set()
+
+
+def pending_count_changes(session):
+    """IdeaPostCountChanges not yet reflected in the stored counts.
+
+    Changes to posts are kept by discussion id; changes to ideas
+    under None, as looking up their discussion during a flush
+    could load deleted objects."""
+    return session.info.setdefault('idea_post_count_changes', {})
+
+
+def record_count_change(target, discussion_id=None, idea_ids=(),
+                        post_paths=()):
+    session = object_session(target)
+    if session is None:
+        return
+    changes = pending_count_changes(session).setdefault(
+        discussion_id, IdeaPostCountChanges())
+    changes.idea_ids.update(id for id in idea_ids if id)
+    changes.post_paths.update(post_paths)
+    discussion_data = Idea.get_discussion_data(discussion_id, False)
+    if discussion_data is not None:
+        discussion_data.reset_hierarchy()
+        discussion_data.reset_content_links()
+
+
+def _old_and_new(target, attribute):
+    history = inspect(target).attrs[attribute].history
+    return set(chain(history.deleted or (), history.unchanged or (),
+                     history.added or ()))
+
+
+@event.listens_for(Post, 'after_insert', propagate=True)
+@event.listens_for(Post, 'after_delete', propagate=True)
+def post_count_listener(mapper, connection, target):
+    record_count_change(target, target.discussion_id, post_paths=[
+        "%s%d," % (target.ancestry or '', target.id)])
+
+
+@event.listens_for(Post, 'after_update', propagate=True)
+def post_update_count_listener(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[attribute].history.has_changes() for attribute in (
+            'ancestry', 'publication_state', 'hidden', 'creator_id')):
+        return
+    record_count_change(target, target.discussion_id, post_paths=[
+        "%s%d," % (ancestry or '', target.id)
+        for ancestry in _old_and_new(target, 'ancestry')])
+
+
+@event.listens_for(IdeaContentLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_update', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_delete', propagate=True)
+def idea_content_link_count_listener(mapper, connection, target):
+    record_count_change(target, idea_ids=_old_and_new(target, 'idea_id'))
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_link_count_listener(mapper, connection, target):
+    record_count_change(target, idea_ids=_old_and_new(target, 'source_id'))
+
+
+def pending_count_updates(session):
+    """Take the :py:class:`IdeaPostCountChanges` of the session,
+    by discussion id, now that the discussion of changed ideas can
+    be looked up."""
+    changes_by_discussion = session.info.pop('idea_post_count_changes', {})
+    idea_changes = changes_by_discussion.pop(None, None)
+    if idea_changes and idea_changes.idea_ids:
+        for (discussion_id,) in session.query(
+                Idea.discussion_id.distinct()).filter(
+                Idea.id.in_(idea_changes.idea_ids)):
+            changes_by_discussion.setdefault(
+                discussion_id, IdeaPostCountChanges()
+            ).idea_ids.update(idea_changes.idea_ids)
+    return changes_by_discussion
+
+
+@event.listens_for(get_session_maker(), 'before_commit')
+def record_idea_post_count_updates(session):
+    """Keep the changes of this transaction that affect the stored
+    counts of ideas, to be applied once it is committed."""
+    if not session.info.get('idea_post_count_changes'):
+        return
+    session.flush()
+    updates = session.info.setdefault('idea_post_count_updates', {})
+    for discussion_id, changes in pending_count_updates(session).items():
+        update = updates.setdefault(discussion_id, IdeaPostCountChanges())
+        update.idea_ids.update(changes.idea_ids)
+        update.post_paths.update(changes.post_paths)
+
+
+@event.listens_for(get_session_maker(), 'after_commit')
+def update_idea_post_counts(session):
+    """Recount the ideas affected by the committed transaction in
+    :py:func:`assembl.tasks.idea_post_counts.update_idea_post_counts`,
+    off the request. Stored counts may lag behind until it has run."""
+    updates = session.info.pop('idea_post_count_updates', None)
+    if not updates:
+        return
+    from ..tasks.idea_post_counts import (
+        update_idea_post_counts as update_task)
+    for discussion_id, changes in updates.items():
+        update_task.delay(
+            discussion_id, list(changes.idea_ids), list(changes.post_paths))
+
+
+@event.listens_for(get_session_maker(), 'after_rollback')
+def forget_idea_post_count_changes(session):
+    session.info.pop('idea_post_count_changes', None)
+    session.info.pop('idea_post_count_updates', None)
@@ -21,12 +21,15 @@ from sqlalchemy import (
     Index,
     or_,
     event,
-    func
+    func,
+    inspect,
+    literal,
 )
 from sqlalchemy.orm import (
-    relationship, backref, deferred, column_property, with_polymorphic)
+    relationship, backref, deferred)
+from sqlalchemy.orm.attributes import set_committed_value
 
-from ..lib.sqla import CrudOperation, DuplicateHandling
+from ..lib.sqla import CrudOperation, DuplicateHandling, SerializedChange
 from ..lib.decl_enums import DeclEnum
 from ..semantic.virtuoso_mapping import QuadMapPatternS
 from ..lib.sqla_types import CoerceUnicode
@@ -86,6 +89,32 @@ countable_publication_states = {
 }
 
 
+class PostAncestryChange(SerializedChange):
+    """The new ancestry of a post whose thread was moved, sent on the
+    changes websocket without loading the post; see
+    :py:meth:`Post._set_ancestry`."""
+
+    def __init__(self, post_id, typename, ancestry):
+        self.uri = Content.uri_generic(post_id)
+        self.typename = typename
+        self.ancestry = ancestry
+
+    def generic_json(self, *vargs, **kwargs):
+        return {
+            "@type": self.typename,
+            "@id": self.uri,
+            "ancestors": [Content.uri_generic(int(ancestor_id))
+                          for ancestor_id in self.ancestry.split(',')
+                          if ancestor_id],
+        }
+
+    def send_to_changes(self, connection, operation=CrudOperation.UPDATE,
+                        discussion_id=None, view_def="changes"):
+        # The full json of the post prevails if it also changed
+        connection.info.setdefault('cdict', {}).setdefault(
+            (self.uri, view_def), (discussion_id, self))
+
+
 class Post(Content):
     """
     A Post represents input into the broader discussion taking place on
@@ -149,11 +178,6 @@ class Post(Content):
         backref=backref('posts_moderated'),
     )
 
-    # All the idea content links of the ancestors of this post
-    idea_content_links_above_post = column_property(
-        func.idea_content_links_above_post(id),
-        deferred=True, expire_on_flush=False)
-
     @classmethod
     def special_quad_patterns(cls, alias_maker, discussion_id):
         # Don't we need a recursive alias for this? It seems not.
@@ -273,13 +297,62 @@ class Post(Content):
         else:
             return body
 
-    def _set_ancestry(self, new_ancestry):
+    def _rebuild_ancestry(self, new_ancestry):
+        """Set the ancestry of this post and its descendants by walking
+        the parent links. Slow, but does not trust the stored ancestry
+        of descendants, e.g. in copied posts."""
         self.ancestry = new_ancestry
 
         descendant_ancestry = "%s%d," % (
             self.ancestry, self.id)
         for descendant in self.get_descendants():
-            descendant._set_ancestry(descendant_ancestry)
+            descendant._rebuild_ancestry(descendant_ancestry)
+
+    def _set_ancestry(self, new_ancestry):
+        """Set the ancestry of this post, and replace the ancestry prefix
+        of all its descendants with a single UPDATE."""
+        from .path_utils import record_count_change
+        old_prefix = "%s%d," % (self.ancestry or '', self.id)
+        new_prefix = "%s%d," % (new_ancestry, self.id)
+        self.ancestry = new_ancestry
+        if old_prefix == new_prefix:
+            return
+        db = self.db
+        db.flush()
+        post_table = Post.__table__
+        content_table = Content.__table__
+        updated = db.execute(post_table.update().where(
+            post_table.c.ancestry.like(old_prefix + '%')
+        ).where(content_table.c.id == post_table.c.id).values(
+            ancestry=literal(new_prefix) + func.substr(
+                post_table.c.ancestry, len(old_prefix) + 1)
+        ).returning(
+            post_table.c.id, post_table.c.ancestry, content_table.c.type
+        )).fetchall()
+        if not updated:
+            return
+        from .idea_content_link import PostIdeaContentLink
+        PostIdeaContentLink.rebuild(
+            db, [post_id for (post_id, _, _) in updated])
+        # Keep loaded descendants in sync without making them dirty,
+        # and send the new ancestries without loading the others.
+        mapper = inspect(Post)
+        polymorphic_map = mapper.polymorphic_map
+        connection = db.connection()
+        post_paths = []
+        for (post_id, ancestry, type) in updated:
+            post_paths.append("%s%d," % (ancestry, post_id))
+            post_paths.append("%s%s%d," % (
+                old_prefix, ancestry[len(new_prefix):], post_id))
+            descendant = db.identity_map.get(
+                mapper.identity_key_from_primary_key((post_id,)))
+            if descendant is not None:
+                set_committed_value(descendant, 'ancestry', ancestry)
+            PostAncestryChange(
+                post_id, polymorphic_map[type].class_.external_typename(),
+                ancestry).send_to_changes(connection, CrudOperation.UPDATE,
+                                          self.discussion_id)
+        record_count_change(self, self.discussion_id, post_paths=post_paths)
 
     def set_parent(self, parent):
         self.parent = parent
@@ -314,20 +387,17 @@ class Post(Content):
         ancestor_ids = [
             int(ancestor_id) \
             for ancestor_id \
-            in self.ancestry.split(',') \
+            in (self.ancestry or '').split(',') \
             if ancestor_id
         ]
         return ancestor_ids
 
-    def ancestors(self):
+    def ancestors(self, loader=None):
+        """The ancestors of this post, from the root down.
 
-        ancestors = [
-            Post.get(ancestor_id) \
-            for ancestor_id \
-            in self.ancestor_ids
-        ]
-
-        return ancestors
+        Uses the request's :py:class:`PostAncestorLoader` by default."""
+        loader = loader or PostAncestorLoader.for_request(self.db)
+        return loader.ancestors(self)
 
     def prefetch_descendants(self):
         pass  #TODO
@@ -439,100 +509,38 @@ class Post(Content):
 
     def indirect_idea_content_links_without_cache(self):
         "Return all ideaContentLinks related to this post or its ancestors"
-        from .idea_content_link import IdeaContentLink
-        ancestors = [int(a) for a in self.ancestry.split(",") if a]
-        ancestors.append(self.id)
-        return self.db.query(IdeaContentLink).filter(
-            IdeaContentLink.content_id.in_(ancestors)).all()
-
-    def filter_idea_content_links_r(self, idea_content_links):
-        """Exclude positive links if a negative link points from the same idea
-        to the same post or a post below.
-
-        Works on dict representations of IdeaContentLink, a version with instances is TODO."""
-        from .idea_content_link import IdeaContentNegativeLink
-        from collections import defaultdict
-        icnl_polymap = {
-            cls.external_typename()
-            for cls in IdeaContentNegativeLink.get_subclasses()}
-
-        neg_links = [icl for icl in idea_content_links
-                     if icl["@type"] in icnl_polymap]
-        if not neg_links:
-            return idea_content_links
-        pos_links = [icl for icl in idea_content_links
-                     if icl["@type"] not in icnl_polymap]
-        links = []
-        ancestor_ids = self.ancestry.split(",")
-        ancestor_ids = [int(x or 0) for x in ancestor_ids]
-        ancestor_ids[-1] = self.id
-        neg_link_post_ids = defaultdict(list)
-        for icl in neg_links:
-            neg_link_post_ids[icl["idIdea"]].append(
-                self.get_database_id(icl["idPost"]))
-        for link in pos_links:
-            idea_id = link["idIdea"]
-            if idea_id in neg_link_post_ids:
-                pos_post_id = self.get_database_id(link["idPost"])
-                for neg_post_id in neg_link_post_ids[idea_id]:
-                    if (ancestor_ids.index(neg_post_id) >
-                            ancestor_ids.index(pos_post_id)):
-                        break
-                else:
-                    links.append(link)
-            else:
-                links.append(link)
-        links.extend(neg_links)
-        return links
+        from .idea_content_link import IdeaContentLink, PostIdeaContentLink
+        return self.db.query(IdeaContentLink).join(
+            PostIdeaContentLink,
+            PostIdeaContentLink.idea_content_link_id == IdeaContentLink.id
+        ).filter(PostIdeaContentLink.post_id == self.id).all()
 
     def indirect_idea_content_links_with_cache(
-            self, links_above_post=None, filter=True):
-        "Return all ideaContentLinks related to this post or its ancestors"
-        # WIP: idea_content_links_above_post is still loaded separately
-        # despite not being deferred. Deferring it hits a sqlalchemy bug.
-        # Still appreciable performance gain using it instead of the orm,
-        # and the ICL cache below.
-        # TODO: move in path_utils?
-        links_above_post = (self.idea_content_links_above_post
-                            if links_above_post is None else links_above_post)
-        if not links_above_post:
-            return []
-        from pyramid.threadlocal import get_current_request
-        from .idea_content_link import IdeaContentLink
+            self, link_ids=None, filter=True, links=None):
+        """Return the json of all ideaContentLinks related to this post
+        or its ancestors, from the discussion's link cache.
+
+        :param link_ids: the ids of those links, if known, as given by
+            :py:meth:`PostIdeaContentLink.link_ids_by_post`
+        :param filter: exclude the positive links cut off by a negative
+            link below them
+        :param links: the discussion's
+            :py:class:`assembl.models.idea_content_link.DiscussionIdeaContentLinks`,
+            if already obtained; else those of the request's
+            :py:class:`assembl.models.path_utils.DiscussionGlobalData`"""
+        from .idea_content_link import PostIdeaContentLink
         from .idea import Idea
-        from .idea_content_link import Extract
-        icl_polymap = IdeaContentLink.__mapper__.polymorphic_map
-        request = get_current_request()
-        if getattr(request, "_idea_content_link_cache2", None) is None:
-            if getattr(request, "_idea_content_link_cache1", None) is None:
-                icl = with_polymorphic(IdeaContentLink, IdeaContentLink)
-                co = with_polymorphic(Content, Content)
-                request._idea_content_link_cache1 = {x[0]: x for x in self.db.query(
-                    icl.id, icl.idea_id, icl.content_id, icl.creator_id, icl.type,
-                    icl.creation_date, icl.extract_id).join(co).filter(
-                    co.discussion_id == self.discussion_id)}
-            request._idea_content_link_cache2 = {}
-
-        def icl_representation(id):
-            if id not in request._idea_content_link_cache2:
-                data = request._idea_content_link_cache1.get(id, None)
-                if data is None:
-                    return None
-                request._idea_content_link_cache2[id] = {
-                    "@id": IdeaContentLink.uri_generic(data[0]),
-                    "idIdea": Idea.uri_generic(data[1]),
-                    "idPost": Content.uri_generic(data[2]),
-                    "idCreator": AgentProfile.uri_generic(data[3]),
-                    "@type": icl_polymap[data[4]].class_.external_typename(),
-                    "created": data[5].isoformat() + "Z",
-                    "idExcerpt": Extract.uri_generic(data[6]) if data[6] else None,
-                }
-            return request._idea_content_link_cache2[id]
-        icls = [icl_representation(int(id)) for id in
-                links_above_post.strip(',').split(',')]
+        if link_ids is None:
+            link_ids = PostIdeaContentLink.link_ids_by_post(
+                self.db, (self.id,)).get(self.id, ())
+        if not link_ids:
+            return []
+        if links is None or not links.knows(link_ids):
+            links = Idea.get_discussion_data(
+                self.discussion_id).idea_content_links(link_ids)
         if filter:
-            icls = self.filter_idea_content_links_r(icls)
-        return icls
+            link_ids = links.filter(link_ids, self)
+        return links.representations(link_ids)
 
     def language_priors(self, translation_service):
         from .auth import User, UserLanguagePreferenceCollection
@@ -619,6 +627,50 @@ def orm_insert_listener(mapper, connection, target):
 event.listen(Post, 'after_insert', orm_insert_listener, propagate=True)
 
 
+class PostAncestorLoader(object):
+    """Loads the ancestors of posts, many posts at a time.
+
+    Posts are kept by id, so ancestors shared by the posts of a thread
+    are loaded once. :py:meth:`for_request` shares a loader across the
+    current request."""
+
+    def __init__(self, db):
+        self.db = db
+        self.posts_by_id = {}
+
+    @classmethod
+    def for_request(cls, db, request=None):
+        from pyramid.threadlocal import get_current_request
+        request = request or get_current_request()
+        if request is None:
+            return cls(db)
+        loader = getattr(request, '_post_ancestor_loader', None)
+        if loader is None or loader.db is not db:
+            loader = request._post_ancestor_loader = cls(db)
+        return loader
+
+    def load(self, posts, options=()):
+        """Load the ancestors of all those posts in a single query,
+        with the given query options."""
+        posts_by_id = self.posts_by_id
+        missing = set()
+        for post in posts:
+            posts_by_id[post.id] = post
+            missing.update(post.ancestor_ids())
+        missing.difference_update(posts_by_id)
+        if missing:
+            query = self.db.query(Post).filter(Post.id.in_(missing))
+            for post in query.options(*options):
+                posts_by_id[post.id] = post
+
+    def ancestors(self, post):
+        self.load((post,))
+        posts_by_id = self.posts_by_id
+        return [posts_by_id[ancestor_id]
+                for ancestor_id in post.ancestor_ids()
+                if ancestor_id in posts_by_id]
+
+
 class LocalPost(Post):
     """
     A Post that originated directly on the platform (wasn't imported from elsewhere).
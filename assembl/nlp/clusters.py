@@ -9,16 +9,21 @@ from builtins import str as new_str
 from builtins import object
 from collections import defaultdict
 from os.path import join, exists
+from tempfile import TemporaryFile
 from os import makedirs, unlink
 from itertools import chain, groupby
 from random import Random
 import logging
 
-from sqlalchemy.orm import defer, with_polymorphic
+import simplejson as json
+
+from sqlalchemy import and_, func, literal_column
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import with_polymorphic
 from gensim import corpora, models as gmodels, similarities
 from gensim.utils import tokenize as gtokenize
 import numpy as np
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 import sklearn.cluster
 from sklearn.metrics.pairwise import pairwise_distances
 from sklearn import metrics
@@ -26,8 +31,9 @@ from .optics import Optics
 
 from assembl.lib.config import get_config
 from assembl.models import (
-    Content, Idea, Discussion, RootIdea, Post, IdeaLink, LangStringEntry)
-from .indexedcorpus import IdMmCorpus
+    Content, Idea, Discussion, RootIdea, Post, LangStringEntry,
+    IdeaHierarchy)
+from .indexedcorpus import AppendableIdCorpus
 from . import (
     get_stop_words, get_stemmer, DummyStemmer, ReversibleStemmer)
 
@@ -35,7 +41,7 @@ nlp_data = 'var/nlp'
 DICTIONARY_FNAME = 'dico.dict'
 STEMS_FNAME = 'stems.dict'
 PHRASES_FNAME = 'phrases.model'
-CORPUS_FNAME = 'posts.mm'
+CORPUS_FNAME = 'posts.bow'
 log = logging.getLogger(__name__)
 
 
@@ -206,24 +212,20 @@ class SemanticAnalysisData(object):
         discussion = self.discussion
         return str("%s/%s/" % (discussion.get_base_url(), discussion.slug))
 
+    @property
+    def idea_hierarchy(self):
+        return IdeaHierarchy.get(self.discussion.db, self.discussion.id)
+
     @property
     def idea_hry(self):
         if self._idea_hry is None:
-            db = self.discussion.db
-            self._idea_hry = dict(db.query(
-                IdeaLink.target_id, IdeaLink.source_id).join(
-                Idea, Idea.id == IdeaLink.source_id).filter(
-                IdeaLink.tombstone_date == None,
-                Idea.discussion_id == self.discussion.id))
+            self._idea_hry = self.idea_hierarchy.parent
         return self._idea_hry
 
     @property
     def idea_children(self):
         if self._idea_children is None:
-            idea_children = defaultdict(list)
-            for child, parent in self.idea_hry.items():
-                idea_children[parent].append(child)
-            self._idea_children = idea_children
+            self._idea_children = self.idea_hierarchy.children
         return self._idea_children
 
     @property
@@ -347,6 +349,71 @@ class SemanticAnalysisData(object):
             self._broadest_ideas_by_post = broadest_ideas_by_post
         return self._broadest_ideas_by_post
 
+    def post_fingerprints(self, discussion_ids):
+        """A hash of the original texts of each post of those discussions,
+        computed by the database, to find the posts that changed."""
+        db = self.discussion.db
+        entry = LangStringEntry.__table__
+        content = Content.__table__
+        return dict(db.query(
+            content.c.id,
+            func.md5(func.string_agg(entry.c.value, aggregate_order_by(
+                literal_column("' '"), entry.c.id)))
+        ).outerjoin(entry, and_(
+            entry.c.langstring_id.in_((
+                content.c.subject_id, content.c.body_id)),
+            entry.c.mt_trans_of_id == None)
+        ).filter(content.c.discussion_id.in_(discussion_ids)
+        ).group_by(content.c.id))
+
+    def update_corpus(self, lang, discussion_ids, corpus_fname,
+                      chunk_size=500):
+        """Vectorize the posts that are new or changed since the corpus
+        was last updated, and drop the posts that are gone.
+
+        Phrases and dictionary are updated with the new texts only; the
+        texts of changed posts are still counted in them."""
+        db = self.discussion.db
+        corpus = AppendableIdCorpus(corpus_fname)
+        if not exists(join(nlp_data, lang, DICTIONARY_FNAME)):
+            # The vectors are meaningless without their dictionary
+            corpus.clear()
+        fingerprints = self.post_fingerprints(discussion_ids)
+        gone = [id for id in corpus.offsets if id not in fingerprints]
+        if gone:
+            corpus.remove(gone)
+        to_vectorize = sorted(
+            id for (id, fingerprint) in fingerprints.items()
+            if id not in corpus or corpus.fingerprint(id) != fingerprint)
+        if not to_vectorize:
+            return corpus
+        tokenizer = Tokenizer(lang)
+        # New phrases and dictionary for a new corpus
+        bowizer = BOWizer(lang, tokenizer, len(corpus) > 0)
+        with TemporaryFile('w+') as spool:
+            def tokenized_posts():
+                # The only pass on the posts; tokens are kept for the next
+                for start in range(0, len(to_vectorize), chunk_size):
+                    posts = db.query(Content).filter(Content.id.in_(
+                        to_vectorize[start:start + chunk_size]))
+                    for post in posts:
+                        tokens = tokenizer.tokenize_post(post)
+                        spool.write(json.dumps([post.id, tokens]) + '\n')
+                        yield tokens
+
+            bowizer.phrases.add_vocab(tokenized_posts())
+            spool.seek(0)
+
+            def bows():
+                for line in spool:
+                    post_id, tokens = json.loads(line)
+                    yield (post_id, fingerprints[post_id],
+                           bowizer.dictionary.doc2bow(
+                               bowizer.phrases[tokens], allow_update=True))
+            corpus.update(bows())
+        bowizer.save()
+        return corpus
+
     def create_dictionaries(self, all_languages=False):
         db = self.discussion.db
         by_main_lang = defaultdict(list)
@@ -367,32 +434,8 @@ class SemanticAnalysisData(object):
             dirname = join(nlp_data, lang)
             if not exists(dirname):
                 makedirs(dirname)
-            corpus_fname = join(dirname, CORPUS_FNAME)
-            if exists(corpus_fname):
-                corpus = IdMmCorpus(corpus_fname)
-                doc_count = db.query(Content).with_polymorphic(
-                    Content).options(defer(Content.like_count)).join(
-                    Discussion).filter(Discussion.id.in_(discussion_ids)
-                                       ).count()
-                if corpus.num_docs == doc_count:
-                    corpora[lang] = corpus
-                    if my_discussion_lang == lang:
-                        self._corpus = corpus
-                    continue
-            tokenizer = Tokenizer(lang)
-            bowizer = BOWizer(lang, tokenizer, False)
-            posts = db.query(Content).join(Discussion).filter(
-                Discussion.id.in_(discussion_ids))
-            bowizer.phrases.add_vocab((
-                tokenizer.tokenize_post(post) for post in posts))
-            bowizer.dictionary.add_documents((
-                bowizer.phrases[tokenizer.tokenize_post(post)]
-                for post in posts))
-            IdMmCorpus.serialize(corpus_fname, (
-                (post.id, bowizer.post_to_bow(post))
-                for post in posts))
-            bowizer.save()
-            corpus = IdMmCorpus(corpus_fname)
+            corpus = self.update_corpus(
+                lang, discussion_ids, join(dirname, CORPUS_FNAME))
             corpora[lang] = corpus
             if my_discussion_lang == lang:
                 self._corpus = corpus
@@ -565,13 +608,26 @@ class SemanticAnalysisData(object):
                 self._topic_intensities = np.ones((self.num_topics,))
         return self._topic_intensities
 
-    def gensimvecs_to_csr(self, vecs, width, topic_intensities):
-        model_matrix = lil_matrix(
-            (len(vecs), width), dtype=np.float64)
-        for nrow, row in enumerate(vecs):
+    @staticmethod
+    def gensimvecs_to_csr(vecs, width, topic_intensities):
+        """A CSR matrix of gensim sparse vectors, one per row, with columns
+        scaled by topic_intensities."""
+        indptr = [0]
+        indices = []
+        data = []
+        for row in vecs:
             for ncol, val in row:
-                model_matrix[nrow, ncol] = val * topic_intensities[ncol]
-        return model_matrix.tocsr()
+                indices.append(ncol)
+                data.append(val)
+            indptr.append(len(indices))
+        model_matrix = csr_matrix((
+            np.array(data, dtype=np.float64),
+            np.array(indices, dtype=np.int32),
+            np.array(indptr, dtype=np.int32)),
+            shape=(len(indptr) - 1, width))
+        model_matrix.data *= np.asarray(
+            topic_intensities, dtype=np.float64)[model_matrix.indices]
+        return model_matrix
 
     def make_model_matrix(self, post_ids=None):
         num_topics = self.num_topics
@@ -19,6 +19,7 @@ of each document.
 """
 
 import itertools
+import os
 
 import logging
 import numpy
@@ -78,3 +79,143 @@ class IdMmCorpus(MmCorpus):
             return IdSlicedCorpus(self, docno)
         else:
             raise ValueError('Unrecognised value for docno, use either a single integer, a slice or a numpy.ndarray')
+
+
+class IdSubCorpus(object):
+    "The documents of an id-keyed corpus with the given ids, in that order"
+    def __init__(self, corpus, ids):
+        self.corpus = corpus
+        self.ids = ids
+
+    def __iter__(self):
+        return self.corpus.docs(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class AppendableIdCorpus(object):
+    """A bag-of-words corpus keyed by document id, that can be updated
+    without rewriting it.
+
+    Documents are appended as lines of text to the corpus file; a side
+    index maps each document id to the offset of its latest line, and to
+    a fingerprint of the text it was computed from, so callers can tell
+    which documents need to be vectorized again. Superseded lines are
+    dropped when they become a majority of the file."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.index_fname = utils.smart_extension(fname, '.index')
+        self.offsets = {}
+        self.fingerprints = {}
+        self.num_lines = 0
+        try:
+            (self.offsets, self.fingerprints, self.num_lines) = \
+                utils.unpickle(self.index_fname)
+            logger.info("loaded corpus index from %s" % self.index_fname)
+        except (IOError, OSError):
+            pass
+
+    @property
+    def num_docs(self):
+        return len(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, docid):
+        return docid in self.offsets
+
+    @property
+    def dockeys(self):
+        "The document ids, in increasing order, as the file once compacted"
+        return sorted(self.offsets)
+
+    def fingerprint(self, docid):
+        return self.fingerprints.get(docid, None)
+
+    @staticmethod
+    def _parse_line(line):
+        parts = line.split()
+        return [(int(termid), float(weight)) for (termid, weight) in (
+            part.split(b':') for part in parts[1:])]
+
+    def docs(self, docids):
+        "The documents with those ids, reading the file once"
+        with open(self.fname, 'rb') as f:
+            for docid in docids:
+                f.seek(self.offsets[int(docid)])
+                yield self._parse_line(f.readline())
+
+    def __getitem__(self, docno):
+        if isinstance(docno, (int, numpy.integer)):
+            return list(self.docs([docno]))[0]
+        elif isinstance(docno, (list, tuple, numpy.ndarray)):
+            return IdSubCorpus(self, docno)
+        else:
+            raise ValueError('Unrecognised value for docno, use either a single integer, a list or a numpy.ndarray')
+
+    def __iter__(self):
+        "The documents, in the order of :py:attr:`dockeys`"
+        if not self.offsets:
+            # The file may not exist yet
+            return iter(())
+        return self.docs(self.dockeys)
+
+    def update(self, docs):
+        """Add or replace documents.
+
+        :param docs: an iterable of (docid, fingerprint, bow) triples"""
+        with open(self.fname, 'ab') as f:
+            offset = f.tell()
+            for docid, fingerprint, bow in docs:
+                line = b' '.join([str(docid).encode('ascii')] + [
+                    ('%d:%s' % (termid, repr(float(weight)))).encode('ascii')
+                    for (termid, weight) in bow]) + b'\n'
+                f.write(line)
+                self.offsets[docid] = offset
+                self.fingerprints[docid] = fingerprint
+                self.num_lines += 1
+                offset += len(line)
+        if self.num_lines > 2 * len(self.offsets):
+            self.compact()
+        else:
+            self.save_index()
+
+    def clear(self):
+        "Remove all documents"
+        self.offsets = {}
+        self.fingerprints = {}
+        self.num_lines = 0
+        open(self.fname, 'wb').close()
+        self.save_index()
+
+    def remove(self, docids):
+        for docid in docids:
+            self.offsets.pop(docid, None)
+            self.fingerprints.pop(docid, None)
+        self.save_index()
+
+    def compact(self):
+        "Rewrite the corpus file without the superseded lines"
+        tmp_fname = self.fname + '.tmp'
+        offsets = {}
+        with open(self.fname, 'rb') as source:
+            with open(tmp_fname, 'wb') as target:
+                for docid in sorted(self.offsets):
+                    source.seek(self.offsets[docid])
+                    offsets[docid] = target.tell()
+                    target.write(source.readline())
+        os.rename(tmp_fname, self.fname)
+        self.offsets = offsets
+        self.num_lines = len(offsets)
+        self.save_index()
+
+    def save_index(self):
+        # Written after the corpus file, and atomically: an interrupted
+        # update only leaves unreferenced lines behind.
+        tmp_fname = self.index_fname + '.tmp'
+        utils.pickle(
+            (self.offsets, self.fingerprints, self.num_lines), tmp_fname)
+        os.rename(tmp_fname, self.index_fname)
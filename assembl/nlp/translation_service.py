@@ -188,6 +188,12 @@ class LanguageIdentificationService(object):
 class AbstractTranslationService(LanguageIdentificationService):
     # Should we identify before translating?
     distinct_identify_step = True
+    # How many texts to send in one call to translate_batch
+    max_batch_size = 1
+    # How many calls to translate_batch may run at once, on as many threads
+    max_concurrency = 1
+    # Maximum calls per second to the service, None for no limit
+    max_rate = None
 
     def serviceData(self):
         return {"translation_notice": "Machine-translated",
@@ -211,12 +217,34 @@ class AbstractTranslationService(LanguageIdentificationService):
             lang, data = self.identify(text)
         return text, lang
 
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        """Translate many texts from the same source locale to the target.
+
+        May be called from another thread: must not use the database.
+
+        :returns: for each text, either a (translation, source locale) pair
+            or the exception raised while translating it"""
+        results = []
+        for text in texts:
+            try:
+                results.append(self.translate(
+                    text, target, is_html, source=source))
+            except Exception as e:
+                results.append(e)
+        return results
+
     def get_mt_name(self, source_name, target_name):
         return create_mt_code(source_name, target_name)
 
     def translate_lse(
             self, source_lse, target, retranslate=False, is_html=False,
-            constrain_locale_threshold=SECURE_IDENTIFICATION_LIMIT):
+            constrain_locale_threshold=SECURE_IDENTIFICATION_LIMIT,
+            translation=None):
+        """Translate a LangStringEntry, and store the result.
+
+        :param translation: the result of translate_batch for this entry,
+            if already obtained: a (translation, source locale) pair or
+            an exception"""
         if not source_lse.value:
             # don't translate empty strings
             return source_lse
@@ -259,7 +287,9 @@ class AbstractTranslationService(LanguageIdentificationService):
             is_new_lse = True
         if self.canTranslate(source_locale, target):
             try:
-                trans, lang = self.translate(
+                if isinstance(translation, Exception):
+                    raise translation
+                trans, lang = translation or self.translate(
                     source_lse.value,
                     target,
                     is_html,
@@ -326,6 +356,9 @@ class AbstractTranslationService(LanguageIdentificationService):
 
 
 class DummyTranslationServiceTwoSteps(AbstractTranslationService):
+    max_batch_size = 10
+    max_concurrency = 4
+
     def canTranslate(cls, source, target):
         return True
 
@@ -464,6 +497,8 @@ class DummyGoogleTranslationService(AbstractTranslationService):
 
 class GoogleTranslationService(DummyGoogleTranslationService):
     distinct_identify_step = False
+    # The api client is not thread-safe; batches are large enough.
+    max_batch_size = 100
 
     def __init__(self, discussion, apikey=None):
         super(GoogleTranslationService, self).__init__(discussion)
@@ -547,6 +582,21 @@ class GoogleTranslationService(DummyGoogleTranslationService):
         translated = self.unescape_string(translated, is_html)
         return translated, source
 
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        if not self.client:
+            from googleapiclient.http import HttpError
+            raise HttpError(401, '{"error":"Please define server_api_key"}')
+        r = self.client.translations().list(
+            q=texts,
+            format="html" if is_html else "text",
+            target=self.asKnownLocale(target),
+            source=self.asKnownLocale(source) if source else None).execute()
+        return [(
+            self.unescape_string(translation[u'translatedText'], is_html),
+            source or self.asPosixLocale(
+                translation[u'detectedSourceLanguage']))
+            for translation in r[u"translations"]]
+
     def decode_exception(self, exception, identify_phase=False):
         from googleapiclient.http import HttpError
         import socket
@@ -575,6 +625,9 @@ class GoogleTranslationService(DummyGoogleTranslationService):
 
 class DeeplTranslationService(AbstractTranslationService):
     distinct_identify_step = False
+    max_batch_size = 50
+    max_concurrency = 4
+    max_rate = 10
 
     known_locales_cls = {
         "de", "en", "fr", "it", "ja", "es", "nl", "pl", "pt", "ru", "zh"}
@@ -647,6 +700,26 @@ class DeeplTranslationService(AbstractTranslationService):
         r = r.json()['translations'][0]
         return r['text'], r['detected_source_language'].lower()
 
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        if not self.apikey:
+            raise RuntimeError("Please define server_api_key")
+        args = dict(
+            auth_key=self.apikey,
+            text=texts,
+            target_lang=target.upper(),
+            split_sentences="nonewlines" if is_html else "1",
+            tag_handling="xml" if is_html else ""
+            )
+        if source:
+            args['source_lang'] = source.upper()
+        r = requests.post(
+            self.translate_url, data=args,
+            timeout=(2, 3+floor(sum(len(text) for text in texts)/100)))
+        if not r.ok:
+            raise RuntimeError("status", r.status_code)
+        return [(t['text'], t['detected_source_language'].lower())
+                for t in r.json()['translations']]
+
     def decode_exception(self, exception, identify_phase=False):
         if isinstance(exception, requests.Timeout):
             return LangStringStatus.SERVICE_DOWN, str(exception)
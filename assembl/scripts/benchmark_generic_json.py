@@ -0,0 +1,49 @@
+"""Time the serialization of posts with generic_json, one post at a time
+and with generic_json_many, for some view_defs."""
+import argparse
+from timeit import timeit
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion_id", type=int)
+    parser.add_argument("--posts", type=int, default=500,
+                        help="number of posts to serialize")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--view_defs", nargs="*",
+        default=["default", "partial_post", "changes"])
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import Post
+    with transaction.manager:
+        posts = db.query(Post).filter_by(
+            discussion_id=args.discussion_id
+        ).order_by(Post.id).limit(args.posts).all()
+        for view_def_name in args.view_defs:
+            # Warm up the serializers and lazy loads
+            for post in posts:
+                post.generic_json(view_def_name)
+
+            def one_by_one():
+                for post in posts:
+                    post.generic_json(view_def_name)
+
+            def many():
+                Post.generic_json_many(posts, view_def_name)
+
+            t_one = timeit(one_by_one, number=args.repeat)
+            t_many = timeit(many, number=args.repeat)
+            print("%s, %d posts: %.3fs one by one, %.3fs with "
+                  "generic_json_many" % (
+                      view_def_name, len(posts), t_one, t_many))
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Compare the time taken to build the topic matrix of the semantic analysis
+from gensim vectors, with the former lil_matrix implementation."""
+import argparse
+from timeit import default_timer
+
+import numpy as np
+from scipy.sparse import lil_matrix
+
+from assembl.nlp.clusters import SemanticAnalysisData
+
+
+def lil_gensimvecs_to_csr(vecs, width, topic_intensities):
+    "The former implementation, for reference"
+    model_matrix = lil_matrix(
+        (len(vecs), width), dtype=np.float64)
+    for nrow, row in enumerate(vecs):
+        for ncol, val in row:
+            model_matrix[nrow, ncol] = val * topic_intensities[ncol]
+    return model_matrix.tocsr()
+
+
+def random_vecs(rows, width, density, seed=0):
+    "Gensim-style sparse vectors: lists of (column, value) pairs"
+    random = np.random.RandomState(seed)
+    vecs = []
+    for _ in range(rows):
+        columns = np.flatnonzero(random.random_sample(width) < density)
+        vecs.append(list(zip(
+            columns.tolist(), random.standard_normal(len(columns)).tolist())))
+    return vecs
+
+
+def timed(function, *args):
+    start = default_timer()
+    result = function(*args)
+    return result, default_timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=50000,
+                        help="number of posts")
+    parser.add_argument("--topics", type=int, default=200,
+                        help="number of topics")
+    parser.add_argument("--density", type=float, default=1.0,
+                        help="fraction of non-zero topics in each vector")
+    args = parser.parse_args()
+    vecs = random_vecs(args.rows, args.topics, args.density)
+    topic_intensities = np.linspace(1, 0.1, args.topics)
+    expected, lil_time = timed(
+        lil_gensimvecs_to_csr, vecs, args.topics, topic_intensities)
+    result, csr_time = timed(
+        SemanticAnalysisData.gensimvecs_to_csr, vecs, args.topics,
+        topic_intensities)
+    assert result.shape == expected.shape
+    assert abs(result - expected).max() < 1e-12
+    print("%d x %d, %d non-zero values" % (
+        args.rows, args.topics, result.nnz))
+    print("lil_matrix: %.3fs" % lil_time)
+    print("csr arrays: %.3fs (%.1f times faster)" % (
+        csr_time, lil_time / csr_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -674,7 +674,7 @@ def clone_discussion(
     to_session.flush()
     for p in to_session.query(Post).filter_by(
             discussion=copy, parent_id=None).all():
-        p._set_ancestry('')
+        p._rebuild_ancestry('')
     to_session.flush()
     return copy
 
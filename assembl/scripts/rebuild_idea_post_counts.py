@@ -0,0 +1,31 @@
+"""Recompute the stored post counts of ideas, for all or some discussions."""
+import argparse
+
+import transaction
+
+from assembl.lib.sqla import mark_changed
+from assembl.scripts import boostrap_configuration
+
+
+def rebuild_idea_post_counts(db, discussion_ids=None):
+    from assembl.models import Discussion, DiscussionGlobalData
+    if not discussion_ids:
+        discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        with transaction.manager:
+            DiscussionGlobalData(db, discussion_id).update_stored_counts()
+            mark_changed(db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion_ids", nargs="*", type=int,
+                        help="discussions to rebuild (default: all)")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    rebuild_idea_post_counts(db, args.discussion_ids)
+
+
+if __name__ == '__main__':
+    main()
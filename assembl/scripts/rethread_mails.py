@@ -0,0 +1,29 @@
+"""Thread all the emails of some or all discussions again, from scratch."""
+import argparse
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def rethread_mails(db, discussion_ids=None):
+    from assembl.models import Discussion, EmailThreader
+    if not discussion_ids:
+        discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        with transaction.manager:
+            EmailThreader(db, discussion_id).rebuild()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion_ids", nargs="*", type=int,
+                        help="discussions to rethread (default: all)")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    rethread_mails(db, args.discussion_ids)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,7 @@ from celery import Celery
 from pyramid_mailer import mailer_factory_from_settings
 
 from ..lib.sqla import configure_engine
-from ..lib.zmqlib import configure_zmq
+from ..lib.zmqlib import configure_zmq_from_settings
 from ..lib.raven_client import setup_raven
 from ..lib.config import get, set_config
 from zope.component import getGlobalSiteManager
@@ -112,7 +112,7 @@ class CeleryWithConfig(Celery):
         if not exists(settings_file):
             raise RuntimeError("Missing settings file")
         _settings = settings = get_appsettings(settings_file, 'idealoom')
-        configure_zmq(settings['changes_socket'], False)
+        configure_zmq_from_settings(settings, False)
         config = configparser.SafeConfigParser()
         config.read(settings_file)
         registry = getGlobalSiteManager()
@@ -141,6 +141,8 @@ class CeleryWithConfig(Celery):
                     continue
                 SMTP_DOMAIN_DELAYS[name[len(SETTINGS_SMTP_DELAY):]] = val
         getLogger().info("SMTP_DOMAIN_DELAYS", delays=SMTP_DOMAIN_DELAYS)
+        import assembl.tasks.changes
+        import assembl.tasks.idea_post_counts
         import assembl.tasks.imap
         import assembl.tasks.notify
         import assembl.tasks.notification_dispatch
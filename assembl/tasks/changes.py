@@ -0,0 +1,46 @@
+"""Celery task that serializes changed objects for the
+:py:mod:`assembl.tasks.changes_router`, outside of the committing request.
+
+Used when ``changes_deferred_serialization`` is set; see
+:py:func:`assembl.lib.sqla.before_commit_listener`."""
+import transaction
+
+from . import celery
+from ..lib.zmqlib import get_pub_socket, send_changes, queue_changes
+
+_socket = None
+
+
+def serialize_deferred_changes(entries):
+    """Turn the entries captured at commit time into the json that
+    would have been sent by the committing process.
+
+    Entries are either (typename, uri, view_def) triples or json
+    that was already serialized, such as tombstones."""
+    from ..lib.sqla import get_named_object
+    changes = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            changes.append(entry)
+            continue
+        typename, uri, view_def = entry
+        target = get_named_object(uri, typename)
+        if target is None:
+            # Deleted since; its tombstone will follow.
+            continue
+        json = target.generic_json(view_def)
+        if json:
+            changes.append(json)
+    return changes
+
+
+@celery.task(ignore_result=True)
+def send_deferred_changes(discussion, entries):
+    global _socket
+    with transaction.manager:
+        changes = serialize_deferred_changes(entries)
+    if not changes or queue_changes(discussion, changes):
+        return
+    if _socket is None:
+        _socket = get_pub_socket()
+    send_changes(_socket, discussion, changes)
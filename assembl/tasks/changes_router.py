@@ -6,7 +6,8 @@ import sys
 from os import makedirs, access, R_OK, W_OK
 from os.path import exists, dirname
 import configparser
-from time import sleep
+from time import sleep, monotonic
+from collections import OrderedDict, defaultdict
 import logging
 import logging.config
 from functools import partial
@@ -31,6 +32,7 @@ log = logging.getLogger("assembl.tasks.changes_router")
 SECTION = 'app:idealoom'
 Everyone = 'system.Everyone'
 Authenticated = 'system.Authenticated'
+USER_PREFIX = 'local:Agent/'
 
 
 def setup_router(in_socket, out_socket):
@@ -85,9 +87,201 @@ def setup_app(path):
     return app
 
 
+class ChangeMessage(object):
+    """A message from the changes socket, shared by all the sockets
+    that receive it. It is parsed at most once, and the message
+    seen by each set of roles is serialized at most once."""
+
+    def __init__(self, data):
+        self.data = data
+        self.has_private = '@private' in data
+        self.items = None
+        self.private_sets = None
+        self.variants = {}
+        self.role_changes = False  # not computed yet
+
+    def parse(self):
+        self.items = []
+        private_sets = set()
+        for x in json.loads(self.data):
+            private = x.get('@private', None)
+            if private is not None:
+                private = frozenset(private)
+                private_sets.add(private)
+            self.items.append((private, x))
+        self.private_sets = private_sets
+
+    def for_roles(self, roles):
+        """The serialized message, without the private items that
+        those roles cannot see. None if nothing is left."""
+        if not self.has_private or "r:sysadmin" in roles:
+            return self.data
+        if self.items is None:
+            self.parse()
+        visible = frozenset(
+            s for s in self.private_sets if not s.isdisjoint(roles))
+        if visible not in self.variants:
+            allowed = [x for (private, x) in self.items
+                       if private is None or private in visible]
+            self.variants[visible] = json.dumps(allowed) if allowed else None
+        return self.variants[visible]
+
+    def changed_roles(self):
+        """Which users may have had their roles or permissions changed
+        by this message, as a set of user uris, or None if it changes
+        permissions for everyone in the discussion."""
+        if self.role_changes is not False:
+            return self.role_changes
+        users = set()
+        if ('Role"' in self.data or '"User"' in self.data
+                or 'Permission"' in self.data):
+            if self.items is None:
+                self.parse()
+            for (private, x) in self.items:
+                typename = x.get('@type', None)
+                if typename in (
+                        'DiscussionPermission', 'StateDiscussionPermission'):
+                    self.role_changes = None
+                    return None
+                elif typename == 'User':
+                    users.add(x['@id'])
+                elif typename in ('UserRole', 'LocalUserRole'):
+                    # @private is the user, or a list including the user
+                    principals = x.get('@private', None) or ()
+                    if isinstance(principals, str):
+                        principals = (principals, )
+                    users.update(p for p in principals
+                                 if p.startswith(USER_PREFIX))
+        self.role_changes = users
+        return users
+
+
+class PermissionCache(object):
+    """Remembers for a while whether users can read discussions, and their
+    roles there, so reconnections do not each make calls to the server.
+    Concurrent lookups for the same user and discussion share one call."""
+
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, discussion, user_id, fetch):
+        """The cached value for this discussion and user.
+        If absent, awaits fetch() to obtain it."""
+        key = (discussion, user_id)
+        entry = self.entries.get(key, None)
+        if entry is not None and entry[0] > monotonic():
+            self.hits += 1
+            return entry[1]
+        future = self.pending.get(key, None)
+        if future is not None:
+            self.hits += 1
+            return await future
+        self.misses += 1
+        future = asyncio.ensure_future(fetch())
+        self.pending[key] = future
+        try:
+            value = await future
+        finally:
+            is_current = self.pending.get(key, None) is future
+            if is_current:
+                del self.pending[key]
+        if is_current:
+            if len(self.entries) >= self.max_size:
+                self.prune()
+            self.entries[key] = (monotonic() + self.ttl, value)
+        return value
+
+    def prune(self):
+        now = monotonic()
+        self.entries = {k: v for (k, v) in self.entries.items()
+                        if v[0] > now}
+
+    def invalidate(self, discussion, users=None):
+        """Forget about some users (or all) in a discussion.
+        Users of a '*' message are forgotten in all discussions."""
+        for cache in (self.entries, self.pending):
+            for key in list(cache.keys()):
+                if discussion != '*' and key[0] != discussion:
+                    continue
+                if users is None or key[1] in users:
+                    del cache[key]
+
+
+class DiscussionSubscription(object):
+    """The single ZMQ subscription of a discussion's changes. Messages are
+    fanned out to a queue for each of the discussion's active sockets."""
+
+    # A socket that falls that far behind is closed
+    max_queue_size = 1000
+
+    def __init__(self, dispatcher, discussion):
+        self.dispatcher = dispatcher
+        self.discussion = discussion
+        self.topic = discussion.encode('ascii')
+        self.queues = {}
+        loop = asyncio.get_event_loop()
+        self.task = loop.create_task(self.listen())
+
+    def add(self, socket):
+        queue = asyncio.Queue(self.max_queue_size)
+        self.queues[socket] = queue
+        return queue
+
+    def remove(self, socket, queue):
+        """Remove the socket's queue. Returns whether any queue is left."""
+        if self.queues.get(socket, None) is queue:
+            del self.queues[socket]
+        return bool(self.queues)
+
+    def close(self):
+        if not self.task.done():
+            self.task.cancel()
+
+    async def listen(self):
+        sock = self.dispatcher.zmq_context.socket(zmq.SUB)
+        try:
+            sock.identity = b'SUB'
+            sock.connect(self.dispatcher.out_socket_name)
+            sock.subscribe(b'*')
+            sock.subscribe(self.topic)
+            log.debug("bound %s", self.discussion)
+            while True:
+                msg = await sock.recv_multipart()  # waits for msg to be ready
+                log.debug("got socket msg %s", msg)
+                if msg[0] not in (b'*', self.topic):
+                    # subscriptions are prefixes: 1 gets 12's messages
+                    continue
+                message = self.dispatcher.get_change_message(msg[-1])
+                changed_roles = message.changed_roles()
+                if changed_roles is None or changed_roles:
+                    self.dispatcher.permission_cache.invalidate(
+                        msg[0].decode('ascii'), changed_roles)
+                for socket, queue in list(self.queues.items()):
+                    try:
+                        queue.put_nowait(message)
+                    except asyncio.QueueFull:
+                        log.warning("socket is too slow, closing")
+                        self.remove(socket, queue)
+                        asyncio.ensure_future(socket.close())
+        except asyncio.CancelledError:
+            log.info('subscription cancelled')
+        finally:
+            log.info('closing subscription to %s', self.discussion)
+            sock.close()
+
+
 class Dispatcher(object):
 
     _dispatcher = None
+    # How many recent messages to keep parsed
+    max_recent_changes = 16
+    # Seconds between bulk connection notifications to the server
+    notification_interval = 5
 
     @classmethod
     def get_instance(cls):
@@ -108,6 +302,12 @@ class Dispatcher(object):
         self.server_url = server_url
         self.out_socket_name = out_socket_name
         self.active_sockets = dict()
+        self.recent_changes = OrderedDict()
+        self.subscriptions = dict()
+        self.permission_cache = PermissionCache()
+        # discussion -> (user token, connecting) -> time, oldest first
+        self.connection_notifications = defaultdict(dict)
+        self.notification_task = None
         self.token = None
         self.discussion = None
         self.userId = None
@@ -122,10 +322,82 @@ class Dispatcher(object):
 
     async def startup(self):
         self.http_client = ClientSession()
+        loop = asyncio.get_event_loop()
+        self.notification_task = loop.create_task(self.notify_periodically())
+
+    def notify_connection(self, discussion, raw_token, connecting):
+        """Queue a user's (dis)connection, to be sent in bulk.
+
+        The latest connection and disconnection of each token are kept
+        in order, so the server can apply them in that order."""
+        notifications = self.connection_notifications[discussion]
+        key = (raw_token, connecting)
+        notifications.pop(key, None)
+        notifications[key] = monotonic()
+
+    @staticmethod
+    def connection_events(notifications):
+        """[token, connecting, seconds ago] lists, oldest first"""
+        now = monotonic()
+        return [[token, connecting, now - time] for (
+            (token, connecting), time) in notifications.items()]
+
+    async def send_connection_notifications(self):
+        notifications = self.connection_notifications
+        self.connection_notifications = defaultdict(dict)
+        for discussion, events in notifications.items():
+            data = {'events': self.connection_events(events)}
+            try:
+                async with self.http_client.post(
+                        '%s/data/Discussion/%s/users_dis_connected' % (
+                            self.server_url, discussion),
+                        json=data) as resp:
+                    await resp.text()
+            except Exception as e:
+                log.error(e)
+                capture_exception()
+
+    async def notify_periodically(self):
+        try:
+            while not self.is_shutdown:
+                await asyncio.sleep(self.notification_interval)
+                await self.send_connection_notifications()
+        except asyncio.CancelledError:
+            pass
 
     def by_session(self, session):
         return self.active_sockets.get(session.id, None)
 
+    def subscribe(self, socket):
+        """Register the socket with its discussion's subscription,
+        creating it if needed. Returns the socket's message queue."""
+        subscription = self.subscriptions.get(socket.discussion, None)
+        if subscription is None:
+            subscription = DiscussionSubscription(self, socket.discussion)
+            self.subscriptions[socket.discussion] = subscription
+        return subscription.add(socket)
+
+    def unsubscribe(self, socket, discussion, queue):
+        """Unregister the socket, and close its discussion's subscription
+        if it was the last socket."""
+        subscription = self.subscriptions.get(discussion, None)
+        if subscription is not None and not subscription.remove(
+                socket, queue):
+            del self.subscriptions[discussion]
+            subscription.close()
+            # we will not see role changes anymore
+            self.permission_cache.invalidate(discussion)
+
+    def get_change_message(self, data):
+        """The shared ChangeMessage for this raw message"""
+        message = self.recent_changes.get(data, None)
+        if message is None:
+            message = ChangeMessage(data.decode('utf-8'))
+            self.recent_changes[data] = message
+            if len(self.recent_changes) > self.max_recent_changes:
+                self.recent_changes.popitem(last=False)
+        return message
+
     def start_shutdown(self):
         if self.is_shutdown:
             log.warning("shutdown twice")
@@ -138,6 +410,11 @@ class Dispatcher(object):
         self.is_shutdown = True
         await asyncio.gather(*[
             session.close() for session in self.active_sockets.values()])
+        for subscription in self.subscriptions.values():
+            subscription.close()
+        if self.notification_task is not None:
+            self.notification_task.cancel()
+        await self.send_connection_notifications()
         if self.http_client is not None:
             await self.http_client.close()
         manager = sockjs.get_manager('changes', self.app)
@@ -190,21 +467,11 @@ class ActiveSocket(object):
         self.valid = True
         self.closing = False
 
-    async def on_recv(self, data):
+    async def on_recv(self, message):
         try:
-            data = data[-1].decode('utf-8')
-            if ("r:sysadmin" not in self.roles) and '@private' in data:
-                jsondata = json.loads(data)
-                allowed = []
-                for x in jsondata:
-                    if '@private' in x:
-                        private = x['@private']
-                        if private is not None and not self.roles.intersection(set(private)):
-                            continue
-                    allowed.append(x)
-                if not allowed:
-                    return
-                data = json.dumps(allowed)
+            data = message.for_roles(self.roles)
+            if data is None:
+                return
             self.session.send(data)
             log.debug('sent:'+data)
         except Exception as e:
@@ -220,11 +487,32 @@ class ActiveSocket(object):
         if self.task and not self.task.cancelled():
             self.task.cancel()
         if self.raw_token and self.discussion and self.userId != Everyone:
-            async with self.http_client.post(
-                    '%s/data/Discussion/%s/all_users/%d/disconnecting' % (
-                        self.server_url, self.discussion, self.token['userId']
-                    ), data={'token': self.raw_token}) as resp:
-                await resp.text()
+            self.dispatcher.notify_connection(
+                self.discussion, self.raw_token, False)
+
+    async def get_permissions(self):
+        """Whether the user can read the discussion, and their roles,
+        from the server"""
+        async with self.http_client.get(
+            '%s/api/v1/discussion/%s/permissions/Conversation.R/u/%s' % (
+                    self.server_url, self.discussion, self.token['userId']
+                ), headers={"Accept": "application/json"}) as resp:
+            text = await resp.text()
+        log.debug(text)
+        if text != 'true':
+            return (False, None)
+        if self.userId == Everyone:
+            return (True, {Everyone})
+        async with self.http_client.get(
+            '%s/api/v1/discussion/%s/roles/allfor/%s' % (
+                    self.server_url, self.discussion, self.token['userId']
+                ), headers={"Accept": "application/json"}) as resp:
+            text = await resp.text()
+        roles = set(json.loads(text))
+        roles.add(Everyone)
+        roles.add(Authenticated)
+        roles.add(self.userId)
+        return (True, frozenset(roles))
 
     async def on_message(self, msg):
         try:
@@ -246,59 +534,36 @@ class ActiveSocket(object):
                     pass
             if self.token and self.discussion:
                 # Check if token authorizes discussion
-                async with self.http_client.get(
-                    '%s/api/v1/discussion/%s/permissions/Conversation.R/u/%s' % (
-                            self.server_url, self.discussion, self.token['userId']
-                        ), headers={"Accept": "application/json"}) as resp:
-                    text = await resp.text()
-                log.debug(text)
-                if text != 'true':
+                can_read, roles = await self.dispatcher.permission_cache.get(
+                    self.discussion, self.userId, self.get_permissions)
+                if not can_read:
                     return
                 log.info("connected")
-                if self.userId == Everyone:
-                    self.roles = {Everyone}
-                else:
-                    async with self.http_client.get(
-                        '%s/api/v1/discussion/%s/roles/allfor/%s' % (
-                                self.server_url, self.discussion, self.token['userId']
-                            ), headers={"Accept": "application/json"}) as resp:
-                        text = await resp.text()
-                        self.roles = set(json.loads(text))
-                        self.roles.add(Everyone)
-                        self.roles.add(Authenticated)
-                        self.roles.add('local:Agent/'+str(self.token['userId']))
+                self.roles = roles
                 loop = asyncio.get_event_loop()
                 self.task = loop.create_task(self.connect())
                 self.session.send('[{"@type":"Connection"}]')
                 if self.token and self.raw_token and self.discussion and self.userId != Everyone:
-                    async with self.http_client.post(
-                            '%s/data/Discussion/%s/all_users/%d/connecting' % (
-                                self.server_url, self.discussion, self.token['userId']
-                            ), data={'token': self.raw_token}) as resp:
-                        await resp.text()
+                    self.dispatcher.notify_connection(
+                        self.discussion, self.raw_token, True)
         except Exception as e:
             log.error(e)
             capture_exception()
             await self.close()
 
     async def connect(self):
-        sock = self.dispatcher.zmq_context.socket(zmq.SUB)
+        discussion = self.discussion
+        queue = self.dispatcher.subscribe(self)
         try:
-            sock.identity = b'SUB'
-            sock.connect(self.dispatcher.out_socket_name)
-            sock.subscribe(b'*')
-            sock.subscribe(self.discussion.encode('ascii'))
-            log.debug("bound")
             while self.valid:
-                msg = await sock.recv_multipart()  # waits for msg to be ready
-                log.debug("got socket msg %s", msg)
-                await self.on_recv(msg)
+                message = await queue.get()  # waits for msg to be ready
+                await self.on_recv(message)
                 log.debug("msg managed")
         except asyncio.CancelledError:
             log.info('cancelled')
         finally:
             log.info('closing websocket')
-            sock.close()
+            self.dispatcher.unsubscribe(self, discussion, queue)
             await self.close()
 
 
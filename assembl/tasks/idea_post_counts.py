@@ -0,0 +1,28 @@
+"""Celery task that updates the stored post counts of ideas, after the
+transactions that changed them were committed; see
+:py:func:`assembl.models.path_utils.update_idea_post_counts`."""
+import transaction
+
+from . import celery
+from ..lib.sqla import mark_changed
+
+
+@celery.task(ignore_result=True, shared=False)
+def update_idea_post_counts(discussion_id, idea_ids, post_paths):
+    """Recount the ideas affected by changes to these ideas and posts.
+
+    Runs for a discussion wait for one another, see
+    :py:meth:`assembl.models.path_utils.DiscussionGlobalData.lock_stored_counts`."""
+    from ..models import RootIdea, DiscussionGlobalData
+    from ..models.path_utils import IdeaPostCountChanges
+    db = RootIdea.default_db
+    with transaction.manager:
+        if db.query(RootIdea.id).filter_by(
+                discussion_id=discussion_id).first() is None:
+            # The discussion was deleted
+            return
+        changes = IdeaPostCountChanges()
+        changes.idea_ids.update(idea_ids)
+        changes.post_paths.update(post_paths)
+        DiscussionGlobalData(db, discussion_id).update_stored_counts(changes)
+        mark_changed(db)
@@ -4,13 +4,12 @@ from datetime import datetime, timedelta
 from imapclient import IMAPClient
 from imapclient.exceptions import (
     IMAPClientAbortError, IMAPClientError, ProtocolError)
-from sqlalchemy.orm import undefer
 
 import ssl
 import certifi
 
 from assembl.lib.raven_client import capture_exception
-from assembl.models import ContentSource, AbstractMailbox, ImportedPost, Email
+from assembl.models import ContentSource, AbstractMailbox, EmailThreader
 from .source_reader import (
     ReaderStatus, SourceReader, ReaderError, ClientError, IrrecoverableError)
 
@@ -170,10 +169,14 @@ class IMAPReader(SourceReader):
             message_string = AbstractMailbox.guess_encoding(message_string)
             try:
                 if self.source.message_ok_to_import(message_string):
-                    (email_object, dummy, error) = self.source.parse_email(message_string)
+                    (email_object, parsed, error) = self.source.parse_email(message_string)
                     if error:
                         raise ReaderError(error)
                     self.source.db.add(email_object)
+                    threader = EmailThreader(
+                        self.source.db, self.source.discussion_id)
+                    threader.add(email_object, parsed['references'])
+                    threader.apply()
                 else:
                     log.info("Skipped message with imap id %s (bounce or vacation message)" % (email_id))
                 # log.debug( "Setting self.source.last_imported_email_uid to "+email_id)
@@ -197,15 +200,7 @@ class IMAPReader(SourceReader):
             self.import_email(email_id)
             if self.status != ReaderStatus.READING:
                 break
-        # We imported mails, we need to re-thread
-        self.source.db.flush()
-        # Rethread emails globally (sigh)
-        emails = self.source.db.query(Email).filter_by(
-            discussion_id=self.source.discussion_id
-        ).options(undefer(ImportedPost.imported_blob)).all()
-
-        AbstractMailbox.thread_mails(emails)
-        self.source.db.commit()
+        # Each email was threaded as it was imported
 
     def do_read(self):
         only_new = not self.reimporting
@@ -1,9 +1,8 @@
 import logging
 
 from imaplib2 import IMAP4_SSL, IMAP4
-from sqlalchemy.orm import undefer
 
-from assembl.models import ContentSource
+from assembl.models import ContentSource, EmailThreader
 from .source_reader import (
     ReaderStatus, SourceReader, ReaderError, ClientError, IrrecoverableError)
 
@@ -116,10 +115,14 @@ class IMAPReader(SourceReader):
                 raise ClientError()
             try:
                 if self.source.message_ok_to_import(message_string):
-                    (email_object, dummy, error) = self.source.parse_email(message_string)
+                    (email_object, parsed, error) = self.source.parse_email(message_string)
                     if error:
                         raise ReaderError(error)
                     self.source.db.add(email_object)
+                    threader = EmailThreader(
+                        self.source.db, self.source.discussion_id)
+                    threader.add(email_object, parsed['references'])
+                    threader.apply()
                 else:
                     log.info("Skipped message with imap id %s (bounce or vacation message)" % (email_id))
                 # log.debug( "Setting self.source.last_imported_email_uid to "+email_id)
@@ -180,16 +183,7 @@ class IMAPReader(SourceReader):
                     self.import_email(email_id)
                     if self.status != ReaderStatus.READING:
                         break
-                from assembl.models import Post, AbstractMailbox
-                # We imported mails, we need to re-thread
-                self.source.db.flush()
-                # Rethread emails globally (sigh)
-                emails = self.source.db.query(Post).filter_by(
-                    discussion_id=self.source.discussion_id
-                ).options(undefer(ImportedPost.imported_blob)).all()
-
-                AbstractMailbox.thread_mails(emails)
-                self.source.db.flush()
+                # Each email was threaded as it was imported
             else:
                 log.debug("No IMAP messages to process")
             self.successful_read()
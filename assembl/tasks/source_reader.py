@@ -28,7 +28,7 @@ from ..lib.raven_client import setup_raven, capture_exception
 from ..lib.config import set_config
 from ..lib.enum import OrderedEnum
 from ..lib.sqla import configure_engine
-from ..lib.zmqlib import configure_zmq
+from ..lib.zmqlib import configure_zmq_from_settings
 
 log = logging.getLogger(__name__)
 pool_counter = 0
@@ -622,7 +622,7 @@ if __name__ == '__main__':
         print_stack()
 
     configure(registry, 'source_reader')
-    configure_zmq(settings['changes_socket'], True)
+    configure_zmq_from_settings(settings, True)
     from assembl.models.import_records import includeme
     includeme(None)
     log.disabled = False
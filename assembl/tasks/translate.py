@@ -1,5 +1,11 @@
 """A celery process that translate messages as soon as they are created. Causes deadlocks, not used"""
 from abc import abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep, time
+
+import transaction
 
 from . import celery
 from ..lib.utils import waiting_get
@@ -42,9 +48,135 @@ class DiscussionPreloadTranslationTable(TranslationTable):
         return self.base_languages - set((locale_code,))
 
 
+class RateLimiter(object):
+    """Space calls made from any thread to at most ``rate`` per second."""
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+class BatchTranslator(object):
+    """Collects the LangStringEntries to translate, and translates them
+    in batches of texts with the same source and target locale.
+
+    Batches are sent to the service concurrently; the database is only
+    used from the calling thread, before and after the service calls."""
+    def __init__(self, service, max_workers=None, rate=None):
+        self.service = service
+        self.max_workers = max_workers or service.max_concurrency
+        self.limiter = RateLimiter(rate or service.max_rate)
+        self.pending = []
+        self.to_send = []
+
+    def add(self, source_lse, target, is_html=False):
+        self.pending.append((source_lse, target, is_html))
+
+    def send_to_changes(self, content):
+        "Send the content to the changes once it is translated"
+        self.to_send.append(content)
+
+    def _batchable(self, source_lse, target):
+        from ..models import LocaleLabel
+        service = self.service
+        locale = source_lse.locale
+        if not source_lse.value or locale == LocaleLabel.NON_LINGUISTIC:
+            return False
+        if locale == LocaleLabel.UNDEFINED:
+            # leave identification to translate_lse
+            if (service.distinct_identify_step or
+                    service.strlen_nourl(source_lse.value) < 5):
+                return False
+        elif locale_compatible(locale, target):
+            return False
+        return bool(service.canTranslate(locale, target))
+
+    def _translate_batch(self, texts, target, is_html, source):
+        self.limiter.wait()
+        try:
+            results = self.service.translate_batch(
+                texts, target, is_html, source=source)
+            if len(results) != len(texts):
+                raise RuntimeError("Expected %d translations, got %d" % (
+                    len(texts), len(results)))
+            return results
+        except Exception as e:
+            return [e] * len(texts)
+
+    def run(self):
+        """Translate all pending entries.
+
+        :returns: the translated LangStringEntries"""
+        from ..models import LocaleLabel
+        service = self.service
+        pending, self.pending = self.pending, []
+        batches = defaultdict(list)
+        results = []
+        for source_lse, target, is_html in pending:
+            if self._batchable(source_lse, target):
+                source = source_lse.locale
+                if source == LocaleLabel.UNDEFINED:
+                    source = None
+                batches[(source, target, is_html)].append(source_lse)
+            else:
+                try:
+                    results.append(service.translate_lse(
+                        source_lse, target, is_html=is_html))
+                except Exception:
+                    capture_exception()
+                source_lse.db.expire(source_lse.langstring, ["entries"])
+        chunks = []
+        for (source, target, is_html), entries in batches.items():
+            for start in range(0, len(entries), service.max_batch_size):
+                chunks.append((
+                    source, target, is_html,
+                    entries[start:start + service.max_batch_size]))
+        if not chunks:
+            return results
+        # Load what the service may need before leaving this thread
+        service.discussion.discussion_locales
+        args = [([lse.value for lse in entries], target, is_html, source)
+                for (source, target, is_html, entries) in chunks]
+        if self.max_workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(self.max_workers) as executor:
+                translations = list(executor.map(
+                    lambda a: self._translate_batch(*a), args))
+        else:
+            translations = [self._translate_batch(*a) for a in args]
+        for (source, target, is_html, entries), batch_translations in zip(
+                chunks, translations):
+            for source_lse, translation in zip(entries, batch_translations):
+                try:
+                    results.append(service.translate_lse(
+                        source_lse, target, is_html=is_html,
+                        translation=translation))
+                except Exception:
+                    capture_exception()
+                source_lse.db.expire(source_lse.langstring, ["entries"])
+        for content in self.to_send:
+            content.send_to_changes()
+        self.to_send = []
+        return results
+
+
 def translate_content(
         content, translation_table=None, service=None,
-        send_to_changes=False):
+        send_to_changes=False, translator=None):
+    """Translate the subject and body of a content in the languages
+    given by the translation table.
+
+    If a translator is given, the translations are only queued on it;
+    otherwise they are done before returning."""
     from ..models import LocaleLabel
     discussion = content.discussion
     service = service or discussion.translation_service()
@@ -53,6 +185,7 @@ def translate_content(
             service, discussion)
     undefined = LocaleLabel.UNDEFINED
     changed = False
+    run_translator = False
     # Special case: Short strings.
     und_subject = content.subject.undefined_entry
     und_body = content.body.undefined_entry
@@ -93,7 +226,7 @@ def translate_content(
                         service.confirm_locale(entry)
                     except:
                         capture_exception()
-                        return changed
+                        break
                     # reload entries
                     ls.db.expire(ls, ("entries",))
                     entries = ls.entries_as_dict
@@ -103,13 +236,17 @@ def translate_content(
             originals = ls.non_mt_entries()
             if not service.canTranslate:
                 continue
+            if translator is None:
+                translator = BatchTranslator(service)
+                run_translator = True
+            queued = set()
             # pick randomly. TODO: Recency order?
             for original in originals:
                 source_loc = (service.asKnownLocale(original.locale) or
                               original.locale) or 'und'
                 for dest in translation_table.languages_for(
                         source_loc, content.db):
-                    if locale_compatible(dest, source_loc):
+                    if dest in queued or locale_compatible(dest, source_loc):
                         continue
                     entry = entries.get(dest, None)
                     is_html = (prop == "body" and
@@ -117,22 +254,35 @@ def translate_content(
                     if entry is None or (
                             entry.error_code and
                             not service.has_fatal_error(entry)):
-                        try:
-                            result = service.translate_lse(
-                                original, dest, is_html=is_html)
-                        except:
-                            capture_exception()
-                            return changed
-                        # recalculate, may have changed
-                        source_loc = (
-                            service.asKnownLocale(original.locale) or
-                            original.locale)
-                        ls.db.expire(ls, ["entries"])
-                        entries[service.asKnownLocale(result.locale)
-                                or original.locale] = result
+                        translator.add(original, dest, is_html)
+                        queued.add(dest)
                         changed = True
     if changed and send_to_changes:
-        content.send_to_changes()
+        translator.send_to_changes(content)
+    if run_translator:
+        translator.run()
+    return changed
+
+
+def translate_posts(
+        posts, translation_table=None, service=None,
+        send_to_changes=False, translator=None):
+    "Translate many posts of a discussion, in batches"
+    if not posts:
+        return False
+    service = service or posts[0].discussion.translation_service()
+    if translation_table is None:
+        translation_table = DiscussionPreloadTranslationTable(
+            service, posts[0].discussion)
+    run_translator = translator is None
+    if run_translator:
+        translator = BatchTranslator(service)
+    changed = False
+    for post in posts:
+        changed |= translate_content(
+            post, translation_table, service, send_to_changes, translator)
+    if run_translator:
+        translator.run()
     return changed
 
 
@@ -143,20 +293,45 @@ def translate_content_task(content_id):
     translate_content(content)
 
 
+@celery.task(ignore_result=True, shared=False)
+def translate_contents(content_ids, send_to_changes=False):
+    "Translate contents in batches, once they are committed"
+    from ..models import Content
+    with transaction.manager:
+        contents = Content.default_db.query(Content).filter(
+            Content.id.in_(content_ids)).order_by(Content.id).options(
+            *Content.subqueryload_options()).all()
+        return translate_posts(contents, send_to_changes=send_to_changes)
+
+
 @celery.task(ignore_result=True, shared=False)
 def translate_discussion(
         discussion_id, translation_table=None,
-        send_to_changes=False):
-    from ..models import Discussion
-    discussion = Discussion.get(discussion_id)
-    service = discussion.translation_service()
-    if service.canTranslate is None:
-        return
-    if translation_table is None:
-        translation_table = DiscussionPreloadTranslationTable(
-            service, discussion)
+        send_to_changes=False, chunk_size=200):
+    """Translate all posts of a discussion, by chunks of posts in id order.
+
+    Each chunk is committed before the next one is started, so an
+    interrupted run loses at most one chunk of work; running the task
+    again skips the entries that were already translated."""
+    from ..models import Discussion, Post
     changed = False
-    for post in discussion.posts:
-        changed |= translate_content(
-            post, translation_table, service, send_to_changes)
-    return changed
+    last_id = 0
+    while True:
+        with transaction.manager:
+            discussion = Discussion.get(discussion_id)
+            service = discussion.translation_service()
+            if service.canTranslate is None:
+                return changed
+            if translation_table is None:
+                translation_table = DiscussionPreloadTranslationTable(
+                    service, discussion)
+            posts = discussion.db.query(Post).filter(
+                Post.discussion_id == discussion_id,
+                Post.id > last_id
+            ).order_by(Post.id).options(
+                *Post.subqueryload_options()).limit(chunk_size).all()
+            if not posts:
+                return changed
+            last_id = posts[-1].id
+            changed |= translate_posts(
+                posts, translation_table, service, send_to_changes)
@@ -66,3 +66,69 @@ def test_restricted_discussion_expiry_override(
     admin_user.last_idealoom_login = long_ago
     admin_social_account.last_checked = now
     assert not admin_user.login_expired(closed_discussion)
+
+
+def test_permission_resolver(
+        test_session, discussion, participant1_user):
+    from assembl.auth import R_PARTICIPANT, R_MODERATOR, P_READ
+    from assembl.auth.util import PermissionResolver
+    from assembl.models import LocalUserRole, Role
+
+    class Request(object):
+        pass
+
+    resolver = PermissionResolver()
+    request = Request()
+    resolved = resolver.get(participant1_user.id, discussion.id, request)
+    assert R_PARTICIPANT in resolved.roles
+    assert P_READ in resolved.permissions
+    misses = resolver.misses
+    # the same request does not query again
+    assert resolver.get(participant1_user.id, discussion.id, request) is resolved
+    assert resolver.misses == misses
+    assert resolver.hits == 1
+    # role changes are recorded for invalidation at commit
+    lur = LocalUserRole(
+        user=participant1_user, discussion=discussion,
+        role=Role.getByName(R_MODERATOR, test_session))
+    test_session.add(lur)
+    test_session.flush()
+    user_ids, discussion_ids = test_session.info['permission_changes']
+    assert participant1_user.id in user_ids
+    resolved = resolver.get(participant1_user.id, discussion.id, Request())
+    assert R_MODERATOR in resolved.roles
+    test_session.delete(lur)
+    test_session.flush()
+
+
+def test_permission_resolver_with_region(
+        test_session, discussion, participant1_user, monkeypatch):
+    from dogpile.cache import make_region
+    from assembl.auth import R_MODERATOR
+    from assembl.auth.util import PermissionResolver
+    from assembl.lib import caching
+    from assembl.models import LocalUserRole, Role
+
+    class Request(object):
+        pass
+
+    monkeypatch.setitem(
+        caching._regions, 'permissions',
+        make_region().configure('dogpile.cache.memory'))
+    resolver = PermissionResolver()
+    resolved = resolver.get(participant1_user.id, discussion.id, Request())
+    assert R_MODERATOR not in resolved.roles
+    # shared across requests
+    misses = resolver.misses
+    resolver.get(participant1_user.id, discussion.id, Request())
+    assert resolver.misses == misses
+    # uncommitted role changes bypass the region
+    lur = LocalUserRole(
+        user=participant1_user, discussion=discussion,
+        role=Role.getByName(R_MODERATOR, test_session))
+    test_session.add(lur)
+    test_session.flush()
+    resolved = resolver.get(participant1_user.id, discussion.id, Request())
+    assert R_MODERATOR in resolved.roles
+    test_session.delete(lur)
+    test_session.flush()
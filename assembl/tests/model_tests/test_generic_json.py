@@ -0,0 +1,63 @@
+from pyramid.security import Everyone
+
+from assembl.auth import P_READ
+
+
+def test_json_serializer_is_cached(
+        test_session, discussion, root_post_1):
+    cls = root_post_1.__class__
+    for view_def_name in ('default', 'partial_post', 'changes'):
+        serializer = cls.get_json_serializer(view_def_name)
+        assert serializer is not None
+        assert cls.get_json_serializer(view_def_name) is serializer
+        json = root_post_1.generic_json(view_def_name)
+        assert json['@id'] == root_post_1.uri()
+        assert json['@type'] == cls.external_typename()
+        assert json['@view'] == view_def_name
+
+
+def test_json_serializer_expected_json(
+        test_session, discussion, participant2_user, root_post_1,
+        reply_post_1):
+    post = reply_post_1
+    common = {
+        "@id": post.uri(),
+        "@type": "Post",
+        "date": "2000-01-04T00:00:00Z",
+        "parentId": root_post_1.uri(),
+        "idCreator": participant2_user.uri(),
+        "publication_state": post.publication_state.name,
+    }
+    json = post.generic_json('partial_post')
+    assert json == dict(common, **{"@view": "partial_post"})
+    assert post.generic_json(
+        'partial_post', Everyone, (P_READ, ), 'local:') == json
+    expected = {
+        'default': dict(
+            common, **{"@view": "default"}, created=common["date"],
+            discussion=discussion.uri(), attachments=[], extracts=[]),
+        'changes': dict(
+            common, created=common["date"], discussion=discussion.uri(),
+            attachments=[], extracts=[]),
+    }
+    for view_def_name, expected_json in expected.items():
+        json = post.generic_json(view_def_name)
+        assert {k: json.get(k) for k in expected_json} == expected_json
+        for name in ('subject', 'body'):
+            assert name in json
+        # excluded by the view_def
+        for name in ('id', 'type', 'ancestry', 'message_id', 'import_date'):
+            assert name not in json
+    assert "@private" in post.generic_json('changes')
+    assert root_post_1.generic_json('partial_post').get("parentId") is None
+
+
+def test_generic_json_many(
+        test_session, discussion, root_post_1, reply_post_1, reply_post_2):
+    from assembl.models import Post
+    posts = [root_post_1, reply_post_1, reply_post_2]
+    for view_def_name in ('default', 'partial_post'):
+        expected = [post.generic_json(view_def_name) for post in posts]
+        for post in posts:
+            test_session.expire(post)
+        assert Post.generic_json_many(posts, view_def_name) == expected
@@ -0,0 +1,33 @@
+def test_idea_hierarchy(
+        test_session, discussion, root_idea, subidea_1, subidea_1_1,
+        subidea_1_1_1, subidea_1_2, subidea_1_2_1):
+    from assembl.models import IdeaHierarchy
+    hierarchy = IdeaHierarchy.load(test_session, discussion.id)
+    assert hierarchy.root_id == root_idea.id
+    assert hierarchy.children[None] == (root_idea.id,)
+    assert hierarchy.children[root_idea.id] == (subidea_1.id,)
+    assert set(hierarchy.children[subidea_1.id]) == {
+        subidea_1_1.id, subidea_1_2.id}
+    assert hierarchy.children[subidea_1_2_1.id] == ()
+    assert hierarchy.parent[subidea_1_2_1.id] == subidea_1_2.id
+    assert hierarchy.depth[subidea_1_1_1.id] == 3
+    assert list(hierarchy.ancestors(subidea_1_1_1.id)) == [
+        subidea_1_1_1.id, subidea_1_1.id, subidea_1.id, root_idea.id]
+    assert hierarchy.is_ancestor(subidea_1.id, subidea_1_2_1.id)
+    assert hierarchy.is_ancestor(subidea_1_2.id, subidea_1_2.id)
+    assert not hierarchy.is_ancestor(
+        subidea_1_2.id, subidea_1_2.id, inclusive=False)
+    assert not hierarchy.is_ancestor(subidea_1_1.id, subidea_1_2_1.id)
+    assert set(hierarchy.descendants(subidea_1.id, False)) == {
+        subidea_1_1.id, subidea_1_1_1.id, subidea_1_2.id, subidea_1_2_1.id}
+    assert set(subidea_1_1.get_all_descendants(True)) == {
+        id for (id,) in test_session.query(
+            subidea_1_1.get_descendants_query_cls(subidea_1_1.id))}
+    # The hierarchy follows uncommitted changes
+    link = subidea_1_2.source_links[0]
+    link.source = subidea_1_1
+    test_session.flush()
+    hierarchy = IdeaHierarchy.get(test_session, discussion.id)
+    assert hierarchy.is_ancestor(subidea_1_1.id, subidea_1_2_1.id)
+    link.source = subidea_1
+    test_session.flush()
@@ -3,6 +3,7 @@
 from future import standard_library
 standard_library.install_aliases()
 import json
+import os
 import pytest
 from urllib.parse import urlencode, quote_plus
 import lxml.html
@@ -450,4 +451,173 @@ Yes!
 
     check_striping_plaintext(original, expected, "Gmail plaintext, circa 2012")
 
-    
\ No newline at end of file
+
+class FakeIMAPClient(object):
+    "A local stand-in for an IMAP server, with messages by uid"
+    def __init__(self, messages):
+        self.messages = messages
+        self.fetches = []
+
+    def search(self, criteria):
+        if criteria == ['ALL']:
+            return list(self.messages)
+        first = int(criteria[1].split(':')[0])
+        # n:* always includes the last uid
+        return [uid for uid in self.messages if uid >= first] or [
+            max(self.messages)]
+
+    def fetch(self, uids, data):
+        self.fetches.append(list(uids))
+        return {uid: {b"RFC822": self.messages[uid]}
+                for uid in uids if uid in self.messages}
+
+    def logout(self):
+        pass
+
+
+def test_imap_import_in_batches(test_session, discussion, monkeypatch):
+    from assembl.models import IMAPMailbox
+    from assembl.tasks.translate import translate_contents
+    maildir = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'fixtures',
+        'jack_layton_fixtures_maildir', 'cur')
+    messages = {}
+    for name in os.listdir(maildir):
+        with open(os.path.join(maildir, name), 'rb') as f:
+            messages[int(name)] = f.read()
+    server = FakeIMAPClient(messages)
+    translated = []
+    monkeypatch.setattr(IMAPMailbox, 'imap_client', lambda self: server)
+    monkeypatch.setattr(IMAPMailbox, 'fetch_batch_size', 8)
+    monkeypatch.setattr(
+        translate_contents, 'delay',
+        lambda ids, send_to_changes=False: translated.extend(ids))
+    mbox = IMAPMailbox(
+        discussion=discussion, name='imap', host='localhost', port=993,
+        username='user', password='password')
+    test_session.add(mbox)
+    test_session.flush()
+    mbox_id = mbox.id
+    try:
+        IMAPMailbox.do_import_content(mbox, only_new=True)
+        assert server.fetches == [
+            list(range(1, 9)), list(range(9, 17)), list(range(17, 21))]
+        mbox = IMAPMailbox.get(mbox_id)
+        assert mbox.last_imported_email_uid == '20'
+        email_ids = {id for (id,) in test_session.query(Email.id).filter_by(
+            source_id=mbox_id)}
+        assert email_ids
+        # translation is deferred, after each batch is committed
+        assert set(translated) == email_ids
+        # resuming fetches nothing already imported
+        server.fetches = []
+        IMAPMailbox.do_import_content(mbox, only_new=True)
+        assert server.fetches == []
+    finally:
+        mbox = IMAPMailbox.get(mbox_id)
+        agents = set()
+        for post in mbox.contents:
+            agents.add(post.creator)
+            test_session.delete(post)
+        for agent in agents:
+            test_session.delete(agent)
+        test_session.delete(mbox)
+        test_session.flush()
+
+
+JACK_LAYTON_ROOT = '1606949.IA7dUeR8YG@benoitg-t510'
+# message-id: message-id of the expected parent
+JACK_LAYTON_PARENTS = {
+    JACK_LAYTON_ROOT: None,
+    '1649857.fOz6x3G98J@benoitg-t510': JACK_LAYTON_ROOT,
+    '2249242.d9RG67mvG7@benoitg-t510': '3844624.NgDPPPZZnZ@benoitg-t510',
+    # References skip an email: the In-Reply-To wins
+    '2046194.jVzdDay1Sb@benoitg-t510': '5376192.Toza0VnpdF@benoitg-t510',
+    # Replies to a missing email go under its closest known ancestor
+    'CAKqvEwBXC5+hHJ7Vqe2uOxhvq0tjiPBFGTgrKgBJWg-8OJvK4g@mail.gmail.com':
+        JACK_LAYTON_ROOT,
+    '2400278.6mpFWar2xg@benoitg-t510': '1720706.VGpvc9NSuf@benoitg-t510',
+}
+
+
+def check_jack_layton_parents(mailbox):
+    emails = {email.source_post_id: email for email in mailbox.contents}
+    for message_id, parent_id in JACK_LAYTON_PARENTS.items():
+        parent = emails[message_id].parent
+        assert (parent.source_post_id if parent else None) == parent_id
+
+
+def test_incremental_threading(jack_layton_mailbox, test_session):
+    from assembl.models import EmailThreader
+    # threaded incrementally by the import, in maildir order
+    check_jack_layton_parents(jack_layton_mailbox)
+    EmailThreader(test_session, jack_layton_mailbox.discussion_id).rebuild()
+    test_session.flush()
+    check_jack_layton_parents(jack_layton_mailbox)
+
+
+def test_threading_reply_before_parent(jack_layton_mailbox, test_session):
+    from email.parser import HeaderParser
+    from assembl.models import (
+        AbstractMailbox, EmailThreadContainer, EmailThreader)
+    discussion_id = jack_layton_mailbox.discussion_id
+    test_session.query(EmailThreadContainer).filter_by(
+        discussion_id=discussion_id).delete(synchronize_session=False)
+    threader = EmailThreader(test_session, discussion_id)
+    # Emails only get a container when added, as in rebuild
+    threader.complete = True
+    parser = HeaderParser()
+    # Each reply is imported before the email it answers
+    for email in sorted(jack_layton_mailbox.contents,
+                        key=lambda email: email.creation_date,
+                        reverse=True):
+        headers = parser.parsestr(
+            AbstractMailbox.guess_encoding(email.imported_blob))
+        threader.add(email, AbstractMailbox.message_references(headers))
+        threader.apply()
+    test_session.flush()
+    check_jack_layton_parents(jack_layton_mailbox)
+
+
+def test_maildir_import_deduplicates(test_session, discussion, tmpdir):
+    from assembl.models import MaildirMailbox
+    fixture_dir = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'fixtures',
+        'jack_layton_fixtures_maildir', 'cur')
+    cur = tmpdir.mkdir('cur')
+    for name in ('1', '2'):
+        with open(os.path.join(fixture_dir, name), 'rb') as f:
+            message = f.read()
+        cur.join(name).write_binary(message)
+        # An identical copy
+        cur.join(name + '.copy').write_binary(message)
+    # Same message-id, other content
+    cur.join('2.resent').write_binary(message.replace(
+        b'Subject:', b'X-Resent: yes\nSubject:', 1))
+    mbox = MaildirMailbox(
+        discussion=discussion, name='maildir',
+        filesystem_path=str(tmpdir))
+    test_session.add(mbox)
+    test_session.flush()
+    mbox_id = mbox.id
+
+    def count_emails():
+        return test_session.query(Email).filter_by(source_id=mbox_id).count()
+
+    try:
+        MaildirMailbox.do_import_content(mbox, only_new=True)
+        assert count_emails() == 2
+        # Already imported messages are skipped
+        MaildirMailbox.do_import_content(
+            MaildirMailbox.get(mbox_id), only_new=True)
+        assert count_emails() == 2
+    finally:
+        mbox = MaildirMailbox.get(mbox_id)
+        agents = set()
+        for post in mbox.contents:
+            agents.add(post.creator)
+            test_session.delete(post)
+        for agent in agents:
+            test_session.delete(agent)
+        test_session.delete(mbox)
+        test_session.flush()
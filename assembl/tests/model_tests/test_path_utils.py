@@ -157,3 +157,83 @@ def test_delete_posts(
     assert reply_post_2.is_tombstone
     assert reply_post_1.is_tombstone
 
+
+
+def test_post_path_index(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1):
+    from assembl.models.path_utils import PostPathIndex
+    ideas = (
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1)
+    discussion_id = subidea_1.discussion_id
+    counters = subidea_1.prepare_counters(discussion_id, True)
+    index = PostPathIndex(counters.paths)
+    posts = test_session.query(Post.id, Post.ancestry).filter_by(
+        discussion_id=discussion_id).all()
+    ideas_by_post = {
+        id: index.ideas_including("%s%d," % (ancestry or "", id))
+        for (id, ancestry) in posts}
+    for idea in ideas:
+        posts_of_idea = {id for (id,) in test_session.execute(
+            counters.paths[idea.id].as_clause_base(
+                test_session, discussion_id, include_deleted=None))}
+        assert posts_of_idea == {
+            id for (id, idea_ids) in ideas_by_post.items()
+            if idea.id in idea_ids}
+
+
+def test_stored_idea_post_counts(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1):
+    from assembl.models import IdeaPostCount
+    from assembl.models.path_utils import (
+        DiscussionGlobalData, pending_count_updates)
+    ideas = (
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1)
+    discussion_id = subidea_1.discussion_id
+    expected = {idea.id: idea.num_total_and_read_posts for idea in ideas}
+    DiscussionGlobalData(test_session, discussion_id).update_stored_counts()
+    # Forget the changes made by fixtures, the rebuild covers them
+    test_session.info.pop('idea_post_count_changes', None)
+
+    def stored_counts():
+        return {
+            idea_id: (num_posts, num_contributors, 0)
+            for (idea_id, num_posts, num_contributors) in test_session.query(
+                IdeaPostCount.idea_id, IdeaPostCount.num_posts,
+                IdeaPostCount.num_contributors
+            ).filter_by(discussion_id=discussion_id)}
+
+    stored = stored_counts()
+    for idea in ideas:
+        assert stored[idea.id] == expected[idea.id]
+
+    # Counts are now read from the table
+    data = DiscussionGlobalData(test_session, discussion_id)
+    counter = data.post_path_counter(None, True)
+    assert not counter.counts
+    for idea in ideas:
+        assert counter.get_counts(idea.id) == expected[idea.id]
+
+    # Deleting a post updates the counts of the ideas that include it
+    post = test_session.query(Post).filter_by(
+        discussion_id=discussion_id).order_by(Post.id.desc()).first()
+    post.delete_post(PublicationStates.DELETED_BY_ADMIN)
+    test_session.flush()
+    test_webrequest.discussion_data = None
+    expected = {idea.id: idea.num_total_and_read_posts for idea in ideas}
+    # As the task run after commit would
+    for discussion_id, changes in pending_count_updates(test_session).items():
+        DiscussionGlobalData(
+            test_session, discussion_id).update_stored_counts(changes)
+    stored = stored_counts()
+    for idea in ideas:
+        assert stored[idea.id] == expected[idea.id]
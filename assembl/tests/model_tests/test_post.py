@@ -0,0 +1,74 @@
+def test_set_parent_moves_descendants(
+        test_session, discussion, root_post_1, reply_post_1, reply_post_2,
+        reply_post_3):
+    from assembl.models import Post
+
+    def stored_ancestry(post):
+        return test_session.query(Post.ancestry).filter_by(
+            id=post.id).scalar()
+
+    from assembl.models.post import PostAncestryChange
+    connection_info = test_session.connection().info
+    # forget the changes of the fixtures
+    connection_info.pop('cdict', None)
+    reply_post_1.set_parent(reply_post_3)
+    test_session.flush()
+    new_ancestry = "%d,%d,%d," % (
+        root_post_1.id, reply_post_3.id, reply_post_1.id)
+    # the loaded descendant is updated without being dirty
+    assert reply_post_2.ancestry == new_ancestry
+    assert reply_post_2 not in test_session.dirty
+    assert stored_ancestry(reply_post_2) == new_ancestry
+    # and its new ancestry is sent from the updated row
+    (_, change) = connection_info['cdict'][(reply_post_2.uri(), 'changes')]
+    assert isinstance(change, PostAncestryChange)
+    assert change.generic_json()['ancestors'] == [
+        post.uri() for post in (root_post_1, reply_post_3, reply_post_1)]
+    reply_post_1.set_parent(root_post_1)
+    test_session.flush()
+    assert stored_ancestry(reply_post_2) == "%d,%d," % (
+        root_post_1.id, reply_post_1.id)
+
+
+def test_post_ancestor_loader(
+        test_session, discussion, root_post_1, reply_post_1, reply_post_2,
+        reply_post_3):
+    from assembl.models import PostAncestorLoader
+    loader = PostAncestorLoader(test_session)
+    loader.load([reply_post_2, reply_post_3])
+    assert set(loader.posts_by_id) == {
+        root_post_1.id, reply_post_1.id, reply_post_2.id, reply_post_3.id}
+    assert reply_post_2.ancestors(loader) == [root_post_1, reply_post_1]
+    assert reply_post_3.ancestors(loader) == [root_post_1]
+    assert root_post_1.ancestors(loader) == []
+
+
+def test_post_idea_content_link_index(
+        test_session, discussion, root_post_1, reply_post_1, reply_post_2,
+        reply_post_3, extract_post_1_to_subidea_1_1):
+    from assembl.models import PostIdeaContentLink
+    link_id = extract_post_1_to_subidea_1_1.id
+
+    def linked_posts():
+        return {post_id for (post_id, link_ids) in
+                PostIdeaContentLink.link_ids_by_post(test_session, [
+                    root_post_1.id, reply_post_1.id, reply_post_2.id,
+                    reply_post_3.id]).items()
+                if link_id in link_ids}
+
+    assert linked_posts() == {reply_post_1.id, reply_post_2.id}
+    json = reply_post_2.indirect_idea_content_links_with_cache()
+    assert [icl['@id'] for icl in json] == [
+        extract_post_1_to_subidea_1_1.uri()]
+    # Moving the linked post moves its subtree's links
+    reply_post_1.set_parent(reply_post_3)
+    test_session.flush()
+    assert linked_posts() == {reply_post_1.id, reply_post_2.id}
+    reply_post_1.set_parent(root_post_1)
+    reply_post_3.set_parent(reply_post_2)
+    test_session.flush()
+    assert linked_posts() == {
+        reply_post_1.id, reply_post_2.id, reply_post_3.id}
+    reply_post_3.set_parent(root_post_1)
+    test_session.flush()
+    assert linked_posts() == {reply_post_1.id, reply_post_2.id}
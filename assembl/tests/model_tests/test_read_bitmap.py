@@ -0,0 +1,57 @@
+from assembl.lib.bitmap import IdBitmap
+
+
+def test_id_bitmap():
+    bitmap = IdBitmap([100, 5, 77])
+    assert list(bitmap) == [5, 77, 100]
+    assert 77 in bitmap and 78 not in bitmap and 1000 not in bitmap
+    bitmap.update(range(10, 30))
+    bitmap.discard(15)
+    assert len(bitmap) == 22
+    assert 15 not in bitmap and 29 in bitmap and 30 not in bitmap
+    copy = IdBitmap.from_bytes(bitmap.base, bitmap.to_bytes())
+    assert copy == bitmap
+    bitmap.difference_update(range(0, 200))
+    assert not bitmap
+
+
+def test_id_bitmap_runs():
+    # Ids of other discussions in between cost nothing
+    bitmap = IdBitmap(list(range(1000, 1100)) + [10 ** 7])
+    assert len(bitmap.to_bytes()) < 10
+    bitmap.discard(1050)
+    assert len(bitmap.starts) == 3
+    bitmap.add(1050)
+    assert len(bitmap.starts) == 2
+    copy = IdBitmap.from_bytes(bitmap.base, bitmap.to_bytes())
+    assert copy == bitmap and len(copy) == 101
+
+
+def test_post_read_bitmap(
+        test_session, discussion, participant1_user, root_post_1,
+        reply_post_1, reply_post_2):
+    from assembl.models import PostReadBitmap, ViewPost
+    user_id = participant1_user.id
+
+    def stored_bitmaps():
+        return test_session.query(PostReadBitmap).filter_by(
+            user_id=user_id, discussion_id=discussion.id).count()
+
+    assert list(discussion.read_post_ids(user_id)) == []
+    # Reading does not store the bitmap
+    assert not stored_bitmaps()
+    view = ViewPost(actor_id=user_id, post=reply_post_1)
+    test_session.add(view)
+    test_session.flush()
+    # Bitmaps are brought up to date at commit
+    from assembl.models.action import update_post_read_bitmaps
+    update_post_read_bitmaps(test_session)
+    bitmap = PostReadBitmap.get_bitmap(test_session, user_id, discussion.id)
+    assert set(bitmap) == {reply_post_1.id}
+    assert stored_bitmaps() == 1
+    view.is_tombstone = True
+    test_session.flush()
+    update_post_read_bitmaps(test_session)
+    assert list(discussion.read_post_ids(user_id)) == []
+    test_session.delete(view)
+    test_session.flush()
@@ -0,0 +1,31 @@
+import numpy as np
+from scipy.sparse import lil_matrix
+
+from assembl.nlp.clusters import SemanticAnalysisData
+
+
+def lil_gensimvecs_to_csr(vecs, width, topic_intensities):
+    "The former implementation, for reference"
+    model_matrix = lil_matrix((len(vecs), width), dtype=np.float64)
+    for nrow, row in enumerate(vecs):
+        for ncol, val in row:
+            model_matrix[nrow, ncol] = val * topic_intensities[ncol]
+    return model_matrix.tocsr()
+
+
+def test_gensimvecs_to_csr():
+    topic_intensities = [2.0, 1.0, 0.5, 0.25]
+    vecs = [
+        [(0, 1.0), (2, 0.5)],
+        [],
+        [(1, -3.0), (3, 2.0)],
+        [(3, 1.5)],
+        []]
+    expected = lil_gensimvecs_to_csr(vecs, 4, topic_intensities)
+    result = SemanticAnalysisData.gensimvecs_to_csr(
+        iter(vecs), 4, topic_intensities)
+    assert result.shape == (5, 4)
+    assert (result.toarray() == expected.toarray()).all()
+    assert result.nnz == 5
+    empty = SemanticAnalysisData.gensimvecs_to_csr([], 4, topic_intensities)
+    assert empty.shape == (0, 4) and empty.nnz == 0
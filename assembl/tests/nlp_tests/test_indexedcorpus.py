@@ -0,0 +1,44 @@
+import os
+
+from assembl.nlp.indexedcorpus import AppendableIdCorpus
+
+
+def test_appendable_id_corpus(tmpdir):
+    fname = str(tmpdir.join('corpus.mm'))
+    corpus = AppendableIdCorpus(fname)
+    assert len(corpus) == 0 and list(corpus) == []
+    corpus.update([
+        (3, 'c', [(0, 1.0), (2, 0.5)]),
+        (1, 'a', [(1, 2.0)]),
+        (2, 'b', [])])
+    assert corpus.dockeys == [1, 2, 3]
+    assert list(corpus) == [[(1, 2.0)], [], [(0, 1.0), (2, 0.5)]]
+    assert corpus[3] == [(0, 1.0), (2, 0.5)]
+    assert list(corpus[[3, 1]]) == [[(0, 1.0), (2, 0.5)], [(1, 2.0)]]
+    # replacing a document appends it; iteration still follows dockeys
+    corpus.update([(1, 'a2', [(4, 0.25)])])
+    assert corpus.fingerprint(1) == 'a2'
+    assert corpus.num_lines == 4
+    assert list(zip(corpus.dockeys, corpus)) == [
+        (1, [(4, 0.25)]), (2, []), (3, [(0, 1.0), (2, 0.5)])]
+    # the index is reloaded
+    reloaded = AppendableIdCorpus(fname)
+    assert reloaded.offsets == corpus.offsets
+    assert reloaded.fingerprint(3) == 'c'
+    assert list(reloaded) == list(corpus)
+    # removed documents are skipped, until compaction drops their lines
+    corpus.remove([2])
+    assert 2 not in corpus and corpus.dockeys == [1, 3]
+    size = os.path.getsize(fname)
+    corpus.compact()
+    assert corpus.num_lines == 2
+    assert os.path.getsize(fname) < size
+    assert list(corpus) == [[(4, 0.25)], [(0, 1.0), (2, 0.5)]]
+    assert list(AppendableIdCorpus(fname)) == list(corpus)
+    # compacted automatically when most lines are superseded
+    for fingerprint in ('x', 'y', 'z'):
+        corpus.update([(3, fingerprint, [(5, 1.5)])])
+    assert corpus.num_lines <= 2 * len(corpus)
+    assert corpus[3] == [(5, 1.5)] and corpus[1] == [(4, 0.25)]
+    corpus.clear()
+    assert list(corpus) == [] and not AppendableIdCorpus(fname).offsets
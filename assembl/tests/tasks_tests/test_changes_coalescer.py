@@ -0,0 +1,53 @@
+import simplejson as json
+
+from assembl.lib.zmqlib import ChangesCoalescer
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data, flags=0):
+        pass
+
+    def send_json(self, data):
+        self.sent.append(json.loads(json.dumps(data)))
+
+
+def test_coalescer_keeps_last_state():
+    coalescer = ChangesCoalescer(0.5, 100)
+    socket = FakeSocket()
+    coalescer.merge('1', [
+        {"@id": "local:Idea/1", "@type": "Idea", "title": "a"},
+        {"@id": "local:Content/2", "@type": "Post"}])
+    coalescer.merge('1', [
+        {"@id": "local:Idea/1", "@type": "Idea", "title": "b"},
+        {"@id": "local:Agent/3", "@type": "User"},
+        {"@id": "local:Agent/3", "@type": "User", "@view": "private"}])
+    coalescer.merge('*', [{"@id": "local:Agent/3", "@type": "User"}])
+    assert coalescer.num_pending == 5
+    coalescer.flush(socket)
+    assert coalescer.num_pending == 0
+    assert coalescer.deadline is None
+    by_discussion = {len(changes): changes for changes in socket.sent}
+    changes = by_discussion[4]
+    assert [c["@id"] for c in changes] == [
+        "local:Content/2", "local:Idea/1", "local:Agent/3", "local:Agent/3"]
+    assert changes[1]["title"] == "b"
+
+
+def test_coalescer_keeps_changes_without_id():
+    coalescer = ChangesCoalescer(0.5, 100)
+    socket = FakeSocket()
+    coalescer.merge('1', [
+        {"@type": "Connection", "user": "local:Agent/1"},
+        {"@id": "local:Idea/1", "@type": "Idea", "title": "a"}])
+    coalescer.merge('1', [
+        {"@type": "Connection", "user": "local:Agent/2"},
+        {"@id": "local:Idea/1", "@type": "Idea", "title": "b"}])
+    assert coalescer.num_pending == 3
+    coalescer.flush(socket)
+    [changes] = socket.sent
+    assert [c.get("user") for c in changes if "@id" not in c] == [
+        "local:Agent/1", "local:Agent/2"]
+    assert [c["title"] for c in changes if "@id" in c] == ["b"]
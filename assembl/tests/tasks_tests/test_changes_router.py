@@ -0,0 +1,179 @@
+from collections import OrderedDict, defaultdict
+
+import simplejson as json
+
+from assembl.tasks.changes_router import (
+    ChangeMessage, Dispatcher, Everyone)
+
+
+def make_change(num_users=20):
+    return json.dumps([
+        {"@id": "local:Content/1", "@type": "Post"},
+        {"@id": "local:Idea/2", "@type": "Idea",
+         "@private": ["r:administrator"]},
+    ] + [
+        {"@id": "local:Notification/%d" % i, "@type": "Notification",
+         "@private": ["local:Agent/%d" % i]}
+        for i in range(num_users)])
+
+
+def filter_for_roles(data, roles):
+    # Reference implementation: what each socket used to do
+    if "r:sysadmin" in roles or '@private' not in data:
+        return data
+    allowed = [x for x in json.loads(data)
+               if x.get('@private', None) is None
+               or roles.intersection(set(x['@private']))]
+    return json.dumps(allowed) if allowed else None
+
+
+def socket_roles(num_sockets, num_users=20):
+    roles = []
+    for i in range(num_sockets):
+        r = {Everyone, "local:Agent/%d" % (i % (num_users * 2))}
+        if i % 50 == 0:
+            r.add("r:administrator")
+        if i % 500 == 0:
+            r.add("r:sysadmin")
+        roles.append(r)
+    return roles
+
+
+def test_change_message_for_roles():
+    data = make_change()
+    message = ChangeMessage(data)
+    for roles in socket_roles(200):
+        assert message.for_roles(roles) == filter_for_roles(data, roles)
+    # participants without notifications, admins, each user
+    assert len(message.variants) <= 2 + 2 * 20
+
+
+def test_change_message_variants_are_shared(monkeypatch):
+    from assembl.tasks import changes_router
+    calls = {'loads': 0, 'dumps': 0}
+
+    def counting(name):
+        function = getattr(json, name)
+
+        def counted(*args, **kwargs):
+            calls[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    monkeypatch.setattr(changes_router, 'json', type(
+        'CountingJson', (object, ), {
+            'loads': staticmethod(counting('loads')),
+            'dumps': staticmethod(counting('dumps'))}))
+    data = make_change()
+    message = ChangeMessage(data)
+    roles = socket_roles(2000)
+    results = [message.for_roles(r) for r in roles]
+    # parsed once, each variant serialized once
+    assert calls['loads'] == 1
+    assert calls['dumps'] == len(message.variants)
+    by_value = {}
+    for result in results:
+        if result is data:
+            continue  # sysadmins get the message as is
+        # sockets that see the same thing share the same string
+        assert by_value.setdefault(result, result) is result
+
+
+def test_discussion_subscription_fan_out():
+    import asyncio
+    import zmq
+    from zmq.asyncio import Context
+    from assembl.tasks.changes_router import Dispatcher
+
+    class FakeSocket(object):
+        def __init__(self, discussion):
+            self.discussion = discussion
+
+        async def close(self):
+            pass
+
+    async def run():
+        context = Context()
+        pub = context.socket(zmq.PUB)
+        pub.bind('inproc://test_changes')
+        dispatcher = Dispatcher.__new__(Dispatcher)
+        dispatcher.zmq_context = context
+        dispatcher.out_socket_name = 'inproc://test_changes'
+        dispatcher.recent_changes = OrderedDict()
+        dispatcher.subscriptions = {}
+        sockets = [FakeSocket('1'), FakeSocket('1'), FakeSocket('12')]
+        queues = [dispatcher.subscribe(s) for s in sockets]
+        assert len(dispatcher.subscriptions) == 2
+        await asyncio.sleep(0.2)  # slow joiner
+        await pub.send_multipart([b'1', b'0', make_change().encode('utf-8')])
+        first = await asyncio.wait_for(queues[0].get(), 1)
+        second = await asyncio.wait_for(queues[1].get(), 1)
+        assert first is second
+        await asyncio.sleep(0.1)
+        assert queues[2].empty()
+        for socket, queue in zip(sockets, queues):
+            dispatcher.unsubscribe(socket, socket.discussion, queue)
+        assert not dispatcher.subscriptions
+        await asyncio.sleep(0.1)
+        pub.close()
+        context.term()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_permission_cache():
+    import asyncio
+    from assembl.tasks.changes_router import PermissionCache
+
+    calls = []
+
+    def fetcher(value):
+        async def fetch():
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+        return fetch
+
+    async def run():
+        cache = PermissionCache(ttl=60)
+        # concurrent lookups share a call
+        results = await asyncio.gather(*[
+            cache.get('1', 'local:Agent/1', fetcher(i)) for i in range(10)])
+        assert results == [0] * 10
+        assert len(calls) == 1
+        assert await cache.get('1', 'local:Agent/1', fetcher(1)) == 0
+        assert await cache.get('1', 'local:Agent/2', fetcher(2)) == 2
+        assert cache.misses == 2
+        # a role change message for user 1
+        message = ChangeMessage(json.dumps([
+            {"@type": "LocalUserRole", "@id": "local:LocalUserRole/3",
+             "@private": "local:Agent/1", "role": "r:participant"}]))
+        cache.invalidate('1', message.changed_roles())
+        assert await cache.get('1', 'local:Agent/1', fetcher(3)) == 3
+        assert await cache.get('1', 'local:Agent/2', fetcher(4)) == 2
+        # a permission change affects everyone
+        message = ChangeMessage(json.dumps([
+            {"@type": "DiscussionPermission",
+             "@id": "local:DiscussionPermission/3"}]))
+        assert message.changed_roles() is None
+        cache.invalidate('1', message.changed_roles())
+        assert not cache.entries
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_connection_events_keep_order():
+    dispatcher = Dispatcher.__new__(Dispatcher)
+    dispatcher.connection_notifications = defaultdict(dict)
+    # a reconnection, and a quick visit, within one interval
+    dispatcher.notify_connection('1', 'a', True)
+    dispatcher.notify_connection('1', 'a', False)
+    dispatcher.notify_connection('1', 'b', True)
+    dispatcher.notify_connection('1', 'a', True)
+    dispatcher.notify_connection('1', 'b', False)
+    events = Dispatcher.connection_events(
+        dispatcher.connection_notifications['1'])
+    assert [(token, connecting) for (token, connecting, age) in events] == [
+        ('a', False), ('b', True), ('a', True), ('b', False)]
+    ages = [age for (token, connecting, age) in events]
+    assert ages == sorted(ages, reverse=True)
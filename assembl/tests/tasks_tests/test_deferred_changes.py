@@ -0,0 +1,11 @@
+def test_deferred_changes_match_inline(
+        test_session, discussion, root_post_1, reply_post_1):
+    from assembl.tasks.changes import serialize_deferred_changes
+    tombstone = reply_post_1.tombstone().generic_json()
+    entries = [
+        [root_post_1.external_typename(), root_post_1.uri(), 'changes'],
+        tombstone,
+        ["Content", "local:Content/0", 'changes'],
+    ]
+    assert serialize_deferred_changes(entries) == [
+        root_post_1.generic_json('changes'), tombstone]
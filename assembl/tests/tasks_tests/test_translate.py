@@ -0,0 +1,47 @@
+from assembl.nlp.translation_service import DummyTranslationServiceTwoSteps
+from assembl.tasks.translate import BatchTranslator, translate_posts
+
+
+class CountingTranslationService(DummyTranslationServiceTwoSteps):
+    max_batch_size = 3
+
+    def __init__(self, discussion):
+        super(CountingTranslationService, self).__init__(discussion)
+        self.batches = []
+
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        self.batches.append((source, target, len(texts)))
+        return super(CountingTranslationService, self).translate_batch(
+            texts, target, is_html, source=source)
+
+
+def test_translate_posts_in_batches(
+        test_session, discussion, root_post_1, reply_post_1):
+    posts = [root_post_1, reply_post_1]
+    for post in posts:
+        for ls in (post.subject, post.body):
+            for entry in ls.non_mt_entries():
+                entry.identify_locale('en', None, True)
+    test_session.flush()
+    service = CountingTranslationService(discussion)
+    translator = BatchTranslator(service)
+    assert translate_posts(posts, service=service, translator=translator)
+    # Nothing is sent before the translator runs
+    assert not service.batches
+    translator.run()
+    # 4 texts per target locale, in batches of at most 3
+    assert sorted(service.batches) == [
+        ('en', 'de', 1), ('en', 'de', 3), ('en', 'fr', 1), ('en', 'fr', 3)]
+    for post in posts:
+        for ls in (post.subject, post.body):
+            test_session.expire(ls, ["entries"])
+            entries = ls.entries_as_dict
+            original = ls.first_original().value
+            for target in ('fr', 'de'):
+                mt_entry = entries[target]
+                assert mt_entry.is_machine_translated
+                assert mt_entry.value.endswith(original)
+    # Already translated entries are not sent again
+    service.batches = []
+    assert not translate_posts(posts, service=service)
+    assert not service.batches
@@ -147,6 +147,27 @@ def test_get_ideas(discussion, test_app, test_session, test_webrequest):
     assert len(ideas) == num_ideas + 1
 
 
+def test_get_ideas_etag(discussion, test_app, test_session, test_webrequest):
+    url = get_url(discussion, 'ideas')
+    res = test_app.get(url)
+    assert res.status_code == 200
+    etag = res.headers['ETag']
+    assert etag.startswith('W/')
+    res = test_app.get(url, headers={'If-None-Match': etag})
+    assert res.status_code == 304
+
+    idea = Idea(
+        title=LangString.create('This is a test', 'en'),
+        discussion=discussion
+    )
+    test_session.add(idea)
+    test_session.flush()
+    test_session.commit()
+    res = test_app.get(url, headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+
+
 def disabledtest_next_synthesis_idea_management(
         discussion, test_app, test_session,
         root_idea, subidea_1, subidea_1_1, subidea_1_1_1):
@@ -375,6 +396,60 @@ def test_api_get_posts_queries(
     # TODO: Other query types, and sorting
 
 
+def test_api_get_posts_cursor(
+        discussion, test_app, test_session, participant1_user,
+        root_post_1, reply_post_1, reply_post_2):
+    base_post_url = get_url(discussion, 'posts')
+    for order in ('chronological', 'reverse_chronological', 'popularity'):
+        for view in ('default', 'id_only'):
+            seen = []
+            cursor = ''
+            while cursor is not None:
+                res = test_app.get(base_post_url + "?" + urlencode(dict(
+                    order=order, view=view, limit=2, cursor=cursor)))
+                assert res.status_code == 200
+                res_data = json.loads(res.body)
+                assert len(res_data['posts']) <= 2
+                seen.extend(
+                    p if view == 'id_only' else p['@id']
+                    for p in res_data['posts'])
+                cursor = res_data['next_cursor']
+            assert len(seen) == 3
+            assert len(set(seen)) == 3
+            if order == 'chronological':
+                assert seen[0] == root_post_1.uri()
+            elif order == 'reverse_chronological':
+                assert seen[-1] == root_post_1.uri()
+
+    res = test_app.get(base_post_url + "?cursor=garbage", expect_errors=True)
+    assert res.status_code == 400
+
+
+def test_api_mark_posts_read(
+        discussion, test_app, test_session, admin_user,
+        root_post_1, reply_post_1, reply_post_2):
+    from assembl.models import ViewPost
+    url = get_url(discussion, 'post_read')
+    res = test_app.put(url, json.dumps({"post_ids": [reply_post_1.uri()]}))
+    assert res.status_code == 200
+    assert json.loads(res.body)['read_posts'] == [reply_post_1.uri()]
+    # The whole thread; only unread posts are marked
+    res = test_app.put(url, json.dumps({"root_post_id": root_post_1.uri()}))
+    assert res.status_code == 200
+    assert set(json.loads(res.body)['read_posts']) == {
+        root_post_1.uri(), reply_post_2.uri()}
+    res = test_app.put(url, json.dumps({"root_post_id": root_post_1.uri()}))
+    assert json.loads(res.body)['read_posts'] == []
+    views = test_session.query(ViewPost).filter_by(
+        actor_id=admin_user.id, tombstone_date=None).all()
+    assert len(views) == 3
+    for view in views:
+        test_session.delete(view)
+    test_session.flush()
+    res = test_app.put(url, json.dumps({}), expect_errors=True)
+    assert res.status_code == 400
+
+
 def test_api_weird_failure_on_joinedload(
         discussion, test_app, test_session, participant1_user,
         root_post_1, reply_post_1, reply_post_2):
@@ -29,6 +29,28 @@ def local_to_absolute(uri):
     return uri
 
 
+def test_conditional_get(discussion, test_app, subidea_1, test_session):
+    from assembl.models import LangString
+    for url in ('/data/Conversation/%d/ideas/%d' % (
+                    discussion.id, subidea_1.id),
+                '/data/Conversation/%d/ideas' % (discussion.id,)):
+        res = test_app.get(url, headers=accept_json)
+        assert res.status_code == 200
+        etag = res.headers.get('ETag')
+        if etag is None:
+            pytest.skip("No dogpile backend to track changes")
+        res = test_app.get(url, headers=dict(
+            accept_json, **{'If-None-Match': etag}))
+        assert res.status_code == 304
+    subidea_1.title = LangString.create(u"changed title", "en")
+    test_session.flush()
+    test_session.commit()
+    res = test_app.get(url, headers=dict(
+        accept_json, **{'If-None-Match': etag}))
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+
+
 def test_get_ideas(discussion, test_app, synthesis_1,
                    subidea_1_1_1, test_session):
     all_ideas = test_app.get('/data/GenericIdeaNode')
@@ -63,6 +85,57 @@ def test_get_ideas(discussion, test_app, synthesis_1,
     assert subidea_1_1_1_id not in syn_ideas
 
 
+def test_get_ideas_streamed(discussion, test_app, subidea_1_1_1, test_session):
+    url = '/data/Conversation/%d/ideas' % (discussion.id,)
+    ideas = test_app.get(url)
+    assert ideas.status_code == 200
+    streamed_ideas = test_app.get(url + '?stream=true')
+    assert streamed_ideas.status_code == 200
+    assert streamed_ideas.content_type == 'application/json'
+    ideas = {idea['@id']: idea for idea in ideas.json}
+    streamed_ideas = {idea['@id']: idea for idea in streamed_ideas.json}
+    assert ideas == streamed_ideas
+
+
+def test_users_dis_connected_in_order(
+        discussion, test_app, test_session, participant1_user):
+    from assembl.lib.web_token import encode_token
+    from assembl.views.api2.auth import TOKEN_SECRET
+    status = participant1_user.create_agent_status_in_discussion(discussion)
+    test_session.flush()
+    token = encode_token({'userId': participant1_user.id}, TOKEN_SECRET)
+    url = '/data/Discussion/%d/users_dis_connected' % (discussion.id,)
+    # disconnection, then reconnection, within one interval
+    res = test_app.post_json(url, {'events': [
+        [token, False, 2.0], [token, True, 1.0]]})
+    assert res.status_code == 200
+    test_session.refresh(status)
+    assert status.last_disconnected < status.last_connected
+    # a quick visit
+    res = test_app.post_json(url, {'events': [
+        [token, True, 2.0], [token, False, 1.0]]})
+    assert res.status_code == 200
+    test_session.refresh(status)
+    assert status.last_connected < status.last_disconnected
+    test_session.delete(status)
+    test_session.flush()
+
+
+def test_json_stream_closes_on_error():
+    from assembl.lib.json import JSONStream
+
+    def items():
+        yield {"a": 1}
+        raise ValueError()
+
+    stream = JSONStream(items(), "items", lambda: {"total": 1})
+    assert json.loads(''.join(stream.iter_chunks())) == {
+        "items": [{"a": 1}], "error": "Incomplete response"}
+    assert stream.failed
+    stream = JSONStream(items())
+    assert json.loads(''.join(stream.iter_chunks())) == [{"a": 1}]
+
+
 def test_add_idea_in_synthesis(
         discussion, test_app, test_session, subidea_1_1):
     synthesis = discussion.next_synthesis
@@ -397,6 +397,37 @@ def get_template_views():
     return views
 
 
+def etag_matches(request, etag):
+    """Whether the client already has the version with that ETag.
+    Weak comparison, as for If-None-Match."""
+    header = request.headers.get('If-None-Match', None)
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    tag = etag[2:] if etag.startswith('W/') else etag
+    return any((candidate[2:] if candidate.startswith('W/') else candidate)
+               == tag for candidate in (
+                   c.strip() for c in header.split(',')))
+
+
+def not_modified_response(etag):
+    response = Response(status=304)
+    response.headers['ETag'] = etag
+    return response
+
+
+def etag_json_response(request, etag, value):
+    """Send this json string with its ETag, or Not Modified
+    if the client has it already."""
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+    response = Response(
+        body=value, content_type='application/json', charset='utf-8')
+    response.headers['ETag'] = etag
+    return response
+
+
 class JSONError(HTTPError):
 
     def __init__(self, detail=None, error_type=None,
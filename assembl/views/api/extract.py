@@ -10,6 +10,7 @@ from sqlalchemy.sql.expression import cast
 from sqlalchemy.orm import joinedload_all
 import simplejson as json
 
+from assembl.views import etag_json_response
 from assembl.views.api import API_DISCUSSION_PREFIX
 from assembl.auth import (
     P_READ, P_ADD_EXTRACT, P_EDIT_EXTRACT, P_ASSOCIATE_EXTRACT)
@@ -93,6 +94,11 @@ def _get_extracts_real(request, view_def='default', ids=None, user_id=None):
 def get_extracts(request):
     view_def = request.GET.get('view', 'default')
     ids = request.GET.getall('ids')
+    if view_def == 'default' and not ids:
+        # Same as the discussion page's preload
+        (etag, value) = request.discussion.related_extracts_preload(
+            authenticated_userid(request))
+        return etag_json_response(request, etag, value)
 
     return _get_extracts_real(
         request, view_def, ids, authenticated_userid(request))
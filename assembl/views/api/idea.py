@@ -12,6 +12,7 @@ from sqlalchemy import and_
 from sqlalchemy.orm import (joinedload, subqueryload, undefer)
 
 from assembl.lib.parsedatetime import parse_datetime
+from assembl.views import etag_json_response
 from assembl.models import (
     Idea, RootIdea, IdeaLink, Discussion, IdeaExtractLink,
     Extract, SubGraphIdeaAssociation, LangString)
@@ -196,8 +197,7 @@ def _get_ideas_real(request, view_def=None, ids=None, user_id=None,
     # cProfile.runctx('''retval = [idea.generic_json(None, %d, %s)
     #           for idea in ideas]''' % (user_id, permissions),
     #           globals(), locals(), 'json_stats')
-    retval = [idea.generic_json(view_def, user_id, permissions)
-              for idea in ideas]
+    retval = Idea.generic_json_many(ideas, view_def, user_id, permissions)
     retval = [x for x in retval if x is not None]
     for r in retval:
         if r.get('widget_links', None) is not None:
@@ -215,6 +215,10 @@ def get_ideas(request):
     view_def = request.GET.get('view')
     ids = request.GET.getall('ids')
     modified_after = request.GET.get('modified_after')
+    if not (view_def or ids or modified_after):
+        # Same as the discussion page's preload
+        (etag, value) = request.discussion.ideas_preload(user_id)
+        return etag_json_response(request, etag, value)
     if modified_after:
         modified_after = parse_datetime(modified_after, True)
     return _get_ideas_real(
@@ -2,6 +2,9 @@
 from __future__ import division
 from builtins import next
 from math import ceil
+from datetime import datetime
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import binascii
 import logging
 from collections import defaultdict
 from itertools import chain
@@ -14,11 +17,12 @@ from pyramid.i18n import TranslationStringFactory
 from pyramid.settings import asbool
 from pyramid.security import authenticated_userid, Everyone
 
-from sqlalchemy import String, text
+from sqlalchemy import String, DateTime, REAL, text
 
 from sqlalchemy.orm import (
     joinedload_all, aliased, subqueryload_all, undefer)
-from sqlalchemy.sql.expression import bindparam, and_, or_
+from sqlalchemy.sql.expression import (
+    bindparam, and_, or_, tuple_, type_coerce)
 from sqlalchemy.sql import cast, column, func, case
 
 from jwzthreading.jwzthreading import SUBJECT_RE
@@ -28,6 +32,8 @@ import transaction
 from assembl.lib.parsedatetime import parse_datetime
 from assembl.lib.clean_input import sanitize_html, sanitize_text
 from assembl.lib.config import get
+from assembl.lib.json import JSONStream
+from assembl.lib.sqla import yield_in_batches
 from assembl.lib.text_search import (
     add_text_search, postgres_language_configurations)
 from assembl.views.api import API_DISCUSSION_PREFIX
@@ -37,10 +43,12 @@ from assembl.tasks.translate import (
     PrefCollectionTranslationTable)
 from assembl.models import (
     Post, LocalPost, SynthesisPost,
-    Synthesis, Discussion, Content, Idea, ViewPost, User,
+    Synthesis, Discussion, Content, Idea, ViewPost, PostReadBitmap, User,
     IdeaRelatedPostLink, AgentProfile, LikedPost, LangString,
-    LanguagePreferenceCollection, LangStringEntry, Extract)
-from assembl.models.post import deleted_publication_states
+    LanguagePreferenceCollection, LangStringEntry, Extract,
+    PostIdeaContentLink)
+from assembl.models.post import (
+    deleted_publication_states, PostAncestorLoader)
 from assembl.lib.raven_client import capture_message
 
 log = logging.getLogger(__name__)
@@ -56,8 +64,56 @@ post_read = Service(name='post_read', path=API_DISCUSSION_PREFIX + '/post_read/{
                description="Signal that a post was read",
                renderer='json')
 
+posts_read = Service(name='posts_read', path=API_DISCUSSION_PREFIX + '/post_read',
+               description="Signal that many posts were read",
+               renderer='json')
+
 _ = TranslationStringFactory('assembl')
 
+_DESCENDING_ORDERS = ('reverse_chronological', 'score', 'popularity')
+
+
+def _keyset_columns(order, rank=None):
+    """The columns that define a total order on posts for keyset pagination.
+
+    The last one is always the post id, as a tie-breaker."""
+    if order == 'score':
+        return [type_coerce(rank.element, REAL), Content.id]
+    elif order == 'popularity':
+        return [Content.like_count, Content.creation_date, Content.id]
+    else:
+        return [Content.creation_date, Content.id]
+
+
+def _encode_cursor(order, values):
+    """Make an opaque cursor from the keyset values of the last post seen"""
+    values = [v.isoformat() if isinstance(v, datetime) else v
+              for v in values]
+    return urlsafe_b64encode(
+        json.dumps([order] + values).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor, order, columns):
+    """Get back the keyset values from a cursor given by _encode_cursor"""
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+        cursor_order = values.pop(0)
+        assert cursor_order == order and len(values) == len(columns)
+        return [parse_datetime(v, True)
+                if isinstance(col.type, DateTime) else v
+                for (col, v) in zip(columns, values)]
+    except (ValueError, TypeError, AssertionError, IndexError,
+            binascii.Error):
+        raise HTTPBadRequest("Invalid cursor")
+
+
+def _keyset_condition(order, columns, values):
+    """The condition selecting posts after the keyset values"""
+    values = tuple_(*[cast(v, col.type) for (col, v) in zip(columns, values)])
+    if order in _DESCENDING_ORDERS:
+        return tuple_(*columns) < values
+    return tuple_(*columns) > values
+
 
 @posts.get(permission=P_READ)
 def get_posts(request):
@@ -76,6 +132,11 @@ def get_posts(request):
     post_author: filter by author
     keyword: use full-text search
     locale: restrict to locale
+    cursor: use keyset pagination. Give an empty cursor for the first page,
+        then the next_cursor value of the previous page. Without a cursor,
+        all posts are returned at once.
+    limit: page size when using a cursor.
+    stream: serialize the posts incrementally, as they are loaded.
     """
     localizer = request.localizer
     discussion = request.context
@@ -111,6 +172,17 @@ def get_posts(request):
     if page < 1:
         page = 1
 
+    stream = asbool(request.GET.get('stream', False))
+
+    cursor = request.GET.get('cursor', None)
+    if cursor is not None:
+        try:
+            limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise HTTPBadRequest("Invalid limit")
+        if limit < 1:
+            raise HTTPBadRequest("Invalid limit")
+
     root_post_id = request.GET.getall('root_post_id')
     if root_post_id:
         root_post_id = Post.get_database_id(root_post_id[0])
@@ -152,8 +224,6 @@ def get_posts(request):
     )
     ##no_of_posts_to_discussion = posts.count()
 
-    post_data = []
-
     # True means deleted only, False (default) means non-deleted only. None means both.
 
     deleted = request.GET.get('deleted', None)
@@ -256,18 +326,11 @@ def get_posts(request):
     is_unread = request.GET.get('is_unread')
     translations = None
     if user_id != Everyone:
-        # This is horrible, but the join creates complex subqueries that
-        # virtuoso cannot decode properly.
-        read_posts = {v.post_id for v in discussion.db.query(
-            ViewPost).filter(
-                ViewPost.tombstone_condition(),
-                ViewPost.actor_id == user_id,
-                *ViewPost.get_discussion_conditions(discussion.id))}
-        liked_posts = {l.post_id: l.id for l in discussion.db.query(
-            LikedPost).filter(
+        liked_posts_query = discussion.db.query(
+            LikedPost.post_id, LikedPost.id).filter(
                 LikedPost.tombstone_condition(),
                 LikedPost.actor_id == user_id,
-                *LikedPost.get_discussion_conditions(discussion.id))}
+                *LikedPost.get_discussion_conditions(discussion.id))
         if is_unread != None:
             posts = posts.outerjoin(
                 ViewPost, and_(
@@ -294,11 +357,10 @@ def get_posts(request):
     if view_def in ('partial_post', 'id_only'):
         pass  # posts = posts.options(defer(Post.body))
     else:
-        ideaContentLinkQuery = posts.with_entities(
-            PostClass.id, PostClass.idea_content_links_above_post)
-        ideaContentLinkCache = dict(ideaContentLinkQuery.all())
+        if cursor is None:
+            ideaContentLinkCache = PostIdeaContentLink.link_ids_by_post(
+                discussion.db, posts.with_entities(PostClass.id))
         posts = posts.options(
-            # undefer(Post.idea_content_links_above_post),
             joinedload_all(Post.creator),
             joinedload_all(Post.extracts),
             joinedload_all(Post.widget_idea_links),
@@ -309,7 +371,36 @@ def get_posts(request):
         else:
             posts = posts.options(*Content.joinedload_options())
 
-    if order == 'chronological':
+    next_cursor = None
+    if cursor is not None:
+        keyset_columns = _keyset_columns(
+            order, rank if order == 'score' else None)
+        if cursor:
+            posts = posts.filter(_keyset_condition(
+                order, keyset_columns,
+                _decode_cursor(cursor, order, keyset_columns)))
+        if order in _DESCENDING_ORDERS:
+            posts = posts.order_by(*[c.desc() for c in keyset_columns])
+        else:
+            posts = posts.order_by(*keyset_columns)
+        if view_def == 'id_only':
+            posts = posts.with_entities(PostClass.id, *keyset_columns)
+        else:
+            posts = posts.add_columns(*keyset_columns)
+        posts = posts.limit(limit + 1).all()
+        if len(posts) > limit:
+            posts = posts[:limit]
+            next_cursor = _encode_cursor(
+                order, list(posts[-1][-len(keyset_columns):]))
+        page_post_ids = [row[0] if view_def == 'id_only' else row[0].id
+                         for row in posts]
+        if user_id != Everyone:
+            liked_posts_query = liked_posts_query.filter(
+                LikedPost.post_id.in_(page_post_ids))
+        if view_def not in ('partial_post', 'id_only'):
+            ideaContentLinkCache = PostIdeaContentLink.link_ids_by_post(
+                discussion.db, page_post_ids)
+    elif order == 'chronological':
         posts = posts.order_by(Content.creation_date)
     elif order == 'reverse_chronological':
         posts = posts.order_by(Content.creation_date.desc())
@@ -327,87 +418,112 @@ def get_posts(request):
 
     if deleted is True:
         # We just got deleted posts, now we want their ancestors for context
-        post_ids = set()
-        ancestor_ids = set()
-
-        def add_ancestors(post):
-            post_ids.add(post.id)
-            ancestor_ids.update(
-                [int(x) for x in post.ancestry.strip(",").split(",") if x])
         posts = list(posts)
-        for post in posts:
-            add_ancestors(post)
-        ancestor_ids -= post_ids
-        if ancestor_ids:
-            ancestors = discussion.db.query(
-                PostClass).filter(PostClass.id.in_(ancestor_ids))
-            if view_def in ('partial_post', 'id_only'):
-                pass  # ancestors = ancestors.options(defer(Post.body))
+        deleted_posts = [
+            post[0] if isinstance(post, (list, tuple)) else post
+            for post in posts]
+        options = ()
+        if view_def not in ('partial_post', 'id_only'):
+            options = [
+                joinedload_all(Post.creator),
+                joinedload_all(Post.extracts),
+                joinedload_all(Post.widget_idea_links),
+                joinedload_all(SynthesisPost.publishes_synthesis),
+                subqueryload_all(Post.attachments)]
+            if len(discussion.discussion_locales) > 1:
+                options.extend(Content.subqueryload_options())
             else:
-                ancestors = ancestors.options(
-                    # undefer(Post.idea_content_links_above_post),
-                    joinedload_all(Post.creator),
-                    joinedload_all(Post.extracts),
-                    joinedload_all(Post.widget_idea_links),
-                    joinedload_all(SynthesisPost.publishes_synthesis),
-                    subqueryload_all(Post.attachments))
-                if len(discussion.discussion_locales) > 1:
-                    ancestors = ancestors.options(
-                        *Content.subqueryload_options())
-                else:
-                    ancestors = ancestors.options(
-                        *Content.joinedload_options())
-            posts.extend(ancestors.all())
-
-    if view_def == 'id_only':
+                options.extend(Content.joinedload_options())
+        # Share the ancestors with anything else rendering this thread
+        loader = PostAncestorLoader.for_request(discussion.db, request)
+        loader.load(deleted_posts, options)
+        post_ids = {post.id for post in deleted_posts}
+        ancestors = {
+            ancestor.id: ancestor
+            for post in deleted_posts
+            for ancestor in loader.ancestors(post)
+            if ancestor.id not in post_ids}
+        if ancestors and view_def not in ('partial_post', 'id_only'):
+            ideaContentLinkCache.update(
+                PostIdeaContentLink.link_ids_by_post(
+                    discussion.db, list(ancestors)))
+        posts.extend(ancestors.values())
+
+    if view_def == 'id_only' and cursor is None:
         posts = posts.with_entities(PostClass.id)
 
-    for query_result in posts:
-        score, viewpost, likedpost = None, None, None
-        if not isinstance(query_result, (list, tuple)):
-            query_result = [query_result]
-        post = query_result[0]
-        no_of_posts += 1
-        if view_def == 'id_only':
-            post_data.append(Content.uri_generic(post))
-            continue
-        if deleted is True:
-            add_ancestors(post)
-
-        if user_id != Everyone:
-            viewpost = post.id in read_posts
-            likedpost = liked_posts.get(post.id, None)
+    if user_id != Everyone:
+        read_posts = PostReadBitmap.get_bitmap(
+            discussion.db, user_id, discussion.id)
+        liked_posts = dict(liked_posts_query)
+
+    def preload(batch):
+        if view_def != 'id_only':
+            PostClass.preload_for_view_def([
+                row[0] if isinstance(row, (list, tuple)) else row
+                for row in batch], view_def)
+
+    if stream and not isinstance(posts, list):
+        posts = yield_in_batches(
+            posts, _keyset_columns(order, rank if order == 'score' else None),
+            on_batch=preload, descending=order in _DESCENDING_ORDERS)
+    else:
+        posts = list(posts)
+        preload(posts)
+
+    if view_def not in ("partial_post", "id_only"):
+        # Shared by all posts, loaded once
+        discussion_links = Idea.get_discussion_data(
+            discussion.id).idea_content_links(
+            set(chain.from_iterable(ideaContentLinkCache.values())))
+
+    def serialize_posts():
+        nonlocal no_of_posts, no_of_posts_viewed_by_user
+        for query_result in posts:
+            score, viewpost, likedpost = None, None, None
+            if not isinstance(query_result, (list, tuple)):
+                query_result = [query_result]
+            post = query_result[0]
+            no_of_posts += 1
+            if view_def == 'id_only':
+                yield Content.uri_generic(post)
+                continue
+
+            if user_id != Everyone:
+                viewpost = post.id in read_posts
+                likedpost = liked_posts.get(post.id, None)
+                if view_def not in ("partial_post", "id_only"):
+                    translate_content(
+                        post, translation_table=translations, service=service)
+            serializable_post = post.generic_json(
+                view_def, user_id, permissions) or {}
+            if order == 'score':
+                score = query_result[1]
+                serializable_post['score'] = score
+
+            if viewpost:
+                serializable_post['read'] = True
+                no_of_posts_viewed_by_user += 1
+            elif user_id != Everyone and root_post is not None and root_post.id == post.id:
+                # Mark post read, we requested it explicitely
+                viewed_post = ViewPost(
+                    actor_id=user_id,
+                    post=root_post
+                    )
+                discussion.db.add(viewed_post)
+                serializable_post['read'] = True
+            else:
+                serializable_post['read'] = False
+            # serializable_post['liked'] = likedpost.uri() if likedpost else False
+            serializable_post['liked'] = (
+                LikedPost.uri_generic(likedpost) if likedpost else False)
             if view_def not in ("partial_post", "id_only"):
-                translate_content(
-                    post, translation_table=translations, service=service)
-        serializable_post = post.generic_json(
-            view_def, user_id, permissions) or {}
-        if order == 'score':
-            score = query_result[1]
-            serializable_post['score'] = score
-
-        if viewpost:
-            serializable_post['read'] = True
-            no_of_posts_viewed_by_user += 1
-        elif user_id != Everyone and root_post is not None and root_post.id == post.id:
-            # Mark post read, we requested it explicitely
-            viewed_post = ViewPost(
-                actor_id=user_id,
-                post=root_post
-                )
-            discussion.db.add(viewed_post)
-            serializable_post['read'] = True
-        else:
-            serializable_post['read'] = False
-        # serializable_post['liked'] = likedpost.uri() if likedpost else False
-        serializable_post['liked'] = (
-            LikedPost.uri_generic(likedpost) if likedpost else False)
-        if view_def not in ("partial_post", "id_only"):
-            serializable_post['indirect_idea_content_links'] = (
-                post.indirect_idea_content_links_with_cache(
-                    ideaContentLinkCache.get(post.id, None)))
+                serializable_post['indirect_idea_content_links'] = (
+                    post.indirect_idea_content_links_with_cache(
+                        ideaContentLinkCache.get(post.id, ()),
+                        links=discussion_links))
 
-        post_data.append(serializable_post)
+            yield serializable_post
 
     # Benoitg:  For now, this completely garbles threading without intelligent
     #handling of pagination.  Disabling
@@ -422,20 +538,35 @@ def get_posts(request):
     #    ViewPost.actor_id == user_id,
     #).count() if user_id else 0
 
-    data = {}
-    data["page"] = page
-    data["unread"] = no_of_posts - no_of_posts_viewed_by_user
-    data["total"] = no_of_posts
-    data["maxPage"] = max(1, ceil(data["total"]/page_size))
-    #TODO:  Check if we want 1 based index in the api
-    data["startIndex"] = (page_size * page) - (page_size-1)
+    def page_data():
+        # Called once all posts have been serialized
+        if cursor is not None:
+            return {
+                "limit": limit,
+                "next_cursor": next_cursor,
+                "unread": no_of_posts - no_of_posts_viewed_by_user,
+            }
+
+        data = {}
+        data["page"] = page
+        data["unread"] = no_of_posts - no_of_posts_viewed_by_user
+        data["total"] = no_of_posts
+        data["maxPage"] = max(1, ceil(data["total"]/page_size))
+        #TODO:  Check if we want 1 based index in the api
+        data["startIndex"] = (page_size * page) - (page_size-1)
+
+        if data["page"] == data["maxPage"]:
+            data["endIndex"] = data["total"]
+        else:
+            data["endIndex"] = data["startIndex"] + (page_size-1)
+        return data
 
-    if data["page"] == data["maxPage"]:
-        data["endIndex"] = data["total"]
-    else:
-        data["endIndex"] = data["startIndex"] + (page_size-1)
-    data["posts"] = post_data
+    if stream:
+        return JSONStream(serialize_posts(), "posts", page_data)
 
+    post_data = list(serialize_posts())
+    data = page_data()
+    data["posts"] = post_data
     return data
 
 
@@ -495,6 +626,57 @@ def mark_post_read(request):
         } for (idea_id, read_posts) in new_counts] }
 
 
+@posts_read.put(permission=P_READ)
+def mark_posts_read(request):
+    """Mark many posts as read: those given in post_ids, the thread below
+    root_post_id, or the posts of idea_id. Return the read post count
+    for all affected ideas."""
+    discussion = request.context
+    user_id = authenticated_userid(request)
+    if not user_id:
+        raise HTTPUnauthorized()
+    read_data = json.loads(request.body)
+    db = discussion.db
+    conditions = []
+    post_ids = read_data.get('post_ids', None)
+    if post_ids:
+        conditions.append(Post.id.in_(
+            [Post.get_database_id(post_id) for post_id in post_ids]))
+    root_post_id = read_data.get('root_post_id', None)
+    if root_post_id:
+        root_post = Post.get_instance(root_post_id)
+        if not root_post:
+            raise HTTPNotFound("Post with id '%s' not found." % root_post_id)
+        conditions.append((Post.id == root_post.id) | Post.ancestry.like(
+            "%s%d,%%" % (root_post.ancestry or '', root_post.id)))
+    idea_id = read_data.get('idea_id', None)
+    if idea_id:
+        idea = Idea.get_instance(idea_id)
+        if not idea:
+            raise HTTPNotFound("Idea with id '%s' not found." % idea_id)
+        related = Idea.get_related_posts_query_c(
+            discussion.id, idea.id, True)
+        conditions.append(Post.id.in_(db.query(related.c.post_id)))
+    if not conditions:
+        raise HTTPBadRequest(
+            "Give post_ids, root_post_id or idea_id")
+    posts = db.query(Post.id).filter(
+        Post.discussion_id == discussion.id,
+        Post.tombstone_date == None,
+        or_(*conditions)).subquery()
+    with transaction.manager:
+        read_ids = ViewPost.mark_read(db, user_id, discussion.id, posts)
+
+    new_counts = Idea.ideas_read_counts(discussion.id, read_ids)
+
+    return { "ok": True, "read_posts": [
+        Post.uri_generic(post_id) for post_id in read_ids
+        ], "ideas": [
+        {"@id": Idea.uri_generic(idea_id),
+         "num_read_posts": read_posts
+        } for (idea_id, read_posts) in new_counts] }
+
+
 @posts.post(permission=P_ADD_POST)
 def create_post(request):
     """
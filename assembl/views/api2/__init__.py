@@ -39,9 +39,11 @@ The structure of those collection URLs will have to be reconstructed (from the P
 import os
 import datetime
 import inspect as pyinspect
+from itertools import chain
 
 from future.utils import string_types
-from sqlalchemy import inspect
+from sqlalchemy import inspect, func, cast, literal, String
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
     HTTPBadRequest, HTTPNotImplemented, HTTPUnauthorized, HTTPNotFound)
@@ -50,16 +52,20 @@ from pyramid.response import Response
 from pyramid.settings import asbool
 from simplejson import dumps
 
-from assembl.lib.sqla import ObjectNotUniqueError
+from assembl.lib.sqla import (
+    ObjectNotUniqueError, TimestampedMixin, yield_in_batches)
+from assembl.lib.json import JSONStream
+from assembl.lib.caching import (
+    shared_region, get_generation, changes_generations, weak_etag)
 from ..traversal import (
     InstanceContext, CollectionContext, ClassContext, Api2Context)
 from assembl.auth import (
     P_READ, P_SYSADMIN, CrudPermissions)
 from assembl.semantic.virtuoso_mapping import get_virtuoso
 from assembl.models import (
-    User, Discussion, TombstonableMixin)
+    User, Discussion, DiscussionBoundBase, TombstonableMixin)
 from assembl.lib.decl_enums import DeclEnumType
-from .. import JSONError
+from .. import JSONError, etag_matches, not_modified_response
 
 FIXTURE_DIR = os.path.join(
     os.path.dirname(__file__), '..', '..', 'static', 'js', 'tests', 'fixtures')
@@ -80,6 +86,23 @@ def check_permissions(
     return allowed
 
 
+def changes_etag(ctx, target_class, *parts):
+    """A weak ETag for a GET response about instances of target_class,
+    determined by those parts, as long as the change stream has nothing
+    new for the discussion, or outside of any discussion for classes
+    that are not bound to a discussion.
+
+    None if there is no dogpile backend to keep track of changes."""
+    region = shared_region('changes')
+    if not region:
+        return None
+    return weak_etag(*chain(parts, (
+        get_generation(region, generation) for generation in
+        changes_generations(
+            ctx.get_discussion_id(),
+            not issubclass(target_class, DiscussionBoundBase)))))
+
+
 class CreationResponse(Response):
     def __init__(
             self, ob_created, user_id=Everyone, permissions=(P_READ,),
@@ -120,6 +143,15 @@ def instance_view(request):
         raise HTTPUnauthorized()
     view = ctx.get_default_view() or 'default'
     view = request.GET.get('view', view)
+    if isinstance(instance, TimestampedMixin):
+        etag = changes_etag(
+            ctx, instance.__class__, instance.external_typename(), instance.id,
+            instance.last_modified, view, user_id,
+            ','.join(sorted(permissions)))
+        if etag:
+            if etag_matches(request, etag):
+                return not_modified_response(etag)
+            request.response.headers['ETag'] = etag
     return instance.generic_json(view, user_id, permissions)
 
 
@@ -133,10 +165,39 @@ def collection_view(request, default_view='default'):
     view = request.GET.get('view', None) or ctx.get_default_view() or default_view
     tombstones = asbool(request.GET.get('tombstones', False))
     q = ctx.create_query(view == 'id_only', tombstones)
+    if issubclass(ctx.collection_class, TimestampedMixin) \
+            and shared_region('changes'):
+        alias = ctx.class_alias
+        # Aggregate over the query as a subquery, so DISTINCT or GROUP BY
+        # still apply; the hash of the ids sees members being replaced.
+        subquery = q.order_by(None).subquery(with_labels=True)
+        id_column = subquery.corresponding_column(alias.id.expression)
+        (ids_hash, last_modified) = q.session.query(
+            func.md5(func.string_agg(
+                cast(id_column, String),
+                aggregate_order_by(literal(','), id_column))),
+            func.max(subquery.corresponding_column(
+                alias.last_modified.expression))).first()
+        etag = changes_etag(
+            ctx, ctx.collection_class, request.path_qs, ids_hash,
+            last_modified, view, user_id,
+            ','.join(sorted(permissions)))
+        if etag:
+            if etag_matches(request, etag):
+                return not_modified_response(etag)
+            request.response.headers['ETag'] = etag
     if view == 'id_only':
         return [ctx.collection_class.uri_generic(x) for (x,) in q.all()]
+    elif asbool(request.GET.get('stream', False)):
+        cls = ctx.collection_class
+        return JSONStream(
+            i.generic_json(view, user_id, permissions)
+            for i in yield_in_batches(
+                q, ctx.class_alias.id, on_batch=lambda batch:
+                    cls.preload_for_view_def(batch, view)))
     else:
-        res = [i.generic_json(view, user_id, permissions) for i in q.all()]
+        res = ctx.collection_class.generic_json_many(
+            q.all(), view, user_id, permissions)
         return [x for x in res if x is not None]
 
 
@@ -1,7 +1,7 @@
 from builtins import str
 from simplejson import dumps, loads
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from Levenshtein import jaro_winkler
 from pyramid.response import Response
@@ -617,6 +617,39 @@ def set_user_disconnected(request):
     return set_user_dis_connected(request, False)
 
 
+@view_config(context=InstanceContext, request_method='POST',
+             ctx_instance_class=Discussion, header=JSON_HEADER,
+             name="users_dis_connected")
+def set_users_dis_connected(request):
+    """Bulk version of the connecting and disconnecting views,
+    used by the changes router. The JSON body gives, under the "events"
+    key, [user token, connecting, seconds ago] lists, oldest first."""
+    discussion = request.context._instance
+    json = request.json_body
+    now = datetime.now()
+    times = {}
+    for (token, connecting, age) in json.get('events', ()):
+        try:
+            user_id = decode_token(token, TOKEN_SECRET)['userId']
+        except TokenInvalid:
+            continue
+        # Later events prevail
+        times.setdefault(user_id, {})[bool(connecting)] = \
+            now - timedelta(seconds=age)
+    if not times:
+        return HTTPOk()
+    statuses = discussion.db.query(AgentStatusInDiscussion).filter(
+        AgentStatusInDiscussion.discussion_id == discussion.id,
+        AgentStatusInDiscussion.profile_id.in_(list(times.keys())))
+    for status in statuses:
+        user_times = times[status.profile_id]
+        if True in user_times:
+            status.last_connected = user_times[True]
+        if False in user_times:
+            status.last_disconnected = user_times[False]
+    return HTTPOk()
+
+
 @view_config(
     context=InstanceContext, request_method='GET',
     ctx_instance_class=AgentProfile,